@@ -1,13 +1,733 @@
+import atexit
+import os
+import queue
 import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import metrics
+
+
+# schema migrations, applied in order. The version of a database file is kept in `PRAGMA user_version`
+MIGRATIONS = [
+    (1, "add indexes and make target domains unique", [
+        # keep the first row of any duplicated domain so the unique index can be created
+        "DELETE FROM domains WHERE rowid NOT IN (SELECT MIN(rowid) FROM domains GROUP BY domain);",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_domains_domain ON domains(domain);",
+        "CREATE INDEX IF NOT EXISTS idx_logs_timestamp ON logs(timestamp);",
+        "CREATE INDEX IF NOT EXISTS idx_commands_cmd_type ON commands(cmd_type);",
+        "CREATE INDEX IF NOT EXISTS idx_tools_name ON tools(name);",
+        "CREATE INDEX IF NOT EXISTS idx_schedule_time ON schedule(hour, minute);",
+    ]),
+    (2, "index logs by event name for filtered log pages", [
+        "CREATE INDEX IF NOT EXISTS idx_logs_event_timestamp ON logs(event_name, timestamp);",
+    ]),
+    (3, "record tool runs", [
+        """
+            CREATE TABLE IF NOT EXISTS "runs" (
+                "id"	        INTEGER NOT NULL,
+                "cmd_id"    	INTEGER NOT NULL,
+                "tool"      	TEXT    NOT NULL,
+                "command"   	TEXT    NOT NULL,
+                "output"    	TEXT,
+                "status"    	TEXT    NOT NULL,
+                "exit_code" 	INTEGER,
+                "started_at"	timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                "duration"  	REAL,
+                PRIMARY KEY("id" AUTOINCREMENT)
+            );
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_runs_cmd_started ON runs(cmd_id, started_at);",
+    ]),
+    (4, "shard file commands by estimated cost", [
+        "ALTER TABLE runs ADD COLUMN shard INTEGER;",
+        """
+            CREATE TABLE IF NOT EXISTS "domain_costs" (
+                "domain"	TEXT    NOT NULL,
+                "cmd_id"	INTEGER NOT NULL,
+                "seconds"	REAL    NOT NULL,
+                PRIMARY KEY("domain", "cmd_id")
+            );
+        """,
+    ]),
+    (5, "store discovered subdomains", [
+        """
+            CREATE TABLE IF NOT EXISTS "subdomains" (
+                "id"        	INTEGER NOT NULL,
+                "name"      	TEXT    NOT NULL UNIQUE,
+                "domain"    	TEXT    NOT NULL REFERENCES domains(domain) ON DELETE CASCADE,
+                "source"    	TEXT    NOT NULL,
+                "first_seen"	timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                "last_seen" 	timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY("id" AUTOINCREMENT)
+            );
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_subdomains_domain ON subdomains(domain, name);",
+    ]),
+    (6, "track subdomains per run to detect changes", [
+        """
+            CREATE TABLE IF NOT EXISTS "run_domains" (
+                "run_id"	INTEGER NOT NULL REFERENCES runs(id) ON DELETE CASCADE,
+                "domain"	TEXT    NOT NULL,
+                PRIMARY KEY("run_id", "domain")
+            ) WITHOUT ROWID;
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_run_domains_domain ON run_domains(domain, run_id);",
+        """
+            CREATE TABLE IF NOT EXISTS "sightings" (
+                "run_id"      	INTEGER NOT NULL REFERENCES runs(id) ON DELETE CASCADE,
+                "subdomain_id"	INTEGER NOT NULL REFERENCES subdomains(id) ON DELETE CASCADE,
+                PRIMARY KEY("run_id", "subdomain_id")
+            ) WITHOUT ROWID;
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_sightings_subdomain ON sightings(subdomain_id);",
+        """
+            CREATE TABLE IF NOT EXISTS "changes" (
+                "id"          	INTEGER NOT NULL,
+                "run_id"      	INTEGER NOT NULL,
+                "domain"      	TEXT    NOT NULL,
+                "name"        	TEXT    NOT NULL,
+                "change"      	TEXT    NOT NULL,
+                "detected_at" 	timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY("id" AUTOINCREMENT)
+            );
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_changes_domain ON changes(domain, id);",
+    ]),
+    (7, "count changes to the configuration tables for the configuration cache", [
+        """
+            CREATE TABLE IF NOT EXISTS "config_versions" (
+                "name"   	TEXT    NOT NULL,
+                "version"	INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY("name")
+            );
+        """,
+        "INSERT OR IGNORE INTO config_versions (name) VALUES ('tools'), ('commands'), ('schedule');",
+    ] + [
+        f"""
+            CREATE TRIGGER IF NOT EXISTS "{table}_{action.lower()}_version" AFTER {action} ON "{table}"
+            BEGIN
+                UPDATE config_versions SET version = version + 1 WHERE name = '{table}';
+            END;
+        """
+        for table in ("tools", "commands", "schedule") for action in ("INSERT", "UPDATE", "DELETE")
+    ]),
+    (8, "keep hourly counts of log events", [
+        """
+            CREATE TABLE IF NOT EXISTS "log_rollups" (
+                "event_name"	TEXT    NOT NULL,
+                "hour"      	TEXT    NOT NULL,
+                "count"     	INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY("event_name", "hour")
+            ) WITHOUT ROWID;
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_log_rollups_hour ON log_rollups(hour);",
+        # counts survive the archival of the log entries they were made from
+        """
+            INSERT INTO log_rollups (event_name, hour, count)
+            SELECT event_name, strftime('%Y-%m-%d %H:00:00', timestamp), COUNT(*) FROM logs GROUP BY 1, 2;
+        """,
+        """
+            CREATE TRIGGER IF NOT EXISTS "logs_insert_rollup" AFTER INSERT ON "logs"
+            BEGIN
+                INSERT INTO log_rollups (event_name, hour, count)
+                VALUES (NEW.event_name, strftime('%Y-%m-%d %H:00:00', NEW.timestamp), 1)
+                ON CONFLICT(event_name, hour) DO UPDATE SET count = count + 1;
+            END;
+        """,
+    ]),
+    (9, "count changes to the domains table for the scope matcher", [
+        "INSERT OR IGNORE INTO config_versions (name) VALUES ('domains');",
+    ] + [
+        f"""
+            CREATE TRIGGER IF NOT EXISTS "domains_{action.lower()}_version" AFTER {action} ON "domains"
+            BEGIN
+                UPDATE config_versions SET version = version + 1 WHERE name = 'domains';
+            END;
+        """
+        for action in ("INSERT", "UPDATE", "DELETE")
+    ]),
+    (10, "store DNS resolution of subdomains", [
+        """
+            CREATE TABLE IF NOT EXISTS "resolutions" (
+                "subdomain_id"	INTEGER NOT NULL REFERENCES subdomains(id) ON DELETE CASCADE,
+                "status"      	TEXT    NOT NULL,
+                "resolved_at" 	timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY("subdomain_id")
+            );
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_resolutions_resolved_at ON resolutions(resolved_at);",
+        """
+            CREATE TABLE IF NOT EXISTS "dns_records" (
+                "subdomain_id"	INTEGER NOT NULL REFERENCES subdomains(id) ON DELETE CASCADE,
+                "record_type" 	TEXT    NOT NULL,
+                "value"       	TEXT    NOT NULL,
+                "ttl"         	INTEGER NOT NULL,
+                "first_seen"  	timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                "last_seen"   	timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY("subdomain_id", "record_type", "value")
+            ) WITHOUT ROWID;
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_dns_records_value ON dns_records(value);",
+    ]),
+    (11, "queue jobs for worker processes", [
+        # lease_expires and available_at are Unix times, compared with sub-second precision
+        """
+            CREATE TABLE IF NOT EXISTS "job_queue" (
+                "id"           	INTEGER NOT NULL,
+                "cmd_id"       	INTEGER NOT NULL,
+                "shard"        	INTEGER,
+                "tool"         	TEXT    NOT NULL,
+                "argv"         	TEXT    NOT NULL,
+                "output"       	TEXT    NOT NULL,
+                "domain_file"  	TEXT,
+                "domains"      	TEXT    NOT NULL DEFAULT '[]',
+                "merge_output" 	TEXT,
+                "state"        	TEXT    NOT NULL DEFAULT 'queued',
+                "lease_owner"  	TEXT,
+                "lease_expires"	REAL,
+                "attempts"     	INTEGER NOT NULL DEFAULT 0,
+                "max_attempts" 	INTEGER NOT NULL,
+                "available_at" 	REAL    NOT NULL,
+                "run_id"       	INTEGER,
+                "last_error"   	TEXT,
+                "enqueued_at"  	timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY("id" AUTOINCREMENT)
+            );
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_job_queue_state ON job_queue(state, available_at);",
+        "CREATE INDEX IF NOT EXISTS idx_job_queue_merge_output ON job_queue(merge_output) WHERE merge_output IS NOT NULL;",
+    ]),
+    (12, "remember the last successful scan of every domain per command", [
+        """
+            CREATE TABLE IF NOT EXISTS "domain_scans" (
+                "domain"       	TEXT    NOT NULL,
+                "cmd_id"       	INTEGER NOT NULL,
+                "run_id"       	INTEGER NOT NULL,
+                "completed_at" 	timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                "output_digest"	TEXT,
+                "seconds"      	REAL    NOT NULL,
+                PRIMARY KEY("domain", "cmd_id")
+            ) WITHOUT ROWID;
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_domain_scans_completed ON domain_scans(cmd_id, completed_at);",
+        # the last successful run of every pair so far; MAX() picks the row the other columns are read from
+        """
+            INSERT OR IGNORE INTO domain_scans (domain, cmd_id, run_id, completed_at, seconds)
+            SELECT run_domains.domain, runs.cmd_id, MAX(runs.id),
+                   datetime(runs.started_at, '+' || CAST(COALESCE(runs.duration, 0) AS INTEGER) || ' seconds'),
+                   COALESCE(runs.duration, 0) / (SELECT COUNT(*) FROM run_domains AS covered WHERE covered.run_id = runs.id)
+            FROM run_domains JOIN runs ON runs.id = run_domains.run_id
+            WHERE runs.status = 'success'
+            GROUP BY run_domains.domain, runs.cmd_id;
+        """,
+    ]),
+    (13, "remember whether a scan printed the same output as the one before", [
+        "ALTER TABLE domain_scans ADD COLUMN unchanged INTEGER NOT NULL DEFAULT 0;",
+    ]),
+    (14, "journal the changed target domains, so every process updates its scope matcher in place", [
+        """
+            CREATE TABLE IF NOT EXISTS "domain_changes" (
+                "id"    	INTEGER NOT NULL,
+                "domain"	TEXT    NOT NULL,
+                PRIMARY KEY("id" AUTOINCREMENT)
+            );
+        """,
+        """
+            CREATE TRIGGER IF NOT EXISTS "domains_insert_journal" AFTER INSERT ON "domains"
+            BEGIN
+                INSERT INTO domain_changes (domain) VALUES (NEW.domain);
+            END;
+        """,
+        """
+            CREATE TRIGGER IF NOT EXISTS "domains_update_journal" AFTER UPDATE ON "domains"
+            BEGIN
+                INSERT INTO domain_changes (domain) VALUES (OLD.domain);
+                INSERT INTO domain_changes (domain) SELECT NEW.domain WHERE NEW.domain != OLD.domain;
+            END;
+        """,
+        """
+            CREATE TRIGGER IF NOT EXISTS "domains_delete_journal" AFTER DELETE ON "domains"
+            BEGIN
+                INSERT INTO domain_changes (domain) VALUES (OLD.domain);
+            END;
+        """,
+        # only the latest 100000 changes are kept; matchers further behind rebuild their trie
+        """
+            CREATE TRIGGER IF NOT EXISTS "domain_changes_trim" AFTER INSERT ON "domain_changes" WHEN NEW.id % 1000 = 0
+            BEGIN
+                DELETE FROM domain_changes WHERE id <= NEW.id - 100000;
+            END;
+        """,
+    ]),
+]
+
+
+def applyMigrations(connection):
+    """
+    `applyMigrations` upgrades the schema behind `connection` to the latest version.
+
+    The caller is responsible for the surrounding transaction. Returns the list of applied versions.
+    """
+    current_version = connection.execute("PRAGMA user_version;").fetchone()[0]
+    applied = []
+
+    for version, description, statements in MIGRATIONS:
+        if version <= current_version:
+            continue
+        for statement in statements:
+            connection.execute(statement)
+        connection.execute(f"PRAGMA user_version={int(version)};")
+        applied.append(version)
+
+    return applied
+
+
+class ConnectionPool:
+    """
+    `ConnectionPool` keeps one open connection per thread for a database file.
+
+    Connections are opened lazily on first use by a thread and handed back to an
+    idle list once the owning thread has exited, so short lived request threads
+    reuse connections instead of paying for `sqlite3.connect` on every query.
+
+    Connections are never shared between processes: after a fork (e.g. in WSGI
+    worker processes) the inherited connections are dropped and new ones opened.
+    """
+
+    def __init__(self, db_file, journal_mode="WAL", synchronous="NORMAL", cache_size=-16000,
+                 busy_timeout=5000, cached_statements=256, max_idle=8):
+        self.db_file = db_file
+        self.journal_mode = journal_mode
+        self.synchronous = synchronous
+        self.cache_size = cache_size
+        self.busy_timeout = busy_timeout
+        self.cached_statements = cached_statements
+        self.max_idle = max_idle
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._owners = {}
+        self._idle = []
+        self._pid = os.getpid()
+
+    def openConnection(self):
+        """
+        `openConnection` opens a new connection and applies the configured pragmas
+        """
+        start = time.perf_counter()
+        # autocommit mode; transactions are started explicitly by `Manager.transaction`
+        connection = sqlite3.connect(self.db_file,
+                                     timeout=self.busy_timeout / 1000,
+                                     isolation_level=None,
+                                     check_same_thread=False,
+                                     cached_statements=self.cached_statements)
+
+        if self.journal_mode:
+            connection.execute(f"PRAGMA journal_mode={self.journal_mode};")
+        connection.execute(f"PRAGMA synchronous={self.synchronous};")
+        connection.execute(f"PRAGMA cache_size={int(self.cache_size)};")
+        connection.execute(f"PRAGMA busy_timeout={int(self.busy_timeout)};")
+        connection.execute("PRAGMA temp_store=MEMORY;")
+        connection.execute("PRAGMA foreign_keys=ON;")
+
+        metrics.CONNECT_DURATION.observe(time.perf_counter() - start)
+        return connection
+
+    def getConnection(self):
+        """
+        `getConnection` returns the connection owned by the calling thread
+        """
+        if self._pid != os.getpid():
+            self._forget()
+
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            return connection
+
+        with self._lock:
+            self._reclaim()
+            if self._idle:
+                connection = self._idle.pop()
+            else:
+                connection = self.openConnection()
+            self._owners[threading.current_thread()] = connection
+
+        self._local.connection = connection
+        self._local.depth = 0
+        return connection
+
+    def _reclaim(self):
+        # move connections of finished threads back to the idle list
+        for thread, connection in list(self._owners.items()):
+            if thread.is_alive():
+                continue
+            del self._owners[thread]
+            if connection.in_transaction:
+                connection.rollback()
+            if len(self._idle) < self.max_idle:
+                self._idle.append(connection)
+            else:
+                connection.close()
+
+    def _forget(self):
+        # connections inherited from the parent process must not be used or closed in the child.
+        # The lock is replaced too, as another thread of the parent may have held it during the fork
+        self._lock = threading.Lock()
+        self._owners = {}
+        self._idle = []
+        self._local = threading.local()
+        self._pid = os.getpid()
+
+    def closeAll(self):
+        """
+        `closeAll` closes every connection opened by this pool
+        """
+        with self._lock:
+            for connection in list(self._owners.values()) + self._idle:
+                connection.close()
+            self._owners = {}
+            self._idle = []
+            self._local = threading.local()
+
+
+class EventLogWriter:
+    """
+    `EventLogWriter` writes application events to the `logs` table from a background thread.
+
+    Events are put on a bounded in-memory queue and flushed with a single `executemany`
+    once `batch_size` events are waiting or `flush_interval` seconds have passed. When the
+    queue is full, callers wait at most `put_timeout` seconds before the event is dropped
+    and counted in `dropped`.
+    """
+
+    def __init__(self, manager, max_queue=10000, batch_size=500, flush_interval=1.0, put_timeout=0.05):
+        self.manager = manager
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.enqueued = 0
+        self.written = 0
+        self.dropped = 0
+        self.batches = 0
+
+        self._counter_lock = threading.Condition()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """
+        `start` starts the writer thread and registers a flush for interpreter shutdown
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="EventLogWriter", daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def enqueue(self, event_info):
+        """
+        `enqueue` queues events for writing. Returns the number of events that were dropped
+        """
+        # keep the time the event happened, not the time the batch was written
+        timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+        dropped = 0
+
+        for event_name, event_details in event_info:
+            try:
+                self.queue.put((event_name, event_details, timestamp), timeout=self.put_timeout)
+            except queue.Full:
+                dropped += 1
+
+        with self._counter_lock:
+            self.enqueued += len(event_info) - dropped
+            self.dropped += dropped
+
+        return dropped
+
+    def flush(self, timeout=5.0):
+        """
+        `flush` waits until every event queued before the call has been written
+        """
+        with self._counter_lock:
+            target = self.enqueued
+            return self._counter_lock.wait_for(lambda: self.written >= target or not self.is_running(), timeout)
+
+    def stop(self, timeout=10.0):
+        """
+        `stop` writes all queued events and stops the writer thread
+        """
+        if self._thread is None:
+            return
+        self._stop_event.set()
+        self._thread.join(timeout)
+        self._thread = None
+        atexit.unregister(self.stop)
+
+    def stats(self):
+        """
+        `stats` returns the writer counters as a dictionary
+        """
+        with self._counter_lock:
+            return {
+                "queued": self.queue.qsize(),
+                "enqueued": self.enqueued,
+                "written": self.written,
+                "dropped": self.dropped,
+                "batches": self.batches,
+            }
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch:
+                self._write(batch)
+            elif self._stop_event.is_set():
+                break
+
+    def _collect(self):
+        # block for the first event, then gather more until the batch is full or the interval ends
+        batch = []
+        try:
+            batch.append(self.queue.get(timeout=0.1 if self._stop_event.is_set() else self.flush_interval))
+        except queue.Empty:
+            return batch
+
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if self._stop_event.is_set():
+                remaining = 0
+            try:
+                if remaining <= 0:
+                    batch.append(self.queue.get_nowait())
+                else:
+                    batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _write(self, batch):
+        try:
+            with self.manager.transaction() as connection:
+                connection.executemany(
+                    """INSERT INTO logs(event_name, event_details, timestamp) VALUES (?, ?, ?);""", batch)
+        except sqlite3.Error:
+            with self._counter_lock:
+                self.dropped += len(batch)
+                self.enqueued -= len(batch)
+                self._counter_lock.notify_all()
+            return
+
+        with self._counter_lock:
+            self.written += len(batch)
+            self.batches += 1
+            self._counter_lock.notify_all()
+
+
+class ConfigCache:
+    """
+    `ConfigCache` keeps the small configuration tables (`tools`, `commands`, `schedule`) in memory.
+
+    A table is read on first use and served from memory until it is invalidated. Writes through
+    `Manager` invalidate the tables they mention. Writes by other connections or processes are
+    noticed through `PRAGMA data_version`, which is checked on every lookup; when it changed,
+    the per-table counters in `config_versions` (kept up to date by triggers) tell which tables
+    were actually modified, so unrelated writes such as new log entries keep the cache.
+    """
+
+    TABLES = {
+        "tools": "SELECT * FROM tools;",
+        "commands": "SELECT * FROM commands;",
+        "schedule": "SELECT * FROM schedule;",
+    }
+
+    def __init__(self, manager):
+        self.manager = manager
+        self.tables = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+        # bumped by every invalidation, so rows read before one are not cached after it
+        self._generation = 0
+        self._data_versions = {}
+        self._table_versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, table):
+        """
+        `get` returns all rows of a cached table as a tuple
+        """
+        connection = self.manager.pool.getConnection()
+        data_version = connection.execute("PRAGMA data_version;").fetchone()[0]
+
+        # data_version only changes for commits made by other connections than this one
+        if self._data_versions.get(id(connection)) != data_version:
+            table_versions = dict(connection.execute("SELECT name, version FROM config_versions;").fetchall())
+            with self._lock:
+                self._data_versions[id(connection)] = data_version
+                for name, version in table_versions.items():
+                    if self._table_versions.get(name) != version:
+                        self._table_versions[name] = version
+                        if self.tables.pop(name, None) is not None:
+                            self.invalidations += 1
+
+        with self._lock:
+            rows = self.tables.get(table)
+            if rows is not None:
+                self.hits += 1
+                return rows
+            self.misses += 1
+            generation = self._generation
+
+        rows = tuple(connection.execute(self.TABLES[table]).fetchall())
+        # uncommitted rows of an open transaction must not be shared with other threads
+        if not connection.in_transaction:
+            with self._lock:
+                if self._generation == generation:
+                    self.tables[table] = rows
+        return rows
+
+    def invalidate(self, query=None):
+        """
+        `invalidate` drops the cached tables mentioned in `query`, or all of them
+        """
+        with self._lock:
+            self._generation += 1
+            if query is None:
+                self._clear()
+                return
+            query = query.lower()
+            for table in list(self.tables):
+                if table in query:
+                    del self.tables[table]
+                    self.invalidations += 1
+
+    def _clear(self):
+        self.invalidations += len(self.tables)
+        self.tables = {}
+
+    def stats(self):
+        """
+        `stats` returns the cache counters as a dictionary
+        """
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "invalidations": self.invalidations,
+                    "cached_tables": sorted(self.tables)}
 
 
 class Manager:
     """
     `Manager` handles database related operations
+
+    The execute methods record their duration and row count in `metrics`. Queries taking at
+    least `slow_query_threshold` seconds are also written to the log as `slow_query` events.
     """
 
-    def __init__(self, db_file):
+    def __init__(self, db_file, slow_query_threshold=None, **pool_options):
         self.db_file = db_file
+        self.slow_query_threshold = slow_query_threshold
+        self.pool = ConnectionPool(db_file, **pool_options)
+        self.config_cache = ConfigCache(self)
+        self.log_writer = None
+
+    def startLogWriter(self, **writer_options):
+        """
+        `startLogWriter` makes `logEvent` queue events for a background `EventLogWriter`
+        """
+        if self.log_writer is None:
+            self.log_writer = EventLogWriter(self, **writer_options)
+        self.log_writer.start()
+        return self.log_writer
+
+    def flushEvents(self, timeout=5.0):
+        """
+        `flushEvents` waits until queued events are visible in the `logs` table
+        """
+        if self.log_writer is not None and self.log_writer.is_running():
+            self.log_writer.flush(timeout)
+
+    @contextmanager
+    def transaction(self):
+        """
+        `transaction` groups the queries run inside the `with` block into a single transaction.
+
+        The transaction is committed when the block exits and rolled back if it raises. Nested
+        blocks join the outermost transaction. Yields the underlying connection.
+        """
+        connection = self.pool.getConnection()
+        local = self.pool._local
+
+        if local.depth > 0:
+            local.depth += 1
+            try:
+                yield connection
+            finally:
+                local.depth -= 1
+            return
+
+        connection.execute("BEGIN IMMEDIATE;")
+        local.depth = 1
+        local.pending_invalidations = []
+        try:
+            yield connection
+        except BaseException:
+            connection.rollback()
+            raise
+        else:
+            connection.commit()
+            # other threads may only drop the cached rows once they can read the committed ones
+            for query in local.pending_invalidations:
+                self.config_cache.invalidate(query)
+        finally:
+            local.depth = 0
+            local.pending_invalidations = []
+
+    def invalidateConfigCache(self, query=None):
+        """
+        `invalidateConfigCache` drops the cached tables written by `query`, once its transaction is committed
+        """
+        local = self.pool._local
+        if getattr(local, "depth", 0) > 0:
+            local.pending_invalidations.append(query)
+        else:
+            self.config_cache.invalidate(query)
+
+    def migrate(self):
+        """
+        `migrate` upgrades an existing database file to the latest schema version in place
+        """
+        with self.transaction() as connection:
+            applied = applyMigrations(connection)
+
+        for version in applied:
+            description = [migration[1] for migration in MIGRATIONS if migration[0] == version][0]
+            self.logEvent([("database_migrated", f"Database upgraded to version {version}: {description}")])
+
+        return applied
+
+    def schemaVersion(self):
+        """
+        `schemaVersion` returns the schema version of the database file
+        """
+        return self.execute_select_query("PRAGMA user_version;", ())[0][0]
+
+    def close(self):
+        """
+        `close` flushes queued events and closes all pooled database connections
+        """
+        if self.log_writer is not None:
+            self.log_writer.stop()
+        self.pool.closeAll()
 
     def createNewDB(db_location):
         """ 
@@ -16,6 +736,9 @@ class Manager:
         connection = sqlite3.connect(db_location)
         cursor = connection.cursor()
 
+        # lets `retention.LogRetention` give pages freed by deleted logs back to the file system
+        cursor.execute("PRAGMA auto_vacuum=INCREMENTAL;")
+
         # create a new table called domains that will store domains in scope
         cursor.execute("""
             CREATE TABLE "domains" (
@@ -86,7 +809,8 @@ class Manager:
             )
         """)
 
-        
+
+        applyMigrations(connection)
 
         connection.commit()
         connection.close()
@@ -96,67 +820,197 @@ class Manager:
         `logEvent` adds a new application event in the database.
 
         `event_info`: Takes the values to be inserted. E.g.[("target_added", "A new target domain.com was added")]
-        """
 
-        connection = sqlite3.connect(self.db_file)
-        cursor = connection.cursor()
+        When the log writer is running the events are queued and written in batches.
+        """
 
-        cursor.executemany(
-            """INSERT INTO logs(event_name, event_details) VALUES (?, ?);""", event_info)
+        if self.log_writer is not None and self.log_writer.is_running():
+            self.log_writer.enqueue(event_info)
+            return
 
-        connection.commit()
-        connection.close()
+        with self.transaction() as connection:
+            connection.executemany(
+                """INSERT INTO logs(event_name, event_details) VALUES (?, ?);""", event_info)
 
     def addTargetDomain(self, domain, program_url, enabled):
         """ 
         `addTargetDomain` adds a new target domain to the database file
         """
-        connection = sqlite3.connect(self.db_file)
-        cursor = connection.cursor()
+        query = "INSERT INTO domains (domain, program_url, enabled) VALUES (?, ?, ?); "
+        self.pool.getConnection().execute(query, (domain, program_url, enabled))
+        self.invalidateConfigCache(query)
 
-        cursor.execute(
-            f"INSERT INTO domains (domain, program_url, enabled) VALUES (\"{domain}\", \"{program_url}\", {enabled}); "
-        )
+    def selectLogsPage(self, limit=50, before=None, event_name=None, since=None, until=None):
+        """
+        `selectLogsPage` returns one page of logs, newest first, and the cursor of the next page.
 
-        connection.commit()
-        connection.close()
+        Pages are addressed by the (timestamp, rowid) of the last row of the previous page, so
+        every page is an index range scan no matter how deep it is. `before` is such a cursor,
+        `event_name`, `since` and `until` filter the rows. Returns (rows, next_cursor) where rows
+        are (rowid, event_name, event_details, timestamp) and next_cursor is None on the last page.
+        """
+        conditions = []
+        params = []
+
+        if before is not None:
+            conditions.append("(timestamp, rowid) < (?, ?)")
+            params.extend(before)
+        if event_name:
+            conditions.append("event_name=?")
+            params.append(event_name)
+        if since:
+            conditions.append("timestamp>=?")
+            params.append(since)
+        if until:
+            conditions.append("timestamp<=?")
+            params.append(until)
+
+        query = "SELECT rowid, event_name, event_details, timestamp FROM logs"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY timestamp DESC, rowid DESC LIMIT ?;"
+        params.append(limit + 1)
+
+        rows = self.execute_select_query(query, params)
+        if len(rows) > limit:
+            rows = rows[:limit]
+            return rows, (rows[-1][3], rows[-1][0])
+        return rows, None
+
+    def selectLogRollups(self, since=None, event_name=None):
+        """
+        `selectLogRollups` returns the number of log events per event name and hour as (event_name, hour, count) rows
+        """
+        conditions = []
+        params = []
+        if since:
+            conditions.append("hour>=?")
+            params.append(since)
+        if event_name:
+            conditions.append("event_name=?")
+            params.append(event_name)
+
+        query = "SELECT event_name, hour, count FROM log_rollups"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY hour DESC, event_name;"
+        return self.execute_select_query(query, params)
+
+    def _namedCursor(self, query, parameters):
+        # rows of this cursor can be read by column name, e.g. row["command"]
+        cursor = self.pool.getConnection().cursor()
+        cursor.row_factory = sqlite3.Row
+        return cursor.execute(query, parameters)
+
+    def selectCommand(self, cmd_id):
+        """
+        `selectCommand` returns the command with the given id as a named row, or None
+        """
+        return self._namedCursor(
+            "SELECT id, tool, command, file_command, cmd_type FROM commands WHERE id=?;", (cmd_id,)).fetchone()
+
+    def selectScheduleEntry(self, schedule_id):
+        """
+        `selectScheduleEntry` returns the schedule entry with the given id as a named row, or None
+        """
+        return self._namedCursor(
+            "SELECT id, hour, minute, day, cmd_id, cmd_type FROM schedule WHERE id=?;", (schedule_id,)).fetchone()
+
+    def selectScheduleWithCommands(self):
+        """
+        `selectScheduleWithCommands` yields every schedule entry together with the command and tool it runs.
+
+        The command is joined in the same query, so the whole schedule is read in one round trip.
+        `command` and `tool` are None for entries whose command no longer exists.
+        """
+        cursor = self._namedCursor(
+            """SELECT schedule.id, schedule.hour, schedule.minute, schedule.day, schedule.cmd_id, schedule.cmd_type,
+                      commands.command, commands.tool
+               FROM schedule LEFT JOIN commands ON commands.id = schedule.cmd_id
+               ORDER BY schedule.id;""", ())
+        try:
+            yield from cursor
+        finally:
+            cursor.close()
+
+    def selectCommandsByType(self, cmd_type):
+        """
+        `selectCommandsByType` returns the commands of a command type as named rows
+        """
+        return self._namedCursor(
+            "SELECT id, tool, command, file_command, cmd_type FROM commands WHERE cmd_type=?;", (cmd_type,)).fetchall()
+
+    def _observeQuery(self, query, seconds, rows):
+        statement = metrics.statementLabel(query)
+        metrics.QUERY_DURATION.observe(seconds, statement)
+        metrics.QUERY_ROWS.inc(statement, amount=max(rows, 0))
+
+        if self.slow_query_threshold is not None and seconds >= self.slow_query_threshold:
+            self.logEvent([("slow_query", f"{seconds * 1000:.1f} ms, {rows} rows: {' '.join(query.split())[:500]}")])
 
     def execute_select_query(self, query, parameters):
         """
         `execute_select_query` executes a SQL SELECT query and returns its output
         """
+        start = time.perf_counter()
+        rows = self.pool.getConnection().execute(query, parameters).fetchall()
+        self._observeQuery(query, time.perf_counter() - start, len(rows))
+        return rows
 
-        connection = sqlite3.connect(self.db_file)
-        cursor = connection.cursor()
-        cursor.execute(query, parameters)
-        target_data = cursor.fetchall()
-        connection.commit()
-        connection.close()
-
-        return target_data
+    def iterate_select_query(self, query, parameters, batch_size=500):
+        """
+        `iterate_select_query` executes a SQL SELECT query and yields its rows as they are read
+        """
+        # only the time spent reading rows counts, not the time the caller spends on them
+        start = time.perf_counter()
+        cursor = self.pool.getConnection().execute(query, parameters)
+        seconds = 0.0
+        count = 0
+        try:
+            rows = cursor.fetchmany(batch_size)
+            seconds += time.perf_counter() - start
+            while rows:
+                count += len(rows)
+                yield from rows
+                start = time.perf_counter()
+                rows = cursor.fetchmany(batch_size)
+                seconds += time.perf_counter() - start
+        finally:
+            cursor.close()
+            self._observeQuery(query, seconds, count)
 
     def execute_other_query(self, query, params):
         """
         `execute_other_query` executes SQL query without returning a value
         """
-
-        connection = sqlite3.connect(self.db_file)
-        cursor = connection.cursor()
-
-        cursor.execute(query, params)
-
-        connection.commit()
-        connection.close()
+        start = time.perf_counter()
+        cursor = self.pool.getConnection().execute(query, params)
+        self._observeQuery(query, time.perf_counter() - start, cursor.rowcount)
+        self.invalidateConfigCache(query)
 
     def execute_multi_query(self, query, seq_of_parameters):
         """
         `execute_multi_query` runs executemany function. Takes query and parameters
         """
+        start = time.perf_counter()
+        with self.transaction() as connection:
+            cursor = connection.executemany(query, seq_of_parameters)
+        self._observeQuery(query, time.perf_counter() - start, cursor.rowcount)
+        self.invalidateConfigCache(query)
 
-        connection = sqlite3.connect(self.db_file)
-        cursor = connection.cursor()
-
-        cursor.executemany(query, seq_of_parameters)
 
-        connection.commit()
-        connection.close()
+def prepareDatabase(db_file, new_db=False):
+    """
+    `prepareDatabase` creates the database file if needed, otherwise upgrades it to the latest schema
+    """
+    if new_db or not os.path.exists(db_file):
+        if os.path.dirname(db_file):
+            os.makedirs(os.path.dirname(db_file), exist_ok=True)
+        Manager.createNewDB(db_file)
+        return "created"
+
+    # upgrade databases created by older versions
+    db_manager = Manager(db_file)
+    applied = db_manager.migrate()
+    db_manager.close()
+    return f"upgraded to version {applied[-1]}" if applied else "up to date"
@@ -0,0 +1,313 @@
+#!/usr/bin/python3
+# This file handles reading and changing the records exposed
+# by the JSON API of the web interface
+
+import gzip
+import sqlite3
+
+import importer
+
+# responses smaller than this are not worth compressing
+GZIP_MIN_SIZE = 1024
+GZIP_LEVEL = 6
+# most records accepted by one batch request
+MAX_BATCH_SIZE = 10000
+
+BATCH_OPERATIONS = ("create", "update", "delete")
+
+
+class ApiError(Exception):
+    """
+    `ApiError` is raised for a request that can't be applied. `index` is the position of the failing record
+    """
+
+    def __init__(self, message, status=400, operation=None, index=None):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+        self.operation = operation
+        self.index = index
+
+    def toDict(self):
+        error = {"error": self.message}
+        if self.operation is not None:
+            error["operation"] = self.operation
+            error["index"] = self.index
+        return error
+
+
+def text(value):
+    if not isinstance(value, str) or not value.strip():
+        raise ValueError("must be a non-empty string")
+    return value.strip()
+
+
+def flag(value):
+    if value in (0, 1, True, False, "0", "1"):
+        return int(value)
+    raise ValueError("must be 0 or 1")
+
+
+def integer(value):
+    if isinstance(value, bool):
+        raise ValueError("must be an integer")
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError("must be an integer")
+
+
+def optionalText(value):
+    if value is None:
+        return None
+    return text(value)
+
+
+def domainName(value):
+    domain = importer.normalizeDomain(text(value))
+    if not importer.DOMAIN_PATTERN.match(domain):
+        raise ValueError("must be a valid domain name")
+    return domain
+
+
+def programUrl(value):
+    if not importer.PROGRAM_URL_PATTERN.match(text(value)):
+        raise ValueError("must be a valid program URL")
+    return value.strip()
+
+
+class Resource:
+    """
+    `Resource` describes how the records of one table are read and changed through the API.
+
+    `columns` maps every column, in table order, to the function that checks and converts a
+    value sent by a client. `key` identifies a record; it is generated for tables whose key
+    is an integer id when a record is created without one.
+    """
+
+    def __init__(self, table, key, columns, operations=BATCH_OPERATIONS, defaults=None, validate=None):
+        self.table = table
+        self.key = key
+        self.columns = columns
+        self.operations = operations
+        self.defaults = defaults or {}
+        self.validate = validate
+
+    def toDict(self, row):
+        return dict(zip(self.columns, row))
+
+    def convert(self, record, required):
+        if not isinstance(record, dict):
+            raise ValueError("record must be an object")
+        unknown = set(record) - set(self.columns)
+        if unknown:
+            raise ValueError(f"unknown fields: {', '.join(sorted(unknown))}")
+
+        values = {}
+        for column, converter in self.columns.items():
+            if column in record:
+                try:
+                    values[column] = converter(record[column])
+                except ValueError as e:
+                    raise ValueError(f"`{column}` {e}")
+            elif required and column != self.key and column not in self.defaults:
+                raise ValueError(f"`{column}` is required")
+        return values
+
+    def select(self, connection, key):
+        cursor = connection.execute(
+            f"SELECT {', '.join(self.columns)} FROM {self.table} WHERE {self.key}=?;", (key,))
+        row = cursor.fetchone()
+        return None if row is None else self.toDict(row)
+
+    def create(self, connection, record):
+        values = self.convert(record, required=True)
+        for column, default in self.defaults.items():
+            if column not in values:
+                values[column] = default(connection, values)
+        if self.validate is not None:
+            self.validate(connection, values)
+
+        columns = list(values)
+        cursor = connection.execute(
+            f"INSERT INTO {self.table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))});",
+            [values[column] for column in columns])
+        return values.get(self.key, cursor.lastrowid)
+
+    def update(self, connection, record):
+        changes = self.convert(record, required=False)
+        if self.key not in changes:
+            raise ValueError(f"`{self.key}` is required")
+        current = self.select(connection, changes[self.key])
+        if current is None:
+            raise LookupError(f"{changes[self.key]} doesn't exist")
+
+        current.update(changes)
+        if self.validate is not None:
+            self.validate(connection, current)
+
+        columns = [column for column in self.columns if column != self.key]
+        connection.execute(
+            f"UPDATE {self.table} SET {', '.join(column + '=?' for column in columns)} WHERE {self.key}=?;",
+            [current[column] for column in columns] + [current[self.key]])
+        return current[self.key]
+
+    def delete(self, connection, key):
+        key = self.columns[self.key](key)
+        if connection.execute(f"DELETE FROM {self.table} WHERE {self.key}=?;", (key,)).rowcount == 0:
+            raise LookupError(f"{key} doesn't exist")
+        return key
+
+
+def defaultCmdType(connection, values):
+    # same rule as the `new_command` form
+    return "subdomain_enum" if values["tool"] in ("amass", "subfinder") else ""
+
+
+def nextScheduleId(connection, values):
+    # `schedule.id` isn't an alias of the rowid, so it is not generated by SQLite
+    return connection.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM schedule;").fetchone()[0]
+
+
+def scheduleCmdType(connection, values):
+    row = connection.execute("SELECT cmd_type FROM commands WHERE id=?;", (values["cmd_id"],)).fetchone()
+    if row is None:
+        raise ValueError(f"command {values['cmd_id']} doesn't exist")
+    return row[0]
+
+
+def validateSchedule(connection, values):
+    # imported here, so web workers don't load the scheduler and executors with the API
+    import runner
+
+    # the runner refuses entries it can't schedule, so refuse them here as well
+    runner.ScheduleEntry(**values)
+    if connection.execute("SELECT 1 FROM commands WHERE id=?;", (values["cmd_id"],)).fetchone() is None:
+        raise ValueError(f"command {values['cmd_id']} doesn't exist")
+
+
+RESOURCES = {
+    "targets": Resource("domains", "domain", {
+        "domain": domainName,
+        "program_url": programUrl,
+        "enabled": flag,
+    }),
+    # the web interface expects the built-in tools to exist, so they can only be changed
+    "tools": Resource("tools", "name", {
+        "name": text,
+        "binary_path": text,
+        "enabled": flag,
+    }, operations=("update",)),
+    "commands": Resource("commands", "id", {
+        "id": integer,
+        "tool": text,
+        "command": text,
+        "file_command": flag,
+        "cmd_type": lambda value: "" if value == "" else text(value),
+    }, defaults={"cmd_type": defaultCmdType}),
+    "schedules": Resource("schedule", "id", {
+        "id": integer,
+        "hour": integer,
+        "minute": integer,
+        "day": optionalText,
+        "cmd_id": integer,
+        "cmd_type": text,
+    }, defaults={"id": nextScheduleId, "day": lambda connection, values: None, "cmd_type": scheduleCmdType},
+        validate=validateSchedule),
+}
+
+
+def listRecords(db_manager, name):
+    """
+    `listRecords` returns every record of a resource as a list of dictionaries
+    """
+    resource = RESOURCES[name]
+    if resource.table in db_manager.config_cache.TABLES:
+        rows = db_manager.config_cache.get(resource.table)
+    else:
+        rows = db_manager.iterate_select_query(
+            f"SELECT {', '.join(resource.columns)} FROM {resource.table};", ())
+    return [resource.toDict(row) for row in rows]
+
+
+def applyBatch(db_manager, name, payload):
+    """
+    `applyBatch` applies the `create`, `update` and `delete` lists of `payload` to a resource in one transaction.
+
+    Either every record is applied or, if one of them fails, none is and an `ApiError` naming
+    the failing record is raised. Returns the keys of the created, updated and deleted records.
+    """
+    resource = RESOURCES[name]
+    if not isinstance(payload, dict):
+        raise ApiError("request body must be a JSON object")
+    unknown = set(payload) - set(BATCH_OPERATIONS)
+    if unknown:
+        raise ApiError(f"unknown operations: {', '.join(sorted(unknown))}")
+
+    batches = {}
+    for operation in BATCH_OPERATIONS:
+        records = payload.get(operation, [])
+        if not isinstance(records, list):
+            raise ApiError(f"`{operation}` must be a list")
+        if records and operation not in resource.operations:
+            raise ApiError(f"{name} can't be {operation}d", status=405)
+        batches[operation] = records
+    if sum(len(records) for records in batches.values()) > MAX_BATCH_SIZE:
+        raise ApiError(f"a batch can hold at most {MAX_BATCH_SIZE} records", status=413)
+
+    result = {"created": [], "updated": [], "deleted": []}
+    with db_manager.transaction() as connection:
+        for operation, done in zip(BATCH_OPERATIONS, result.values()):
+            method = getattr(resource, operation)
+            for index, record in enumerate(batches[operation]):
+                try:
+                    done.append(method(connection, record))
+                except ValueError as e:
+                    raise ApiError(str(e), 400, operation, index)
+                except LookupError as e:
+                    raise ApiError(str(e), 404, operation, index)
+                except sqlite3.IntegrityError:
+                    raise ApiError("record already exists", 409, operation, index)
+    # changes of this connection don't change its `PRAGMA data_version`
+    db_manager.invalidateConfigCache(resource.table)
+
+    return result
+
+
+def acceptsGzip(accept_encoding):
+    """
+    `acceptsGzip` tells whether an `Accept-Encoding` header allows gzip, honouring `q=0`
+    """
+    qualities = {}
+    for item in accept_encoding.split(","):
+        coding, _, parameters = item.partition(";")
+        quality = 1.0
+        for parameter in parameters.split(";"):
+            name, _, value = parameter.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding.strip().lower()] = quality
+    # an explicit gzip entry overrides the `*` wildcard
+    return qualities.get("gzip", qualities.get("*", 0.0)) > 0
+
+
+def compressResponse(response, accept_encoding):
+    """
+    `compressResponse` gzips a response body if the client accepts it and it is large enough
+    """
+    if (response.direct_passthrough or response.is_streamed or not acceptsGzip(accept_encoding)
+            or "Content-Encoding" in response.headers or response.status_code < 200
+            or response.status_code in (204, 304)):
+        return response
+
+    response.vary.add("Accept-Encoding")
+    data = response.get_data()
+    if len(data) < GZIP_MIN_SIZE:
+        return response
+
+    response.set_data(gzip.compress(data, GZIP_LEVEL))
+    response.headers["Content-Encoding"] = "gzip"
+    return response
@@ -0,0 +1,221 @@
+#!/usr/bin/python3
+# This file handles the execution of tool commands as asyncio
+# subprocesses whose output is read line by line as it arrives
+
+import asyncio
+import collections
+import concurrent.futures
+import os
+import signal
+import sqlite3
+import subprocess
+import threading
+import time
+
+import executor
+
+# longest line read from a tool; longer lines are skipped
+MAX_LINE_LENGTH = 1024 * 1024
+# lines of stderr kept to explain a failed run in the logs
+STDERR_TAIL = 20
+
+
+class AsyncExecutor(executor.Executor):
+    """
+    `AsyncExecutor` runs tool commands with `asyncio.create_subprocess_exec` on one event loop thread.
+
+    Instead of one worker thread per running tool, a single event loop waits for all of them,
+    so hundreds of tools can run at the same time; `max_workers` only limits how many do.
+    stdout and stderr are read line by line while the tool runs and every line is passed to
+    the consumers:
+
+    - the run's `.log` file next to its output, like `executor.Executor` writes it
+    - per stream line counters on the job (`job.lines`), to follow the progress of a run
+    - the `ingest.Ingestor`, which stores the subdomains printed on stdout right away
+    - `line_consumers`, extra callables taking (job, stream, line) called on the event loop
+
+    The last `STDERR_TAIL` lines of stderr are written to the log when a run fails. The event
+    loop never touches the database: queries and log events run on a small thread pool of
+    `blocking_workers` threads, and stdout lines are passed in order to one ingest thread, whose
+    batches may wait for the database lock.
+    """
+
+    def __init__(self, db_manager, output_dir="target_data/output", max_workers=64, line_consumers=None,
+                 blocking_workers=4, **options):
+        super().__init__(db_manager, output_dir, max_workers, **options)
+        self.line_consumers = list(line_consumers or [])
+        # the thread pool of `Executor` is only used for blocking work here
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=blocking_workers, thread_name_prefix="tool-io")
+        # a single thread, so the lines of a run are stored in order and are all stored once it is drained
+        self._ingest_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="tool-ingest")
+
+        self._futures = set()
+        self.loop = asyncio.new_event_loop()
+        self._loop_thread = threading.Thread(target=self.loop.run_forever, name="AsyncExecutor", daemon=True)
+        self._loop_thread.start()
+        self._slots = asyncio.run_coroutine_threadsafe(self._createSlots(), self.loop).result()
+
+    async def _createSlots(self):
+        # the semaphore belongs to the loop it is created on
+        return asyncio.Semaphore(self.max_workers)
+
+    def _start(self, job):
+        job.lines = {"stdout": 0, "stderr": 0}
+        # set on the event loop by a cancel, so the run stops waiting for the tool right away
+        job.cancel_event = None
+        job.on_cancel = lambda: self.loop.call_soon_threadsafe(self._terminate, job)
+        job.future = asyncio.run_coroutine_threadsafe(self._runAsync(job), self.loop)
+        with self._lock:
+            self._futures.add(job.future)
+        job.future.add_done_callback(self._forgetFuture)
+
+    def _forgetFuture(self, future):
+        with self._lock:
+            self._futures.discard(future)
+
+    def _terminate(self, job):
+        if job.cancel_event is not None:
+            job.cancel_event.set()
+        if job.process is not None and job.process.returncode is None:
+            job.process.terminate()
+
+    async def _runAsync(self, job):
+        try:
+            async with self._slots:
+                return await self._executeAsync(job)
+        finally:
+            self._release(job.tool)
+
+    async def _executeAsync(self, job):
+        loop = asyncio.get_running_loop()
+        job.cancel_event = asyncio.Event()
+        if job.cancelled():
+            await loop.run_in_executor(self.pool, self._finish, job, "cancelled", None, 0)
+            return job
+
+        job.status = "running"
+        await loop.run_in_executor(self.pool, self.db_manager.execute_other_query,
+                                   "UPDATE runs SET status=?, started_at=CURRENT_TIMESTAMP WHERE id=?;", (job.status, job.id))
+        start = time.monotonic()
+
+        try:
+            job.process = await asyncio.create_subprocess_exec(
+                *job.argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.DEVNULL,
+                limit=MAX_LINE_LENGTH, start_new_session=True)
+        except OSError as error:
+            await loop.run_in_executor(self.pool, self.db_manager.logEvent,
+                                       [("tool_run_failed", f"Run ID `{job.id}` ({job.tool}) could not start: {error}")])
+            await loop.run_in_executor(self.pool, self._finish, job, "failed", None, time.monotonic() - start)
+            return job
+        if job.cancelled():
+            job.process.terminate()
+        if self.ingestor is not None:
+            # tools that only write `$output` files are still followed through their files
+            self._ingest_pool.submit(self._ingest, job, self.ingestor.watch, job.output, job.tool, job.finished, job.id)
+
+        stderr_tail = collections.deque(maxlen=STDERR_TAIL)
+        with open(job.output + ".log", "wb") as log_file:
+            readers = asyncio.gather(self._readLines(job, "stdout", job.process.stdout, log_file, None),
+                                     self._readLines(job, "stderr", job.process.stderr, log_file, stderr_tail))
+            status = None
+            # a cancel only sends SIGTERM, so the grace period below has to start once it arrives
+            exited = asyncio.ensure_future(job.process.wait())
+            cancelled = asyncio.ensure_future(job.cancel_event.wait())
+            done, _ = await asyncio.wait({exited, cancelled}, timeout=self.timeout,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            exited.cancel()
+            cancelled.cancel()
+            if not done:
+                status = "timeout"
+                job.process.terminate()
+            try:
+                await asyncio.wait_for(job.process.wait(), executor.TERMINATE_GRACE)
+            except asyncio.TimeoutError:
+                # children of the tool would keep its pipes open, so the whole process group is killed
+                try:
+                    os.killpg(job.process.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+                try:
+                    await asyncio.wait_for(job.process.wait(), executor.TERMINATE_GRACE)
+                except asyncio.TimeoutError:
+                    pass
+            # children of the tool may keep the pipes open, so don't wait for them forever
+            try:
+                await asyncio.wait_for(readers, executor.TERMINATE_GRACE)
+            except asyncio.TimeoutError:
+                pass
+        if self.ingestor is not None:
+            # the run is only finished once every line it printed is stored
+            await loop.run_in_executor(self._ingest_pool, lambda: None)
+
+        exit_code = job.process.returncode
+        if status is None:
+            if job.cancelled():
+                status = "cancelled"
+            else:
+                status = "success" if exit_code == 0 else "failed"
+        if status != "success" and stderr_tail:
+            await loop.run_in_executor(self.pool, self.db_manager.logEvent,
+                                       [("tool_run_failed", f"Run ID `{job.id}` ({job.tool}) {status}, last stderr lines: "
+                                         + " | ".join(stderr_tail))])
+
+        await loop.run_in_executor(self.pool, self._finish, job, status, exit_code, time.monotonic() - start)
+        return job
+
+    async def _readLines(self, job, name, stream, log_file, tail):
+        while True:
+            try:
+                raw_line = await stream.readuntil(b"\n")
+            except asyncio.IncompleteReadError as error:
+                # the last line without a newline, or nothing at the end of the stream
+                raw_line = error.partial
+            except asyncio.LimitOverrunError:
+                # the line is longer than `MAX_LINE_LENGTH` and is dropped
+                await self._skipLine(stream)
+                continue
+            if not raw_line:
+                break
+
+            log_file.write(raw_line)
+            job.lines[name] += 1
+            line = raw_line.decode(errors="replace").rstrip("\r\n")
+            if tail is not None:
+                tail.append(line)
+            if name == "stdout" and self.ingestor is not None:
+                self._ingest_pool.submit(self._ingest, job, self.ingestor.ingestLine, line, job.tool, job.id)
+            for consumer in self.line_consumers:
+                consumer(job, name, line)
+
+    async def _skipLine(self, stream):
+        # read up to and including the next newline, so the rest of a long line isn't taken for a new one
+        while True:
+            try:
+                await stream.readuntil(b"\n")
+                return
+            except asyncio.LimitOverrunError as error:
+                await stream.readexactly(error.consumed)
+            except asyncio.IncompleteReadError:
+                return
+
+    def _ingest(self, job, method, *args):
+        # runs on the ingest thread, where a failed batch must not go unnoticed in a dropped future
+        try:
+            method(*args)
+        except sqlite3.Error as error:
+            self.db_manager.logEvent([("ingest_failed", f"Output of run ID `{job.id}` ({job.tool}) not stored: {error}")])
+
+    def shutdown(self, wait=True, cancel=False):
+        """
+        `shutdown` stops accepting jobs and stops the event loop once the jobs are done
+        """
+        super().shutdown(wait, cancel)
+        if wait:
+            # runs are done, but their coroutines may still be giving back their tool slot
+            with self._lock:
+                futures = list(self._futures)
+            concurrent.futures.wait(futures)
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._loop_thread.join()
+            self.loop.close()
+        self._ingest_pool.shutdown(wait=wait)
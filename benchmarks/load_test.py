@@ -0,0 +1,90 @@
+#!/usr/bin/python3
+# This file sends concurrent requests to a running AssetGuard web
+# interface and reports requests per second and latency percentiles
+
+import argparse
+import base64
+import http.client
+import threading
+import time
+from urllib.parse import urlsplit
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(int(len(sorted_values) * fraction), len(sorted_values) - 1)]
+
+
+def worker(url, headers, deadline, latencies, errors, lock):
+    parts = urlsplit(url)
+    path = parts.path or "/"
+    if parts.query:
+        path += "?" + parts.query
+
+    connection = None
+    local_latencies = []
+    local_errors = 0
+
+    while time.monotonic() < deadline:
+        if connection is None:
+            connection = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=30)
+        start = time.perf_counter()
+        try:
+            connection.request("GET", path, headers=headers)
+            response = connection.getresponse()
+            response.read()
+            if response.status != 200:
+                local_errors += 1
+            if response.getheader("Connection", "").lower() == "close":
+                connection.close()
+                connection = None
+        except (OSError, http.client.HTTPException):
+            local_errors += 1
+            connection.close()
+            connection = None
+            continue
+        local_latencies.append(time.perf_counter() - start)
+
+    if connection is not None:
+        connection.close()
+    with lock:
+        latencies.extend(local_latencies)
+        errors.append(local_errors)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test a running AssetGuard web interface")
+    parser.add_argument("urls", nargs="+", help="URLs to request, e.g. http://127.0.0.1:8899/list_targets")
+    parser.add_argument("-c", "--concurrency", type=int, default=16, help="Concurrent connections (default 16)")
+    parser.add_argument("-d", "--duration", type=float, default=10, help="Seconds per URL (default 10)")
+    parser.add_argument("--usrnm", default="admin", help="HTTP Basic Auth username (default 'admin')")
+    parser.add_argument("--passwd", default="admin", help="HTTP Basic Auth password (default 'admin')")
+    args = parser.parse_args(argv)
+
+    token = base64.b64encode(f"{args.usrnm}:{args.passwd}".encode()).decode()
+    headers = {"Authorization": f"Basic {token}"}
+
+    for url in args.urls:
+        latencies = []
+        errors = []
+        lock = threading.Lock()
+        deadline = time.monotonic() + args.duration
+
+        threads = [threading.Thread(target=worker, args=(url, headers, deadline, latencies, errors, lock))
+                   for _ in range(args.concurrency)]
+        start = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - start
+
+        latencies.sort()
+        print(f"{url}: {len(latencies) / elapsed:.1f} req/s, {sum(errors)} errors, "
+              f"p50 {percentile(latencies, 0.5) * 1000:.1f} ms, p95 {percentile(latencies, 0.95) * 1000:.1f} ms, "
+              f"p99 {percentile(latencies, 0.99) * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/python3
+# This file compares query plans and timings of the dashboard queries
+# before and after the schema migrations are applied
+
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import DbManager
+
+QUERIES = [
+    ("domain lookup", "SELECT enabled FROM domains WHERE domain=?;", ("d5000.example.com",)),
+    ("tool lookup", "SELECT * FROM tools WHERE name=?;", ("amass",)),
+    ("commands by type", "SELECT * FROM commands WHERE cmd_type=?;", ("subdomain_enum",)),
+    ("latest logs", "SELECT * FROM logs ORDER BY timestamp DESC LIMIT 50;", ()),
+    ("due schedule", "SELECT * FROM schedule WHERE hour=? AND minute=?;", (3, 30)),
+]
+
+
+# the schema of versions without migrations, as their createNewDB made it
+LEGACY_SCHEMA = [
+    'CREATE TABLE "domains" ("domain" TEXT NOT NULL, "program_url" TEXT NOT NULL, "enabled" INTEGER NOT NULL);',
+    'CREATE TABLE "tools" ("name" TEXT NOT NULL, "binary_path" TEXT NOT NULL, "enabled" INTEGER NOT NULL);',
+    """CREATE TABLE "commands" ("id" INTEGER NOT NULL, "tool" TEXT NOT NULL, "command" TEXT NOT NULL,
+                                "file_command" INTEGER NOT NULL, "cmd_type" TEXT NOT NULL, PRIMARY KEY("id" AUTOINCREMENT));""",
+    """CREATE TABLE "logs" ("event_name" TEXT NOT NULL, "event_details" TEXT NOT NULL,
+                            "timestamp" timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP);""",
+    """CREATE TABLE "schedule" ("id" INTEGER NOT NULL UNIQUE, "hour" INTEGER NOT NULL, "minute" INTEGER NOT NULL,
+                                "day" TEXT, "cmd_id" INTEGER NOT NULL, "cmd_type" TEXT NOT NULL);""",
+]
+
+
+def createLegacyDB(db_location, domains, logs):
+    """
+    `createLegacyDB` creates a database the way versions without migrations did, filled with synthetic rows
+    """
+    connection = sqlite3.connect(db_location)
+    with connection:
+        for statement in LEGACY_SCHEMA:
+            connection.execute(statement)
+        connection.executemany("INSERT INTO tools (name, binary_path, enabled) VALUES (?, ?, 0);",
+                               (("amass", "amass"), ("subfinder", "subfinder")))
+        connection.executemany("INSERT INTO commands (id, tool, command, file_command, cmd_type) VALUES (?, ?, ?, 1, ?);",
+                               ((1, "amass", "amass enum -df $domain_file -o $output", "subdomain_enum"),
+                                (2, "subfinder", "subfinder -dL $domain_file -all -o $output.txt", "subdomain_enum")))
+
+        connection.executemany("INSERT INTO domains (domain, program_url, enabled) VALUES (?, ?, ?);",
+                               ((f"d{i}.example.com", "https://example.com/program", i % 2) for i in range(domains)))
+        connection.executemany("INSERT INTO logs (event_name, event_details, timestamp) VALUES (?, ?, datetime('now', ?));",
+                               (("domain_added", f"d{i}.example.com added", f"-{i} seconds") for i in range(logs)))
+        connection.executemany("INSERT INTO schedule (id, hour, minute, day, cmd_id, cmd_type) VALUES (?, ?, ?, ?, ?, ?);",
+                               ((i, i % 24, i % 60, "everyday", 1, "subdomain_enum") for i in range(1, 2001)))
+    connection.close()
+    return DbManager.Manager(db_location)
+
+
+def measure(manager, repeat):
+    results = {}
+    for name, query, params in QUERIES:
+        plan = " | ".join(row[3] for row in manager.execute_select_query("EXPLAIN QUERY PLAN " + query, params))
+        start = time.perf_counter()
+        for _ in range(repeat):
+            manager.execute_select_query(query, params)
+        results[name] = (plan, (time.perf_counter() - start) / repeat * 1000)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Show the effect of the schema migrations on query plans")
+    parser.add_argument("--domains", type=int, default=100000, help="Number of synthetic domains")
+    parser.add_argument("--logs", type=int, default=100000, help="Number of synthetic log entries")
+    parser.add_argument("--repeat", type=int, default=20, help="Times each query is run")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as directory:
+        manager = createLegacyDB(os.path.join(directory, "bench.sqlite"), args.domains, args.logs)
+
+        before = measure(manager, args.repeat)
+        start = time.perf_counter()
+        manager.migrate()
+        migrate_time = time.perf_counter() - start
+        after = measure(manager, args.repeat)
+        manager.close()
+
+    print(f"migration to version {DbManager.MIGRATIONS[-1][0]} took {migrate_time:.2f}s")
+    for name, _, _ in QUERIES:
+        print(f"\n{name}")
+        print(f"  before: {before[name][1]:8.3f} ms  {before[name][0]}")
+        print(f"  after:  {after[name][1]:8.3f} ms  {after[name][0]}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+#!/usr/bin/python3
+# This file times matching host names from tool output against the target
+# domains with the scope trie and the lookups it replaced
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import DbManager
+import scope
+
+TLDS = ("com", "net", "org", "io", "co.uk")
+WORDS = ("api", "dev", "staging", "mail", "vpn", "cdn", "auth", "static", "internal", "admin")
+
+
+def generateNames(domains, count, miss_ratio, seed=1):
+    """
+    `generateNames` returns `count` host names as tools print them, `miss_ratio` of them out of scope
+    """
+    rng = random.Random(seed)
+    names = []
+    for _ in range(count):
+        if rng.random() < miss_ratio:
+            base = f"other{rng.randrange(1000000)}.{rng.choice(TLDS)}"
+        else:
+            base = rng.choice(domains)
+        labels = [rng.choice(WORDS) for _ in range(rng.randrange(0, 4))]
+        names.append(".".join(labels + [base]))
+    return names
+
+
+def suffixSetMatch(domains):
+    # the earlier lookup: join every suffix of the name and look it up in a set
+    domain_set = set(domains)
+
+    def match(name):
+        labels = name.split(".")
+        for index in range(len(labels) - 2, -1, -1):
+            suffix = ".".join(labels[index:])
+            if suffix in domain_set:
+                return suffix
+        return None
+    return match
+
+
+def scanMatch(domains):
+    # checking every target domain, as a naive classifier would
+    def match(name):
+        for domain in domains:
+            if name == domain or name.endswith("." + domain):
+                return domain
+        return None
+    return match
+
+
+def timeMatcher(match, names):
+    start = time.perf_counter()
+    found = sum(1 for name in names if match(name) is not None)
+    return time.perf_counter() - start, found
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark matching host names against the target domains")
+    parser.add_argument("--domains", type=int, default=10000, help="Number of target domains (default 10000)")
+    parser.add_argument("--lines", type=int, default=1000000, help="Number of host names to match (default 1000000)")
+    parser.add_argument("--miss-ratio", type=float, default=0.3, help="Share of names out of scope (default 0.3)")
+    parser.add_argument("--scan-lines", type=int, default=2000,
+                        help="Names matched by the naive scan, which is far slower (default 2000, 0 skips it)")
+    args = parser.parse_args(argv)
+
+    domains = [f"target{i}.{TLDS[i % len(TLDS)]}" for i in range(args.domains)]
+    names = generateNames(domains, args.lines, args.miss_ratio)
+
+    with tempfile.TemporaryDirectory() as temporary_dir:
+        db_location = os.path.join(temporary_dir, "assetguard.sqlite")
+        DbManager.Manager.createNewDB(db_location)
+        manager = DbManager.Manager(db_location)
+        manager.execute_multi_query("INSERT INTO domains (domain, program_url, enabled) VALUES (?, ?, 1);",
+                                    ((domain, f"https://{domain}/program") for domain in domains))
+
+        matcher = scope.ScopeMatcher(manager)
+        start = time.perf_counter()
+        matcher.load()
+        print(f"trie of {len(matcher)} domains loaded in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+        manager.execute_other_query("UPDATE domains SET enabled=0 WHERE domain=?;", (domains[0],))
+        start = time.perf_counter()
+        matcher.refresh()
+        print(f"incremental refresh after one changed domain in {(time.perf_counter() - start) * 1000:.3f} ms")
+        manager.close()
+
+    results = [("ScopeMatcher.match", matcher.match, names),
+               ("suffix set lookup", suffixSetMatch(domains), names)]
+    if args.scan_lines:
+        results.append(("scan of every domain", scanMatch(domains), names[:args.scan_lines]))
+
+    for label, match, sample in results:
+        elapsed, found = timeMatcher(match, sample)
+        print(f"{label:<22} {len(sample):>9} names {elapsed:8.3f} s  {found / len(sample) * 100:5.1f}% in scope  "
+              f"{len(sample) / elapsed * 60 / 1e6:8.2f} M lines/min")
+
+
+if __name__ == "__main__":
+    main()
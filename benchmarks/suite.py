@@ -0,0 +1,256 @@
+#!/usr/bin/python3
+# This file times the database operations and the web interface routes
+# on synthetic databases of several sizes and writes the results as JSON
+
+import argparse
+import base64
+import datetime
+import itertools
+import json
+import os
+import platform
+import resource
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import DbManager
+
+DEFAULT_SIZES = (1000, 100000, 1000000)
+EVENT_NAMES = ("domain_added", "scheduled_run", "tool_run_finished", "new_asset_found")
+
+ROUTES = [
+    ("GET", "/"),
+    ("GET", "/add_targets"),
+    ("GET", "/list_targets"),
+    ("GET", "/tools"),
+    ("GET", "/cmds"),
+    ("GET", "/scheudle"),
+    ("GET", "/logs"),
+    ("GET", "/logs?event_name=scheduled_run"),
+    ("GET", "/logs.json"),
+    ("GET", "/changes"),
+    ("GET", "/api/v1/targets"),
+    ("GET", "/api/v1/commands"),
+    ("GET", "/api/v1/logs"),
+    ("GET", "/enable?type=domain&domain=d1.example.com"),
+]
+
+
+def generateDB(db_location, size):
+    """
+    `generateDB` creates a database with `size` target domains and `size` log entries
+    """
+    DbManager.Manager.createNewDB(db_location)
+
+    manager = DbManager.Manager(db_location)
+    with manager.transaction() as connection:
+        connection.executemany("INSERT INTO domains (domain, program_url, enabled) VALUES (?, ?, ?);",
+                               ((f"d{i}.example.com", "https://example.com/program", i % 2) for i in range(size)))
+        # one entry every few seconds, ending now
+        start = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=size * 3)
+        connection.executemany("INSERT INTO logs (event_name, event_details, timestamp) VALUES (?, ?, ?);",
+                               ((EVENT_NAMES[i % len(EVENT_NAMES)], f"d{i}.example.com event {i}",
+                                 (start + datetime.timedelta(seconds=i * 3)).strftime("%Y-%m-%d %H:%M:%S"))
+                                for i in range(size)))
+        connection.executemany("INSERT INTO schedule (id, hour, minute, day, cmd_id, cmd_type) VALUES (?, ?, ?, ?, ?, ?);",
+                               ((i, i % 24, i % 60, "monday", 1 + i % 2, "subdomain_enum") for i in range(1, 101)))
+    manager.execute_select_query("ANALYZE;", ())
+    manager.close()
+
+
+def openDB(cache_dir, size):
+    """
+    `openDB` returns a fresh copy of the generated database of `size` rows, generating it on first use
+    """
+    template = os.path.join(cache_dir, f"assetguard-{size}.sqlite")
+    if not os.path.exists(template):
+        generateDB(template + ".tmp", size)
+        os.replace(template + ".tmp", template)
+
+    copy = os.path.join(cache_dir, f"run-{size}.sqlite")
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(copy + suffix):
+            os.remove(copy + suffix)
+    # the backup API copies a consistent image even with a WAL file next to the template
+    source = sqlite3.connect(template)
+    target = sqlite3.connect(copy)
+    source.backup(target)
+    source.close()
+    target.close()
+    return copy
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(int(len(sorted_values) * fraction), len(sorted_values) - 1)]
+
+
+def measure(operation, repeat, max_seconds):
+    """
+    `measure` calls `operation` `repeat` times or until `max_seconds` have passed and returns the statistics.
+
+    Peak memory is measured with `tracemalloc` on one extra call, so the timed calls are not slowed down.
+    """
+    operation()
+
+    latencies = []
+    deadline = time.perf_counter() + max_seconds
+    start = time.perf_counter()
+    for _ in range(repeat):
+        call_start = time.perf_counter()
+        operation()
+        latencies.append(time.perf_counter() - call_start)
+        if call_start > deadline:
+            break
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    operation()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    latencies.sort()
+    return {
+        "iterations": len(latencies),
+        "mean_ms": sum(latencies) / len(latencies) * 1000,
+        "p50_ms": percentile(latencies, 0.5) * 1000,
+        "p90_ms": percentile(latencies, 0.9) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "max_ms": latencies[-1] * 1000,
+        "ops_per_second": len(latencies) / elapsed if elapsed else 0.0,
+        "peak_alloc_kib": peak / 1024,
+    }
+
+
+def managerOperations(manager, size):
+    counter = itertools.count()
+
+    def addTargetDomain():
+        manager.addTargetDomain(f"bench{next(counter)}.example.org", "https://example.org/program", 1)
+
+    def toggleDomain():
+        manager.execute_other_query("UPDATE domains SET enabled = 1 - enabled WHERE domain=?;", (f"d{size // 2}.example.com",))
+
+    return [
+        ("logEvent", lambda: manager.logEvent([("benchmark", "a benchmark event")])),
+        ("addTargetDomain", addTargetDomain),
+        ("select domain", lambda: manager.execute_select_query(
+            "SELECT enabled FROM domains WHERE domain=?;", (f"d{size // 2}.example.com",))),
+        ("update domain", toggleDomain),
+        ("selectLogsPage", lambda: manager.selectLogsPage(50)),
+        ("selectLogsPage by event", lambda: manager.selectLogsPage(50, event_name="scheduled_run")),
+        ("selectLogRollups", lambda: manager.selectLogRollups()),
+        ("config_cache commands", lambda: manager.config_cache.get("commands")),
+        ("selectScheduleWithCommands", lambda: list(manager.selectScheduleWithCommands())),
+        ("iterate all domains", lambda: sum(1 for _ in manager.iterate_select_query("SELECT * FROM domains;", ()))),
+    ]
+
+
+def benchmarkManager(db_location, size, repeat, max_seconds):
+    manager = DbManager.Manager(db_location)
+    results = []
+    for name, operation in managerOperations(manager, size):
+        results.append(dict(group="manager", name=name, size=size, **measure(operation, repeat, max_seconds)))
+
+    # the web interface queues events for a background writer instead
+    manager.startLogWriter()
+    results.append(dict(group="manager", name="logEvent (queued)", size=size,
+                        **measure(lambda: manager.logEvent([("benchmark", "a benchmark event")]), repeat, max_seconds)))
+    manager.close()
+    return results
+
+
+def benchmarkRoutes(db_location, size, repeat, max_seconds):
+    import main
+    import webapp
+
+    server = webapp.Server(db_location, main.buildParser().parse_args(["serve"]))
+    client = server.app.test_client()
+    headers = {"Authorization": "Basic " + base64.b64encode(b"admin:admin").decode()}
+
+    def request(method, path):
+        def call():
+            response = client.open(path, method=method, headers=headers)
+            # streamed pages are rendered while the body is read
+            response.get_data()
+            if response.status_code >= 400:
+                raise RuntimeError(f"{method} {path} returned {response.status_code}")
+        return call
+
+    results = []
+    for method, path in ROUTES:
+        results.append(dict(group="route", name=f"{method} {path}", size=size,
+                            **measure(request(method, path), repeat, max_seconds)))
+    server.db_manager.close()
+    return results
+
+
+def compare(results, baseline_file):
+    """
+    `compare` prints the change of the median latency of every benchmark against an earlier result file
+    """
+    with open(baseline_file) as baseline:
+        previous = {(row["group"], row["name"], row["size"]): row for row in json.load(baseline)["results"]}
+
+    for row in results:
+        old = previous.get((row["group"], row["name"], row["size"]))
+        if old is None or not old["p50_ms"]:
+            continue
+        change = (row["p50_ms"] - old["p50_ms"]) / old["p50_ms"] * 100
+        print(f"{row['size']:>8} {row['group']:<8} {row['name']:<45} p50 {old['p50_ms']:9.3f} -> {row['p50_ms']:9.3f} ms ({change:+.1f}%)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark database operations and web routes on synthetic databases")
+    parser.add_argument("--sizes", type=lambda value: [int(size) for size in value.split(",")], default=list(DEFAULT_SIZES),
+                        help="Comma separated numbers of domains and log entries (default 1000,100000,1000000)")
+    parser.add_argument("--repeat", type=int, default=200, help="Calls per benchmark (default 200)")
+    parser.add_argument("--max-seconds", type=float, default=5, help="Stop a benchmark after this many seconds (default 5)")
+    parser.add_argument("--cache-dir", help="Keep generated databases here to reuse them in later runs")
+    parser.add_argument("--skip-routes", action="store_true", default=False, help="Only benchmark database operations")
+    parser.add_argument("-o", "--output", default="benchmark_results.json", help="Result file (default benchmark_results.json)")
+    parser.add_argument("--compare", help="Earlier result file to compare the median latencies with")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as temporary_dir:
+        cache_dir = args.cache_dir or temporary_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+        results = []
+        for size in args.sizes:
+            start = time.perf_counter()
+            db_location = openDB(cache_dir, size)
+            print(f"{size} rows: database ready in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+
+            results.extend(benchmarkManager(db_location, size, args.repeat, args.max_seconds))
+            if not args.skip_routes:
+                # routes run on their own copy, unchanged by the writes above
+                results.extend(benchmarkRoutes(openDB(cache_dir, size), size, args.repeat, args.max_seconds))
+
+    report = {
+        "created_at": datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "peak_rss_kib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "results": results,
+    }
+    with open(args.output, "w") as output_file:
+        json.dump(report, output_file, indent=2)
+
+    for row in results:
+        print(f"{row['size']:>8} {row['group']:<8} {row['name']:<45} p50 {row['p50_ms']:9.3f} ms  "
+              f"p99 {row['p99_ms']:9.3f} ms  {row['ops_per_second']:9.1f} ops/s  {row['peak_alloc_kib']:9.1f} KiB")
+    if args.compare:
+        print()
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
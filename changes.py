@@ -0,0 +1,114 @@
+#!/usr/bin/python3
+# This file handles finding the subdomains that appeared or
+# disappeared between two enumeration runs of a target
+
+import freshness
+
+NEW = "new"
+GONE = "gone"
+
+
+class ChangeDetector:
+    """
+    `ChangeDetector` compares the subdomains seen by a run with the previous run of the same command.
+
+    Every run records the target domains it covered (`run_domains`) and the subdomains it saw
+    (`sightings`). For each domain of a finished run the previous successful run of the same
+    command over that domain is looked up, and the two sets of sightings are compared with
+    indexed `NOT EXISTS` queries, so the cost depends on the size of the two runs only and not
+    on the whole history. Domains whose scan saw the same subdomains as the run before, as
+    recorded in `domain_scans` by `freshness.recordDigests`, have no changes and are not compared. Differences are stored in
+    the `changes` table.
+    """
+
+    def __init__(self, db_manager):
+        self.db_manager = db_manager
+
+    def previousRun(self, run_id, domain):
+        """
+        `previousRun` returns the id of the last successful run of the same command over `domain` before `run_id`
+        """
+        rows = self.db_manager.execute_select_query(
+            """SELECT runs.id FROM run_domains
+               JOIN runs ON runs.id = run_domains.run_id
+               WHERE run_domains.domain = ? AND run_domains.run_id < ? AND runs.status = 'success'
+                 AND runs.cmd_id = (SELECT cmd_id FROM runs WHERE id = ?)
+               ORDER BY run_domains.run_id DESC LIMIT 1;""", (domain, run_id, run_id))
+        return rows[0][0] if rows else None
+
+    def diff(self, run_id, previous_run_id, domain):
+        """
+        `diff` returns the subdomains of `domain` only seen by `run_id` and the ones only seen by `previous_run_id`
+        """
+        query = """SELECT subdomains.name FROM sightings AS current
+                   JOIN subdomains ON subdomains.id = current.subdomain_id
+                   WHERE current.run_id = ? AND subdomains.domain = ?
+                     AND NOT EXISTS (SELECT 1 FROM sightings AS other
+                                     WHERE other.run_id = ? AND other.subdomain_id = current.subdomain_id)
+                   ORDER BY subdomains.name;"""
+        new = [row[0] for row in self.db_manager.execute_select_query(query, (run_id, domain, previous_run_id))]
+        gone = [row[0] for row in self.db_manager.execute_select_query(query, (previous_run_id, domain, run_id))]
+        return new, gone
+
+    def detect(self, run_id):
+        """
+        `detect` stores the changes found by a finished run and logs the new assets. Returns (new, gone) counts
+        """
+        status = self.db_manager.execute_select_query("SELECT status FROM runs WHERE id=?;", (run_id,))
+        if not status or status[0][0] != "success":
+            return 0, 0
+
+        freshness.recordDigests(self.db_manager, run_id)
+        domains = [row[0] for row in self.db_manager.execute_select_query(
+            """SELECT run_domains.domain FROM run_domains
+               WHERE run_domains.run_id = ? AND NOT EXISTS (
+                   SELECT 1 FROM domain_scans
+                   WHERE domain_scans.domain = run_domains.domain AND domain_scans.run_id = run_domains.run_id
+                     AND domain_scans.unchanged = 1);""", (run_id,))]
+
+        rows = []
+        for domain in domains:
+            previous_run_id = self.previousRun(run_id, domain)
+            # the first run over a domain is the baseline
+            if previous_run_id is None:
+                continue
+            new, gone = self.diff(run_id, previous_run_id, domain)
+            rows.extend((run_id, domain, name, NEW) for name in new)
+            rows.extend((run_id, domain, name, GONE) for name in gone)
+
+        if rows:
+            self.db_manager.execute_multi_query(
+                "INSERT INTO changes (run_id, domain, name, change) VALUES (?, ?, ?, ?);", rows)
+            self.db_manager.logEvent([("new_asset_found", f"{row[2]} found for {row[1]} by run ID `{run_id}`")
+                                      for row in rows if row[3] == NEW])
+
+        new_count = sum(1 for row in rows if row[3] == NEW)
+        return new_count, len(rows) - new_count
+
+    def listChanges(self, limit=50, before_id=None, domain=None, change=None):
+        """
+        `listChanges` returns one page of detected changes, newest first, and the id to continue from
+        """
+        conditions = []
+        params = []
+        if before_id is not None:
+            conditions.append("id < ?")
+            params.append(before_id)
+        if domain:
+            conditions.append("domain = ?")
+            params.append(domain)
+        if change:
+            conditions.append("change = ?")
+            params.append(change)
+
+        query = "SELECT id, run_id, domain, name, change, detected_at FROM changes"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY id DESC LIMIT ?;"
+        params.append(limit + 1)
+
+        rows = self.db_manager.execute_select_query(query, params)
+        if len(rows) > limit:
+            rows = rows[:limit]
+            return rows, rows[-1][0]
+        return rows, None
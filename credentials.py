@@ -0,0 +1,139 @@
+#!/usr/bin/python3
+# This file handles verification of the HTTP Basic Auth
+# credentials of the web interface
+
+import hashlib
+import hmac
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+
+class VerificationCache:
+    """
+    `VerificationCache` remembers recently verified credentials so they don't go through the password hash again.
+
+    Entries are keyed by the username and an HMAC of the password under a random per-process
+    key, so the cache never holds the password or a digest that could be checked offline.
+    At most `max_size` entries are kept (least recently used are dropped) for `ttl` seconds.
+    """
+
+    def __init__(self, max_size=256, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+        self._key = os.urandom(32)
+        self._lock = threading.Lock()
+
+    def key(self, username, password):
+        return (username, hmac.new(self._key, password.encode(), hashlib.sha256).digest())
+
+    def contains(self, key):
+        now = time.monotonic()
+        with self._lock:
+            expires = self.entries.get(key)
+            if expires is None or expires < now:
+                if expires is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return False
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return True
+
+    def add(self, key):
+        with self._lock:
+            self.entries[key] = time.monotonic() + self.ttl
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+
+
+class RateLimiter:
+    """
+    `RateLimiter` is an in-memory token bucket per client address.
+
+    Each address may make `burst` attempts at once and regains `rate` attempts per second.
+    Buckets of at most `max_clients` addresses are kept; the least recently seen are dropped.
+    """
+
+    def __init__(self, rate=1.0, burst=10, max_clients=10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self.buckets = OrderedDict()
+        self.limited = 0
+
+        self._lock = threading.Lock()
+
+    def allow(self, address):
+        """
+        `allow` takes one token from the bucket of `address`. Returns False if it is empty
+        """
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self.buckets.pop(address, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            else:
+                self.limited += 1
+
+            self.buckets[address] = (tokens, now)
+            while len(self.buckets) > self.max_clients:
+                self.buckets.popitem(last=False)
+            return allowed
+
+
+class CredentialStore:
+    """
+    `CredentialStore` checks a username and password against a stored password hash.
+
+    Credentials found in the `VerificationCache` are accepted without hashing. Every other
+    attempt costs a token from the client's `RateLimiter` bucket and a full password hash check.
+    """
+
+    def __init__(self, username, password_hash, cache=None, rate_limiter=None):
+        self.username = username
+        self.password_hash = password_hash
+        self.cache = cache or VerificationCache()
+        self.rate_limiter = rate_limiter or RateLimiter()
+
+    @classmethod
+    def fromPassword(cls, username, password, **options):
+        """
+        `fromPassword` creates a store for a plaintext password, which is hashed right away
+        """
+        return cls(username, generate_password_hash(password), **options)
+
+    def verify(self, username, password, address):
+        """
+        `verify` returns True for valid credentials, False for invalid ones and None if `address` is rate limited
+        """
+        key = self.cache.key(username, password)
+        if self.cache.contains(key):
+            return True
+
+        if not self.rate_limiter.allow(address):
+            return None
+
+        # both checks always run, so the response time doesn't tell which one failed
+        username_matches = hmac.compare_digest(username.encode(), self.username.encode())
+        password_matches = check_password_hash(self.password_hash, password)
+
+        if username_matches and password_matches:
+            self.cache.add(key)
+            return True
+        return False
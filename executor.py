@@ -0,0 +1,372 @@
+#!/usr/bin/python3
+# This file handles the execution of tool commands
+# in a bounded pool of worker threads
+
+import os
+import shlex
+import sqlite3
+import string
+import subprocess
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import freshness
+import metrics
+import sharding
+
+# seconds a cancelled or timed out tool gets to exit before it is killed
+TERMINATE_GRACE = 5
+# seconds between checks for a cancel while a tool runs
+CANCEL_POLL_INTERVAL = 0.5
+
+
+class Job:
+    """
+    `Job` is a single invocation of a tool command
+    """
+
+    def __init__(self, cmd_id, tool, argv, output, domain_file=None, domains=None, shard=None):
+        self.id = None
+        self.cmd_id = cmd_id
+        self.tool = tool
+        self.argv = argv
+        self.output = output
+        self.domain_file = domain_file
+        self.domains = domains or []
+        self.shard = shard
+        self.group = None
+        self.finished = threading.Event()
+
+        self.status = "queued"
+        self.exit_code = None
+        self.duration = None
+        self.process = None
+        self.future = None
+        # called instead of terminating `process` directly, for executors that own the process elsewhere
+        self.on_cancel = None
+
+        self._cancelled = threading.Event()
+        self._lock = threading.Lock()
+
+    def cancel(self):
+        """
+        `cancel` stops the job. A job that has not started yet will not start
+        """
+        self._cancelled.set()
+        with self._lock:
+            if self.on_cancel is not None:
+                self.on_cancel()
+            elif self.process is not None and self.process.poll() is None:
+                self.process.terminate()
+
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def done(self):
+        return self.status not in ("queued", "running")
+
+
+def expandCommand(command, binary_path, domain="", domain_file="", output=""):
+    """
+    `expandCommand` replaces the `$exec`, `$domain`, `$domain_file` and `$output` phrases and splits the command into arguments
+    """
+    expanded = string.Template(command).safe_substitute(
+        exec=shlex.quote(binary_path),
+        domain=shlex.quote(domain),
+        domain_file=shlex.quote(domain_file),
+        output=shlex.quote(output),
+    )
+    return shlex.split(expanded)
+
+
+def writeDomainFile(path, domains):
+    """
+    `writeDomainFile` writes one domain per line to `path`
+    """
+    with open(path, "w") as domain_file:
+        for domain in domains:
+            domain_file.write(domain + "\n")
+    return path
+
+
+def jobOutput(run_directory, name, tool):
+    """
+    `jobOutput` returns the output name of one job, in a directory of its own, so no other job's files start with it
+    """
+    job_directory = os.path.join(run_directory, name)
+    os.makedirs(job_directory, exist_ok=True)
+    return os.path.join(job_directory, tool)
+
+
+class Executor:
+    """
+    `Executor` runs tool commands as subprocesses in a bounded worker pool.
+
+    At most `max_workers` tools run at the same time, and at most `tool_limits[tool]`
+    (or `default_tool_limit`) of them for the same tool. Each run is recorded in the
+    `runs` table with its exit status and duration.
+
+    With `shards` above 1, file commands are split into that many jobs, each with its own
+    domain file, and the outputs are merged when all of them are done. `shard_by` chooses
+    between shards of equal domain count and shards of equal estimated cost.
+
+    When an `ingest.Ingestor` is given, the output files of each job are followed while the
+    tool writes them and the subdomains found are stored as they appear.
+
+    Every successful run records the domains it scanned in `domain_scans`. With a
+    `freshness.FreshnessPolicy`, domains a command scanned recently are left out of its new runs.
+    """
+
+    def __init__(self, db_manager, output_dir="target_data/output", max_workers=4,
+                 default_tool_limit=2, tool_limits=None, timeout=6 * 60 * 60, shards=1, shard_by="count",
+                 ingestor=None, freshness=None):
+        self.db_manager = db_manager
+        self.output_dir = output_dir
+        self.max_workers = max_workers
+        self.default_tool_limit = default_tool_limit
+        self.tool_limits = tool_limits or {}
+        self.timeout = timeout
+        self.shards = shards
+        self.shard_by = shard_by
+        self.ingestor = ingestor
+        self.freshness = freshness
+
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tool")
+        self.jobs = {}
+
+        # jobs of a tool wait here while the tool is at its limit, so they don't hold a worker thread
+        self._pending = {}
+        self._running = {}
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+
+    def newRunDirectory(self, cmd_id):
+        """
+        `newRunDirectory` creates a unique directory for the files of one command run
+        """
+        os.makedirs(self.output_dir, exist_ok=True)
+        return tempfile.mkdtemp(prefix=f"{time.strftime('%Y%m%d-%H%M%S')}-cmd{cmd_id}-", dir=self.output_dir)
+
+    def enabledDomains(self):
+        return [row[0] for row in self.db_manager.execute_select_query(
+            "SELECT domain FROM domains WHERE enabled>0 ORDER BY domain;", ())]
+
+    def buildJobs(self, cmd_id):
+        """
+        `buildJobs` creates the jobs for a command: one job for a file command, otherwise one per enabled domain
+        """
+        rows = self.db_manager.execute_select_query(
+            """SELECT commands.tool, commands.command, commands.file_command, tools.binary_path
+               FROM commands JOIN tools ON tools.name = commands.tool
+               WHERE commands.id=? AND tools.enabled>0;""", (cmd_id,))
+        if len(rows) == 0:
+            return []
+        tool, command, file_command, binary_path = rows[0]
+
+        domains = self.enabledDomains()
+        if self.freshness is not None:
+            domains = self.freshness.apply(cmd_id, tool, domains, file_command=file_command > 0)
+        if len(domains) == 0:
+            return []
+
+        run_directory = self.newRunDirectory(cmd_id)
+
+        if file_command > 0 and self.shards > 1 and len(domains) > 1:
+            return self.buildShardJobs(cmd_id, tool, command, binary_path, domains, run_directory)
+
+        if file_command > 0:
+            domain_file = writeDomainFile(os.path.join(run_directory, "domains.txt"), domains)
+            output = jobOutput(run_directory, tool, tool)
+            return [Job(cmd_id, tool, expandCommand(command, binary_path, domain_file=domain_file, output=output),
+                        output, domain_file, domains)]
+
+        jobs = []
+        for domain in domains:
+            output = jobOutput(run_directory, f"{tool}_{domain}", tool)
+            jobs.append(Job(cmd_id, tool, expandCommand(command, binary_path, domain=domain, output=output),
+                            output, domains=[domain]))
+        return jobs
+
+    def buildShardJobs(self, cmd_id, tool, command, binary_path, domains, run_directory):
+        """
+        `buildShardJobs` creates one job per shard of `domains` for a file command
+        """
+        if self.shard_by == "cost":
+            shards = sharding.splitByCost(domains, self.shards, sharding.loadCosts(self.db_manager, cmd_id))
+        else:
+            shards = sharding.splitByCount(domains, self.shards)
+
+        group = sharding.ShardGroup(cmd_id, os.path.join(run_directory, tool))
+        for index, shard_domains in enumerate(shards):
+            domain_file = writeDomainFile(os.path.join(run_directory, f"domains_shard{index}.txt"), shard_domains)
+            output = jobOutput(run_directory, f"{tool}_shard{index}", tool)
+            group.add(Job(cmd_id, tool, expandCommand(command, binary_path, domain_file=domain_file, output=output),
+                          output, domain_file, shard_domains, index))
+        return group.jobs
+
+    def submitCommand(self, cmd_id):
+        """
+        `submitCommand` queues all jobs of a command and returns them
+        """
+        jobs = self.buildJobs(cmd_id)
+        for job in jobs:
+            self.submit(job)
+        return jobs
+
+    def submit(self, job):
+        """
+        `submit` queues a job on the worker pool
+        """
+        with self.db_manager.transaction() as connection:
+            job.id = connection.execute(
+                "INSERT INTO runs (cmd_id, tool, command, output, status, shard) VALUES (?, ?, ?, ?, ?, ?);",
+                (job.cmd_id, job.tool, shlex.join(job.argv), job.output, job.status, job.shard)
+            ).lastrowid
+            # the domains covered by the run, used to compare it with the previous run
+            connection.executemany("INSERT OR IGNORE INTO run_domains (run_id, domain) VALUES (?, ?);",
+                                   [(job.id, domain) for domain in job.domains])
+        with self._lock:
+            self.jobs[job.id] = job
+            if self._running.get(job.tool, 0) >= self.tool_limits.get(job.tool, self.default_tool_limit):
+                self._pending.setdefault(job.tool, deque()).append(job)
+                return job
+            self._running[job.tool] = self._running.get(job.tool, 0) + 1
+        self._start(job)
+        return job
+
+    def _start(self, job):
+        job.future = self.pool.submit(self._run, job)
+
+    def _release(self, tool):
+        # start the next waiting job of the tool, or give its slot back
+        with self._lock:
+            pending = self._pending.get(tool)
+            if pending:
+                job = pending.popleft()
+            else:
+                self._running[tool] -= 1
+                return
+        self._start(job)
+
+    def _run(self, job):
+        try:
+            return self._execute(job)
+        finally:
+            self._release(job.tool)
+
+    def _execute(self, job):
+        if job.cancelled():
+            self._finish(job, "cancelled", None, 0)
+            return job
+
+        job.status = "running"
+        self.db_manager.execute_other_query("UPDATE runs SET status=?, started_at=CURRENT_TIMESTAMP WHERE id=?;",
+                                            (job.status, job.id))
+        start = time.monotonic()
+
+        try:
+            with open(job.output + ".log", "wb") as log_file, job._lock:
+                job.process = subprocess.Popen(job.argv, stdout=log_file, stderr=subprocess.STDOUT,
+                                               stdin=subprocess.DEVNULL)
+                if job.cancelled():
+                    job.process.terminate()
+            if self.ingestor is not None:
+                self.ingestor.watch(job.output, job.tool, job.finished, job.id)
+        except OSError as error:
+            self.db_manager.logEvent([("tool_run_failed", f"Run ID `{job.id}` ({job.tool}) could not start: {error}")])
+            self._finish(job, "failed", None, time.monotonic() - start)
+            return job
+
+        status = None
+        deadline = start + self.timeout
+        # a cancel only sends SIGTERM, so the grace period below has to start once it arrives
+        while not job.cancelled():
+            try:
+                job.process.wait(timeout=min(CANCEL_POLL_INTERVAL, max(deadline - time.monotonic(), 0)))
+                break
+            except subprocess.TimeoutExpired:
+                if time.monotonic() >= deadline:
+                    status = "timeout"
+                    job.process.terminate()
+                    break
+        try:
+            job.process.wait(timeout=TERMINATE_GRACE)
+        except subprocess.TimeoutExpired:
+            job.process.kill()
+            job.process.wait()
+
+        exit_code = job.process.returncode
+        if status is None:
+            if job.cancelled():
+                status = "cancelled"
+            else:
+                status = "success" if exit_code == 0 else "failed"
+
+        self._finish(job, status, exit_code, time.monotonic() - start)
+        return job
+
+    def _finish(self, job, status, exit_code, duration):
+        job.status = status
+        job.exit_code = exit_code
+        job.duration = duration
+        metrics.JOB_DURATION.observe(duration, job.tool, status)
+
+        # a failed step is logged, but the job is always released, or `shutdown` and its watchers wait forever
+        try:
+            for step in (self._recordRun, self._mergeShards):
+                try:
+                    step(job)
+                except (sqlite3.Error, OSError) as error:
+                    self.db_manager.logEvent([("run_finish_failed",
+                                               f"Run ID `{job.id}` ({job.tool}) not fully recorded: {error}")])
+        finally:
+            job.finished.set()
+            with self._lock:
+                self.jobs.pop(job.id, None)
+                self._idle.notify_all()
+
+    def _recordRun(self, job):
+        self.db_manager.execute_other_query("UPDATE runs SET status=?, exit_code=?, duration=? WHERE id=?;",
+                                            (job.status, job.exit_code, job.duration, job.id))
+        self.db_manager.logEvent([("tool_run_finished",
+                                   f"Run ID `{job.id}` ({job.tool}) {job.status} with exit code {job.exit_code} in {job.duration:.1f}s")])
+
+        if job.status == "success" and job.domains:
+            sharding.recordCosts(self.db_manager, job.cmd_id, job.domains, job.duration)
+            freshness.recordScan(self.db_manager, job.cmd_id, job.id, job.domains, job.duration)
+
+    def _mergeShards(self, job):
+        # every shard counts as finished, even one whose run could not be recorded
+        if job.group is not None and job.group.jobFinished():
+            merged = job.group.merge()
+            self.db_manager.logEvent([("shards_merged",
+                                       f"Output of {len(job.group.jobs)} shards of command ID `{job.cmd_id}` merged into {', '.join(merged) or 'no files'}")])
+
+    def cancel(self, job_id):
+        """
+        `cancel` cancels a queued or running job
+        """
+        job = self.jobs.get(job_id)
+        if job is not None:
+            job.cancel()
+        return job
+
+    def cancelAll(self):
+        for job in list(self.jobs.values()):
+            if not job.done():
+                job.cancel()
+
+    def shutdown(self, wait=True, cancel=False):
+        """
+        `shutdown` stops accepting jobs. With `cancel` the running tools are stopped as well
+        """
+        if cancel:
+            self.cancelAll()
+        if wait:
+            # jobs waiting for a tool slot are submitted to the pool later, so wait for all of them first
+            with self._idle:
+                self._idle.wait_for(lambda: len(self.jobs) == 0)
+        self.pool.shutdown(wait=wait)
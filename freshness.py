@@ -0,0 +1,128 @@
+#!/usr/bin/python3
+# This file handles remembering when every domain was last scanned by a
+# command, so recently scanned domains are not enumerated again
+
+import collections
+import hashlib
+
+import metrics
+
+FRESHNESS_MODES = ("skip", "last")
+
+
+def namesDigest(names):
+    """
+    `namesDigest` returns the SHA-256 of a set of subdomain names, whatever their order
+    """
+    return hashlib.sha256("\n".join(sorted(names)).encode()).hexdigest()
+
+
+def recordScan(db_manager, cmd_id, run_id, domains, duration):
+    """
+    `recordScan` records that a successful run of a command scanned `domains`, with its share of the run time per domain.
+
+    The digest of the earlier scan is kept until `recordDigests` compares it with the one of this run.
+    """
+    if not domains:
+        return
+    seconds = duration / len(domains)
+    db_manager.execute_multi_query(
+        """INSERT INTO domain_scans (domain, cmd_id, run_id, completed_at, seconds)
+           VALUES (?, ?, ?, CURRENT_TIMESTAMP, ?)
+           ON CONFLICT(domain, cmd_id) DO UPDATE SET run_id = excluded.run_id, completed_at = excluded.completed_at,
+               unchanged = 0, seconds = excluded.seconds;""",
+        [(domain, cmd_id, run_id, seconds) for domain in domains])
+
+
+def recordDigests(db_manager, run_id):
+    """
+    `recordDigests` stores the digest of the subdomains a run saw for each of its domains, once its output is ingested.
+
+    The digest covers the normalized names in `sightings`, so the order of a tool's output, its
+    progress messages and the files it wrote them to don't matter. A scan with the same digest
+    as the earlier scan of the domain is marked `unchanged`, so `changes.ChangeDetector` doesn't
+    compare the two runs.
+    """
+    names = collections.defaultdict(list)
+    for domain, name in db_manager.execute_select_query(
+            """SELECT subdomains.domain, subdomains.name FROM sightings
+               JOIN subdomains ON subdomains.id = sightings.subdomain_id
+               WHERE sightings.run_id = ?;""", (run_id,)):
+        names[domain].append(name)
+    domains = [row[0] for row in db_manager.execute_select_query(
+        "SELECT domain FROM run_domains WHERE run_id = ?;", (run_id,))]
+    if not domains:
+        return
+    rows = []
+    for domain in domains:
+        digest = namesDigest(names[domain])
+        rows.append((digest, digest, domain, run_id))
+    # a newer scan of the domain recorded in the meantime is left alone
+    db_manager.execute_multi_query(
+        """UPDATE domain_scans SET unchanged = COALESCE(output_digest = ?, 0), output_digest = ?
+           WHERE domain = ? AND run_id = ?;""", rows)
+
+
+class FreshnessPolicy:
+    """
+    `FreshnessPolicy` decides which target domains of a command were scanned recently enough to leave out.
+
+    A domain is fresh for a command when a successful run of that command covered it less than
+    `ttl` seconds ago, as recorded in `domain_scans` when the run finished, whichever schedule
+    entry, worker or manual run started it. With mode `skip` fresh domains are left out of the
+    run and the subdomains stored by their last run stand; with `last` they are still run, after
+    all the others. `last` only orders the per-domain jobs of a command: a `$domain_file` command
+    runs all of its domains in one job, so `last` is rejected for it and every domain is run. The
+    run time of every skipped domain, its share of its last run, is counted as saved in `skipped`
+    and `seconds_saved` and in the metrics.
+    """
+
+    def __init__(self, db_manager, ttl, mode="skip"):
+        if mode not in FRESHNESS_MODES:
+            raise ValueError(f"unknown freshness mode `{mode}`")
+        self.db_manager = db_manager
+        self.ttl = ttl
+        self.mode = mode
+        self.skipped = 0
+        self.seconds_saved = 0.0
+
+    def freshScans(self, cmd_id):
+        """
+        `freshScans` returns the domains scanned by `cmd_id` within the TTL, mapped to (run id, seconds)
+        """
+        rows = self.db_manager.execute_select_query(
+            """SELECT domain, run_id, seconds FROM domain_scans
+               WHERE cmd_id = ? AND completed_at >= datetime('now', ?);""", (cmd_id, f"-{int(self.ttl)} seconds"))
+        return {domain: (run_id, seconds) for domain, run_id, seconds in rows}
+
+    def apply(self, cmd_id, tool, domains, file_command=False):
+        """
+        `apply` returns the domains a run of `cmd_id` should cover, without or after the fresh ones
+        """
+        if self.mode == "last" and file_command:
+            self.db_manager.logEvent([("fresh_mode_unsupported",
+                                       f"Fresh mode `last` only orders per-domain commands, file command ID `{cmd_id}` runs every domain")])
+            return domains
+
+        fresh = self.freshScans(cmd_id)
+        stale = [domain for domain in domains if domain not in fresh]
+        recent = [domain for domain in domains if domain in fresh]
+        if not recent:
+            return domains
+
+        if self.mode == "last":
+            self.db_manager.logEvent([("fresh_targets_deprioritized",
+                                       f"{len(recent)} domain(s) of command ID `{cmd_id}` scanned in the last {self.ttl:g}s run last")])
+            return stale + recent
+
+        saved = sum(fresh[domain][1] for domain in recent)
+        self.skipped += len(recent)
+        self.seconds_saved += saved
+        metrics.FRESH_SKIPPED.inc(tool, amount=len(recent))
+        metrics.TOOL_SECONDS_SAVED.inc(tool, amount=saved)
+        runs = sorted({fresh[domain][0] for domain in recent})
+        self.db_manager.logEvent([("fresh_targets_skipped",
+                                   f"{len(recent)} domain(s) of command ID `{cmd_id}` skipped, scanned in the last {self.ttl:g}s "
+                                   f"by run ID(s) {', '.join(f'`{run_id}`' for run_id in runs[:10])}"
+                                   f"{' and more' if len(runs) > 10 else ''}; about {saved:.0f}s of {tool} time saved")])
+        return stale
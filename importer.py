@@ -0,0 +1,208 @@
+#!/usr/bin/python3
+# This file handles bulk import of target domains from
+# text, CSV and JSON files
+
+import argparse
+import csv
+import io
+import json
+import re
+import sys
+
+import DbManager
+
+# labels don't start or end with a hyphen; names are matched after `normalizeDomain`
+DOMAIN_PATTERN = re.compile(r"^(?:[a-z0-9_](?:[a-z0-9_\-]*[a-z0-9_])?\.)+[a-z]{2,}$")
+PROGRAM_URL_PATTERN = re.compile(r"^https?://[a-zA-Z_0-9\.\-]+\.[a-z]{2,}/?[a-zA-Z0-9_\.\-/]*$")
+
+FORMATS = ("text", "csv", "json")
+
+# number of rejected lines kept for the report; all of them are counted
+MAX_REPORTED_REJECTS = 1000
+
+
+class ImportResult:
+    """
+    `ImportResult` holds the outcome of a bulk import
+    """
+
+    def __init__(self):
+        self.added = 0
+        # names of the added domains
+        self.domains = []
+        self.duplicates = 0
+        self.rejected = 0
+        self.rejects = []
+
+    def reject(self, line_number, value, reason):
+        self.rejected += 1
+        if len(self.rejects) < MAX_REPORTED_REJECTS:
+            self.rejects.append((line_number, value, reason))
+
+    def summary(self):
+        return f"{self.added} added, {self.duplicates} duplicates skipped, {self.rejected} rejected"
+
+
+def detectFormat(filename):
+    """
+    `detectFormat` guesses the import format from a file name
+    """
+    filename = (filename or "").lower()
+    if filename.endswith(".csv"):
+        return "csv"
+    if filename.endswith(".json") or filename.endswith(".jsonl"):
+        return "json"
+    return "text"
+
+
+def normalizeDomain(domain):
+    """
+    `normalizeDomain` lowercases a domain and strips a leading wildcard label
+    """
+    domain = domain.strip().lower().rstrip(".")
+    if domain.startswith("*."):
+        domain = domain[2:]
+    return domain
+
+
+def iterRecords(stream, fmt):
+    """
+    `iterRecords` reads `stream` one line at a time and yields (line_number, domain, program_url, enabled, error).
+
+    `program_url` and `enabled` are None when the line does not set them, and `error` is set
+    for lines that could not be parsed. Text files hold one domain per line (`#` starts a
+    comment), CSV files hold `domain[,program_url[,enabled]]` with an optional header, and
+    JSON files are JSON Lines of strings or objects. A file that is a single JSON array is
+    also accepted but is parsed as a whole.
+    """
+    if fmt == "csv":
+        for line_number, row in enumerate(csv.reader(stream), start=1):
+            if not row or not row[0].strip() or row[0].strip().startswith("#"):
+                continue
+            if line_number == 1 and row[0].strip().lower() == "domain":
+                continue
+            yield (line_number, row[0], row[1].strip() if len(row) > 1 and row[1].strip() else None,
+                   row[2].strip() if len(row) > 2 and row[2].strip() else None, None)
+    elif fmt == "json":
+        first_line = stream.readline()
+        if first_line.lstrip().startswith("["):
+            records = json.loads(first_line + stream.read())
+            for index, record in enumerate(records, start=1):
+                yield _jsonRecord(index, record)
+            return
+        for line_number, line in enumerate(_chain(first_line, stream), start=1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                yield (line_number, line.strip(), None, None, "invalid JSON")
+                continue
+            yield _jsonRecord(line_number, record)
+    else:
+        for line_number, line in enumerate(stream, start=1):
+            line = line.split("#", 1)[0].strip()
+            if line:
+                yield (line_number, line, None, None, None)
+
+
+def _chain(first_line, stream):
+    yield first_line
+    yield from stream
+
+
+def _jsonRecord(line_number, record):
+    if isinstance(record, str):
+        return (line_number, record, None, None, None)
+    if isinstance(record, dict):
+        return (line_number, str(record.get("domain", "")), record.get("program_url"), record.get("enabled"), None)
+    return (line_number, json.dumps(record), None, None, "unsupported JSON value")
+
+
+def importTargets(db_manager, stream, fmt="text", program_url="", enabled=0):
+    """
+    `importTargets` validates every record in `stream` and adds the new domains in one transaction.
+
+    `program_url` and `enabled` are used for records that don't set them. Returns an `ImportResult`.
+    """
+    result = ImportResult()
+    seen = set()
+    rows = []
+
+    for line_number, domain, record_url, record_enabled, error in iterRecords(stream, fmt):
+        if error is not None:
+            result.reject(line_number, domain, error)
+            continue
+
+        domain = normalizeDomain(domain)
+        record_url = record_url if record_url is not None else program_url
+
+        if not DOMAIN_PATTERN.match(domain):
+            result.reject(line_number, domain, "invalid domain name")
+            continue
+        if not record_url or not PROGRAM_URL_PATTERN.match(record_url):
+            result.reject(line_number, domain, "invalid program URL")
+            continue
+        try:
+            record_enabled = int(record_enabled if record_enabled is not None else enabled)
+        except (TypeError, ValueError):
+            result.reject(line_number, domain, "invalid enabled flag")
+            continue
+
+        if domain in seen:
+            result.duplicates += 1
+            continue
+        seen.add(domain)
+        rows.append((domain, record_url, 1 if record_enabled > 0 else 0))
+
+    with db_manager.transaction() as connection:
+        # the unique index skips domains that already exist, without reading the whole table under the write lock
+        for row in rows:
+            cursor = connection.execute(
+                "INSERT INTO domains (domain, program_url, enabled) VALUES (?, ?, ?) ON CONFLICT(domain) DO NOTHING;", row)
+            if cursor.rowcount:
+                result.domains.append(row[0])
+        result.added = len(result.domains)
+        result.duplicates += len(rows) - result.added
+
+    if result.added:
+        db_manager.logEvent([("domains_imported", f"{result.added} domains imported in bulk")])
+
+    return result
+
+
+def main(argv=None, prog=None):
+    parser = argparse.ArgumentParser(prog=prog, description="Import target domains in bulk")
+    parser.add_argument("file", help="File to import. Use - to read from stdin")
+    parser.add_argument("--format", help="Input format (default: guessed from the file name)",
+                        dest="fmt", choices=FORMATS, default=None)
+    parser.add_argument("--program-url", help="Program URL for records that don't have one",
+                        dest="program_url", default="")
+    parser.add_argument("--enabled", help="Enable imported domains that don't set the flag",
+                        dest="enabled", action="store_true", default=False)
+    parser.add_argument("--db-file", help="Location of the database (default target_data/assetguard.sqlite)",
+                        dest="db_file", default="target_data/assetguard.sqlite")
+    args = parser.parse_args(argv)
+
+    fmt = args.fmt or detectFormat(args.file)
+    DbManager.prepareDatabase(args.db_file)
+    db_manager = DbManager.Manager(args.db_file)
+
+    if args.file == "-":
+        stream = io.TextIOWrapper(sys.stdin.buffer, encoding="utf-8", errors="replace")
+        result = importTargets(db_manager, stream, fmt, args.program_url, int(args.enabled))
+    else:
+        with open(args.file, encoding="utf-8", errors="replace", newline="") as stream:
+            result = importTargets(db_manager, stream, fmt, args.program_url, int(args.enabled))
+
+    db_manager.close()
+
+    for line_number, value, reason in result.rejects:
+        print(f"line {line_number}: {value}: {reason}", file=sys.stderr)
+    print(result.summary())
+
+    return 0 if result.rejected == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
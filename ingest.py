@@ -0,0 +1,281 @@
+#!/usr/bin/python3
+# This file handles reading the output of the tools
+# and storing the discovered subdomains
+
+import argparse
+import re
+import sqlite3
+import threading
+import time
+
+import DbManager
+import scope
+import sharding
+
+HOSTNAME_PATTERN = re.compile(r"^[a-z0-9_](?:[a-z0-9_\-]*[a-z0-9_])?(?:\.[a-z0-9_](?:[a-z0-9_\-]*[a-z0-9_])?)*\.[a-z][a-z0-9\-]*[a-z0-9]$")
+
+# files written next to tool output that don't hold results
+IGNORED_SUFFIXES = (".log",)
+
+
+def normalizeName(line):
+    """
+    `normalizeName` extracts the host name from a line of tool output. Returns None if there is none
+    """
+    # amass prints `name (FQDN) --> ...`, other tools one name per line
+    parts = line.split(None, 1)
+    if len(parts) == 0:
+        return None
+    name = parts[0].lower().rstrip(".")
+    if name.startswith("*."):
+        name = name[2:]
+    if len(name) > 253 or not HOSTNAME_PATTERN.match(name):
+        return None
+    return name
+
+
+class BoundedSet:
+    """
+    `BoundedSet` remembers recently added items using at most about `2 * max_size` entries.
+
+    When the current generation is full it replaces the previous one, so the oldest items are
+    forgotten in bulk. Forgotten items are deduplicated by the database instead.
+    """
+
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self.current = set()
+        self.previous = set()
+
+    def __contains__(self, item):
+        return item in self.current or item in self.previous
+
+    def add(self, item):
+        if len(self.current) >= self.max_size:
+            self.previous = self.current
+            self.current = set()
+        self.current.add(item)
+
+
+class Ingestor:
+    """
+    `Ingestor` stores subdomains found in tool output in the `subdomains` table.
+
+    Files are read line by line, names already seen recently are skipped using a `BoundedSet`
+    and new rows are upserted in batches, so output files of any size are never loaded into
+    memory at once. With `start`, files that are still being written can be followed with
+    `watch` until the tool has finished.
+
+    Names read for a run are also recorded as sightings of that run, and `on_run_ingested`
+    is called with the run id once all of its output has been stored.
+    """
+
+    def __init__(self, db_manager, batch_size=1000, flush_interval=2.0, poll_interval=0.5, dedupe_size=100000):
+        self.db_manager = db_manager
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.poll_interval = poll_interval
+
+        self.seen = BoundedSet(dedupe_size)
+        # subdomains of disabled target domains are stored as well
+        self.scope = scope.ScopeMatcher(db_manager, enabled_only=False)
+        self.stored = 0
+        self.skipped = 0
+
+        self.on_run_ingested = None
+
+        self._batch = []
+        self._last_flush = time.monotonic()
+        self._watches = []
+        self._lock = threading.RLock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def loadDomains(self):
+        """
+        `loadDomains` applies the changes to the target domains used to link subdomains to their domain
+        """
+        self.scope.refresh()
+
+    def ingestLine(self, line, source, run_id=None):
+        """
+        `ingestLine` queues the subdomain on a line of output. Returns True if it was queued
+        """
+        if self.scope.version is None:
+            self.loadDomains()
+
+        name = normalizeName(line)
+        if name is None:
+            self.skipped += 1
+            return False
+        key = (name, source, run_id)
+        if key in self.seen:
+            return False
+
+        match = self.scope.match(name)
+        if match is None:
+            self.skipped += 1
+            return False
+        domain = match[0]
+
+        self.seen.add(key)
+        with self._lock:
+            self._batch.append((name, domain, source, run_id))
+            if len(self._batch) >= self.batch_size:
+                self.flush()
+        return True
+
+    def ingestLines(self, lines, source, run_id=None):
+        for line in lines:
+            self.ingestLine(line, source, run_id)
+        self.flush()
+
+    def ingestFile(self, path, source, run_id=None):
+        """
+        `ingestFile` reads a finished output file line by line and stores its subdomains
+        """
+        with open(path, errors="replace") as output_file:
+            self.ingestLines(output_file, source, run_id)
+
+    def flush(self):
+        """
+        `flush` writes the queued subdomains in one transaction
+        """
+        with self._lock:
+            batch, self._batch = self._batch, []
+            self._last_flush = time.monotonic()
+            if not batch:
+                return
+            with self.db_manager.transaction() as connection:
+                # names of target domains deleted since they were matched are dropped
+                connection.executemany(
+                    """INSERT INTO subdomains (name, domain, source, first_seen, last_seen)
+                       SELECT ?, ?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP
+                       WHERE EXISTS (SELECT 1 FROM domains WHERE domain = ?)
+                       ON CONFLICT(name) DO UPDATE SET last_seen = excluded.last_seen;""",
+                    [row[:3] + (row[1],) for row in batch])
+                connection.executemany(
+                    """INSERT OR IGNORE INTO sightings (run_id, subdomain_id)
+                       SELECT ?, id FROM subdomains WHERE name = ?;""",
+                    [(row[3], row[0]) for row in batch if row[3] is not None])
+            self.stored += len(batch)
+
+    def watch(self, prefix, source, finished, run_id=None):
+        """
+        `watch` follows every output file starting with `prefix` until the `finished` event is set
+        """
+        # pick up target domains added since the last run
+        self.loadDomains()
+        with self._lock:
+            self._watches.append(_Watch(prefix, source, finished, run_id))
+
+    def start(self):
+        """
+        `start` starts the thread that follows watched files
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="Ingestor", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        `stop` reads what is left of the watched files, writes it and stops the thread
+        """
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def _run(self):
+        while True:
+            stopping = self._stop_event.is_set()
+            with self._lock:
+                watches = list(self._watches)
+
+            # a failed batch is logged and skipped, so it doesn't stop the thread and every other watch with it
+            for watch in watches:
+                try:
+                    self._readWatch(watch, stopping)
+                except sqlite3.Error as error:
+                    self.db_manager.logEvent([("ingest_failed", f"Output of {watch.source} ({watch.prefix}) not stored: {error}")])
+
+            if time.monotonic() - self._last_flush >= self.flush_interval:
+                try:
+                    self.flush()
+                except sqlite3.Error as error:
+                    self.db_manager.logEvent([("ingest_failed", f"Batch of subdomains not stored: {error}")])
+            if stopping:
+                break
+            self._stop_event.wait(self.poll_interval)
+
+
+    def _readWatch(self, watch, stopping):
+        # check before reading, so nothing written just before the tool exited is missed
+        finished = watch.finished.is_set() or stopping
+        for line in watch.readLines(finished):
+            self.ingestLine(line, watch.source, watch.run_id)
+        if finished:
+            watch.close()
+            with self._lock:
+                self._watches.remove(watch)
+            if watch.run_id is not None and self.on_run_ingested is not None:
+                self.flush()
+                self.on_run_ingested(watch.run_id)
+
+
+class _Watch:
+    # open files of one watched output prefix and how far they have been read
+
+    def __init__(self, prefix, source, finished, run_id):
+        self.prefix = prefix
+        self.source = source
+        self.finished = finished
+        self.run_id = run_id
+        self.files = {}
+        self.partial = {}
+
+    def readLines(self, final=False):
+        for path in sharding.outputFiles(self.prefix):
+            if path.endswith(IGNORED_SUFFIXES):
+                continue
+            if path not in self.files:
+                self.files[path] = open(path, errors="replace")
+                self.partial[path] = ""
+
+            for line in self.files[path]:
+                # a line without a newline is still being written
+                if not line.endswith("\n"):
+                    self.partial[path] += line
+                    continue
+                yield self.partial[path] + line
+                self.partial[path] = ""
+
+        if final:
+            for path, rest in self.partial.items():
+                if rest:
+                    yield rest
+            self.partial = dict.fromkeys(self.partial, "")
+
+    def close(self):
+        for output_file in self.files.values():
+            output_file.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Store the subdomains found in tool output files")
+    parser.add_argument("files", nargs="+", help="Output files to read")
+    parser.add_argument("--source", help="Tool that produced the files", dest="source", required=True)
+    parser.add_argument("--db-file", help="Location of the database (default target_data/assetguard.sqlite)",
+                        dest="db_file", default="target_data/assetguard.sqlite")
+    args = parser.parse_args()
+
+    db_manager = DbManager.Manager(args.db_file)
+    ingestor = Ingestor(db_manager)
+    for path in args.files:
+        ingestor.ingestFile(path, args.source)
+    db_manager.close()
+
+    print(f"{ingestor.stored} subdomains stored, {ingestor.skipped} lines skipped")
@@ -0,0 +1,402 @@
+#!/usr/bin/python3
+# This file handles queueing tool jobs in the database, so worker
+# processes on the same host can claim and run them
+
+import argparse
+import json
+import os
+import random
+import socket
+import threading
+import time
+
+import asyncexecutor
+import changes
+import DbManager
+import executor
+import ingest
+import metrics
+import resolver
+import sharding
+
+QUEUED = "queued"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+STATES = (QUEUED, LEASED, DONE, FAILED)
+
+
+class QueuedJob:
+    """
+    `QueuedJob` is one row of the `job_queue` table
+    """
+
+    def __init__(self, id, cmd_id, shard, tool, argv, output, domain_file, domains, merge_output, attempts):
+        self.id = id
+        self.cmd_id = cmd_id
+        self.shard = shard
+        self.tool = tool
+        self.argv = json.loads(argv)
+        self.output = output
+        self.domain_file = domain_file
+        self.domains = json.loads(domains)
+        self.merge_output = merge_output
+        self.attempts = attempts
+
+    def toJob(self):
+        """
+        `toJob` returns an `executor.Job` running this queued job, writing its domain file again if it was removed
+        """
+        os.makedirs(os.path.dirname(self.output), exist_ok=True)
+        if self.domain_file and not os.path.exists(self.domain_file):
+            executor.writeDomainFile(self.domain_file, self.domains)
+        return executor.Job(self.cmd_id, self.tool, self.argv, self.output, self.domain_file, self.domains, self.shard)
+
+
+class JobQueue:
+    """
+    `JobQueue` keeps tool jobs in the `job_queue` table until a worker has run them.
+
+    The scheduler adds jobs with `enqueueCommand`. Workers `claim` queued jobs: the claim runs
+    in one `BEGIN IMMEDIATE` transaction, so two workers never get the same job, whether they
+    are threads or processes. A claimed job is leased to its worker for `lease_seconds`, and the
+    worker extends the lease with `heartbeat` while the tool runs. Leases of workers that crashed
+    expire and their jobs are queued again by the next claim.
+
+    All workers must run on the host of the database file: WAL mode keeps its index in shared
+    memory, which a network file system doesn't share between hosts, and lease expiry is
+    compared with the local clock.
+
+    A failed run is retried after an exponential backoff of `backoff_base` seconds, doubled for
+    every attempt up to `backoff_max`, with some jitter. After `max_attempts` attempts, counting
+    the ones lost with a crashed worker, the job is left `failed`.
+    """
+
+    def __init__(self, db_manager, lease_seconds=300, max_attempts=3, backoff_base=60, backoff_max=3600):
+        self.db_manager = db_manager
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+    def enqueue(self, jobs, merge_output=None, now=None):
+        """
+        `enqueue` adds `executor.Job`s to the queue in one transaction and returns their queue ids
+        """
+        now = time.time() if now is None else now
+        ids = []
+        with self.db_manager.transaction() as connection:
+            for job in jobs:
+                ids.append(connection.execute(
+                    """INSERT INTO job_queue (cmd_id, shard, tool, argv, output, domain_file, domains, merge_output,
+                                              max_attempts, available_at)
+                       VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?);""",
+                    (job.cmd_id, job.shard, job.tool, json.dumps(job.argv), job.output, job.domain_file,
+                     json.dumps(job.domains), merge_output, self.max_attempts, now)).lastrowid)
+        return ids
+
+    def enqueueCommand(self, tool_executor, cmd_id):
+        """
+        `enqueueCommand` builds the jobs of a command with `tool_executor` and queues them instead of running them.
+        Give `tool_executor` an absolute `output_dir`: workers run the stored paths from their own working directory
+        """
+        jobs = tool_executor.buildJobs(cmd_id)
+        # shards are merged by the worker finishing the last one
+        merge_output = jobs[0].group.output if jobs and jobs[0].group is not None else None
+        for job in jobs:
+            job.group = None
+        return self.enqueue(jobs, merge_output)
+
+    def recoverExpired(self, now=None):
+        """
+        `recoverExpired` queues the jobs whose lease expired again, or fails them after their last attempt. Returns how many
+        """
+        now = time.time() if now is None else now
+        with self.db_manager.transaction() as connection:
+            recovered = connection.execute(
+                """UPDATE job_queue SET state = CASE WHEN attempts >= max_attempts THEN ? ELSE ? END,
+                          lease_owner = NULL, lease_expires = NULL, available_at = ?,
+                          last_error = 'lease of ' || lease_owner || ' expired'
+                   WHERE state = ? AND lease_expires < ?;""",
+                (FAILED, QUEUED, now, LEASED, now)).rowcount
+        if recovered:
+            self.db_manager.logEvent([("job_lease_expired", f"{recovered} job(s) of lost workers recovered")])
+        return recovered
+
+    def claim(self, worker_id, limit=1, tools=None, now=None):
+        """
+        `claim` leases up to `limit` queued jobs to `worker_id`, optionally only jobs of `tools`, and returns them
+        """
+        now = time.time() if now is None else now
+        query = "SELECT id FROM job_queue WHERE state = ? AND available_at <= ?"
+        params = [QUEUED, now]
+        if tools:
+            query += f" AND tool IN ({', '.join('?' * len(tools))})"
+            params.extend(tools)
+        query += " ORDER BY available_at, id LIMIT ?;"
+        params.append(limit)
+
+        with self.db_manager.transaction() as connection:
+            self.recoverExpired(now)
+            ids = [row[0] for row in connection.execute(query, params)]
+            if not ids:
+                return []
+            placeholders = ", ".join("?" * len(ids))
+            connection.execute(
+                f"""UPDATE job_queue SET state = ?, lease_owner = ?, lease_expires = ?, attempts = attempts + 1
+                    WHERE id IN ({placeholders});""", [LEASED, worker_id, now + self.lease_seconds] + ids)
+            rows = connection.execute(
+                f"""SELECT id, cmd_id, shard, tool, argv, output, domain_file, domains, merge_output, attempts
+                    FROM job_queue WHERE id IN ({placeholders}) ORDER BY available_at, id;""", ids).fetchall()
+        return [QueuedJob(*row) for row in rows]
+
+    def heartbeat(self, worker_id, job_ids, now=None):
+        """
+        `heartbeat` extends the leases `worker_id` holds on `job_ids`. Returns the ids whose lease it still holds
+        """
+        now = time.time() if now is None else now
+        if not job_ids:
+            return set()
+        placeholders = ", ".join("?" * len(job_ids))
+        with self.db_manager.transaction() as connection:
+            connection.execute(
+                f"""UPDATE job_queue SET lease_expires = ?
+                    WHERE id IN ({placeholders}) AND state = ? AND lease_owner = ?;""",
+                [now + self.lease_seconds] + list(job_ids) + [LEASED, worker_id])
+            return {row[0] for row in connection.execute(
+                f"SELECT id FROM job_queue WHERE id IN ({placeholders}) AND state = ? AND lease_owner = ?;",
+                list(job_ids) + [LEASED, worker_id])}
+
+    def complete(self, worker_id, job_id, run_id=None):
+        """
+        `complete` marks a leased job done. Returns the merged output name if it was the last shard of its command, else None
+        """
+        with self.db_manager.transaction() as connection:
+            updated = connection.execute(
+                """UPDATE job_queue SET state = ?, lease_owner = NULL, lease_expires = NULL, run_id = ?, last_error = NULL
+                   WHERE id = ? AND state = ? AND lease_owner = ?;""",
+                (DONE, run_id, job_id, LEASED, worker_id)).rowcount
+            merge_output = connection.execute("SELECT merge_output FROM job_queue WHERE id = ?;", (job_id,)).fetchone()
+            if not updated or merge_output is None or merge_output[0] is None:
+                return None
+            remaining = connection.execute("SELECT COUNT(*) FROM job_queue WHERE merge_output = ? AND state != ?;",
+                                           (merge_output[0], DONE)).fetchone()[0]
+        return merge_output[0] if remaining == 0 else None
+
+    def backoff(self, attempts):
+        delay = min(self.backoff_base * 2 ** max(attempts - 1, 0), self.backoff_max)
+        # spread the retries of jobs that failed together
+        return delay * random.uniform(0.8, 1.2)
+
+    def fail(self, worker_id, job_id, error, run_id=None, now=None):
+        """
+        `fail` queues a leased job again after a backoff, or marks it failed after its last attempt. Returns the new state
+        """
+        now = time.time() if now is None else now
+        with self.db_manager.transaction() as connection:
+            row = connection.execute("SELECT attempts, max_attempts FROM job_queue WHERE id = ? AND state = ? AND lease_owner = ?;",
+                                     (job_id, LEASED, worker_id)).fetchone()
+            if row is None:
+                return None
+            state = FAILED if row[0] >= row[1] else QUEUED
+            connection.execute(
+                """UPDATE job_queue SET state = ?, lease_owner = NULL, lease_expires = NULL, available_at = ?,
+                          run_id = ?, last_error = ?
+                   WHERE id = ?;""", (state, now + self.backoff(row[0]), run_id, error, job_id))
+        return state
+
+    def release(self, worker_id, job_id, now=None):
+        """
+        `release` gives a leased job back without counting the attempt, e.g. when its worker is stopped
+        """
+        now = time.time() if now is None else now
+        self.db_manager.execute_other_query(
+            """UPDATE job_queue SET state = ?, lease_owner = NULL, lease_expires = NULL, available_at = ?,
+                      attempts = MAX(attempts - 1, 0)
+               WHERE id = ? AND state = ? AND lease_owner = ?;""", (QUEUED, now, job_id, LEASED, worker_id))
+
+    def shardOutputs(self, merge_output):
+        return [row[0] for row in self.db_manager.execute_select_query(
+            "SELECT output FROM job_queue WHERE merge_output = ? ORDER BY shard;", (merge_output,))]
+
+    def counts(self):
+        """
+        `counts` returns the number of jobs in every state
+        """
+        counts = dict.fromkeys(STATES, 0)
+        counts.update(self.db_manager.execute_select_query("SELECT state, COUNT(*) FROM job_queue GROUP BY state;", ()))
+        return counts
+
+
+class QueueWorker:
+    """
+    `QueueWorker` claims jobs from a `JobQueue` and runs them on an `executor.Executor`.
+
+    It claims as many jobs as the executor has free workers, every `poll_interval` seconds,
+    and extends their leases a few times per lease period. When the lease of a running job is
+    lost (the worker was paused longer than the lease and another worker took the job over),
+    the tool is stopped. Finished runs are completed or failed in the queue; the worker
+    finishing the last shard of a command merges the shard outputs, which requires the workers
+    of that command to use the same output directory.
+    """
+
+    def __init__(self, queue, tool_executor, worker_id=None, poll_interval=2.0, tools=None):
+        self.queue = queue
+        self.executor = tool_executor
+        self.db_manager = queue.db_manager
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        self.poll_interval = poll_interval
+        self.heartbeat_interval = queue.lease_seconds / 3
+        self.tools = tools
+
+        # queue id -> executor.Job
+        self.active = {}
+        self._last_heartbeat = 0
+        self._stop_event = threading.Event()
+
+        metrics.REGISTRY.gauge("assetguard_job_queue_jobs", "Jobs in the job queue by state",
+                               lambda: {(state,): count for state, count in self.queue.counts().items()}, ("state",))
+
+    def runOnce(self, now=None):
+        """
+        `runOnce` settles finished jobs, renews leases and claims new jobs. Returns the number of claimed jobs
+        """
+        now = time.time() if now is None else now
+        self.settleFinished()
+        if self.active and now - self._last_heartbeat >= self.heartbeat_interval:
+            self.renewLeases(now)
+
+        capacity = self.executor.max_workers - len(self.active)
+        if capacity <= 0 or self._stop_event.is_set():
+            return 0
+        claimed = self.queue.claim(self.worker_id, capacity, self.tools, now)
+        for queued_job in claimed:
+            try:
+                job = queued_job.toJob()
+            except OSError as error:
+                self.queue.fail(self.worker_id, queued_job.id, f"could not prepare job: {error}", now=now)
+                continue
+            self.active[queued_job.id] = job
+            self.executor.submit(job)
+        return len(claimed)
+
+    def renewLeases(self, now):
+        held = self.queue.heartbeat(self.worker_id, list(self.active), now)
+        self._last_heartbeat = now
+        for queue_id in set(self.active) - held:
+            job = self.active.pop(queue_id)
+            job.cancel()
+            self.db_manager.logEvent([("job_lease_lost", f"Queued job `{queue_id}` (run ID `{job.id}`) lost its lease and was stopped")])
+
+    def settleFinished(self):
+        for queue_id, job in list(self.active.items()):
+            if not job.done():
+                continue
+            del self.active[queue_id]
+
+            if job.status == "success":
+                merge_output = self.queue.complete(self.worker_id, queue_id, job.id)
+                if merge_output is not None:
+                    merged = sharding.mergeOutputs(self.queue.shardOutputs(merge_output), merge_output)
+                    self.db_manager.logEvent([("shards_merged",
+                                               f"Output of the shards of command ID `{job.cmd_id}` merged into {', '.join(merged) or 'no files'}")])
+            elif job.status == "cancelled" and self._stop_event.is_set():
+                self.queue.release(self.worker_id, queue_id)
+            else:
+                state = self.queue.fail(self.worker_id, queue_id, f"{job.status} with exit code {job.exit_code}", job.id)
+                if state == FAILED:
+                    self.db_manager.logEvent([("job_failed", f"Queued job `{queue_id}` of command ID `{job.cmd_id}` "
+                                               "failed its last attempt")])
+
+    def start(self):
+        """
+        `start` runs the worker loop. It returns after `stop` is called
+        """
+        self._stop_event.clear()
+        while not self._stop_event.is_set():
+            claimed = self.runOnce()
+            # keep claiming right away while there is work and free workers
+            if claimed == 0 or len(self.active) >= self.executor.max_workers:
+                self._stop_event.wait(self.poll_interval)
+
+    def stop(self, cancel_jobs=False):
+        """
+        `stop` ends the worker loop and waits for the running jobs, or stops them and gives them back with `cancel_jobs`
+        """
+        self._stop_event.set()
+        if cancel_jobs:
+            for job in self.active.values():
+                job.cancel()
+        self.executor.shutdown(wait=True)
+        self.settleFinished()
+
+
+def main(argv=None, prog=None):
+    parser = argparse.ArgumentParser(prog=prog, description="Run jobs queued by `run-scheduler --queue`. "
+                                     "Workers must run on the host of the database file")
+    parser.add_argument("--db-file", help="Location of the database (default target_data/assetguard.sqlite)",
+                        dest="db_file", default="target_data/assetguard.sqlite")
+    parser.add_argument("--worker-id", help="Name of this worker in the queue (default host:pid)", dest="worker_id")
+    parser.add_argument("--workers", help="Maximum number of tools running at the same time (default 4)",
+                        dest="max_workers", type=int, default=4)
+    parser.add_argument("--per-tool", help="Maximum number of runs of the same tool at the same time (default 2)",
+                        dest="default_tool_limit", type=int, default=2)
+    parser.add_argument("--tool", help="Only claim jobs of this tool, can be repeated", dest="tools", action="append")
+    parser.add_argument("--timeout", help="Seconds after which a tool run is stopped (default 21600)",
+                        dest="timeout", type=int, default=6 * 60 * 60)
+    parser.add_argument("--lease-seconds", help="Seconds a claimed job stays leased without a heartbeat (default 300)",
+                        dest="lease_seconds", type=int, default=300)
+    parser.add_argument("--poll-interval", help="Seconds between checks for new jobs (default 2)",
+                        dest="poll_interval", type=float, default=2.0)
+    parser.add_argument("--asyncio", help="Run tools as asyncio subprocesses and read their output as it is printed",
+                        dest="use_asyncio", action="store_true", default=False)
+    parser.add_argument("--resolve", help="Resolve the subdomains found by every run and store their A, AAAA and CNAME records",
+                        dest="resolve", action="store_true", default=False)
+    parser.add_argument("--nameserver", help="Nameserver for --resolve as host or host:port, can be repeated (default from /etc/resolv.conf)",
+                        dest="nameservers", action="append")
+    parser.add_argument("--dns-concurrency", help="Maximum number of DNS queries in flight (default 200)",
+                        dest="dns_concurrency", type=int, default=200)
+    parser.add_argument("--dns-retries", help="Times a DNS query is sent again after a timeout or server failure (default 2)",
+                        dest="dns_retries", type=int, default=2)
+    parser.add_argument("--dns-timeout", help="Seconds to wait for a DNS answer (default 2)",
+                        dest="dns_timeout", type=float, default=2.0)
+    args = parser.parse_args(argv)
+
+    DbManager.prepareDatabase(args.db_file)
+    db_manager = DbManager.Manager(args.db_file)
+    ingestor = ingest.Ingestor(db_manager)
+    change_detector = changes.ChangeDetector(db_manager)
+    resolution_stage = None
+    if args.resolve:
+        resolution_stage = resolver.ResolutionStage(db_manager, nameservers=args.nameservers, concurrency=args.dns_concurrency,
+                                                    retries=args.dns_retries, timeout=args.dns_timeout)
+
+    def runIngested(run_id):
+        # same as `runner.Engine.runIngested` for the runs of this worker
+        change_detector.detect(run_id)
+        if resolution_stage is not None:
+            resolution_stage.submitRun(run_id)
+
+    ingestor.on_run_ingested = runIngested
+    executor_class = asyncexecutor.AsyncExecutor if args.use_asyncio else executor.Executor
+    # queued jobs carry the absolute paths of their output, chosen by `run-scheduler --output-dir`
+    tool_executor = executor_class(db_manager, max_workers=args.max_workers,
+                                   default_tool_limit=args.default_tool_limit, timeout=args.timeout, ingestor=ingestor)
+    worker = QueueWorker(JobQueue(db_manager, lease_seconds=args.lease_seconds), tool_executor,
+                         worker_id=args.worker_id, poll_interval=args.poll_interval, tools=args.tools)
+
+    if resolution_stage is not None:
+        resolution_stage.start()
+    ingestor.start()
+    try:
+        worker.start()
+    except KeyboardInterrupt:
+        worker.stop(cancel_jobs=True)
+    ingestor.stop()
+    if resolution_stage is not None:
+        resolution_stage.stop()
+    db_manager.close()
+
+
+if __name__ == "__main__":
+    main()
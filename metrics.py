@@ -0,0 +1,223 @@
+#!/usr/bin/python3
+# This file handles collecting timings and counters and
+# exposing them in the Prometheus text format
+
+import functools
+import re
+import threading
+
+# upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# upper bounds in seconds for tool runs, which take minutes to hours
+JOB_BUCKETS = (1, 10, 30, 60, 300, 600, 1800, 3600, 7200, 21600)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+STATEMENT_PATTERN = re.compile(
+    r"^\s*(?:WITH\b.*?\)\s*)?(SELECT|INSERT|UPDATE|DELETE|PRAGMA|BEGIN|CREATE|DROP|ANALYZE|VACUUM)\b"
+    r"(?:.*?\b(?:FROM|INTO|UPDATE)\s+\"?(\w+))?", re.IGNORECASE | re.DOTALL)
+
+
+@functools.lru_cache(maxsize=1024)
+def statementLabel(query):
+    """
+    `statementLabel` reduces a query to its statement type and first table, e.g. `SELECT domains`
+    """
+    match = STATEMENT_PATTERN.match(query)
+    if match is None:
+        return "OTHER"
+    if match.group(1).upper() == "PRAGMA":
+        return "PRAGMA " + query.split(None, 1)[1].split("(")[0].split("=")[0].strip(" ;").lower()
+    if match.group(2) is None:
+        return match.group(1).upper()
+    return f"{match.group(1).upper()} {match.group(2)}"
+
+
+def formatLabels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def formatNumber(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """
+    `Counter` is a value per label set that only goes up
+    """
+
+    kind = "counter"
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        with self._lock:
+            values = dict(self.values)
+        for label_values, value in sorted(values.items()):
+            yield f"{self.name}{formatLabels(self.labels, label_values)} {formatNumber(value)}"
+
+
+class Histogram:
+    """
+    `Histogram` counts observed values per label set in cumulative buckets, like a Prometheus histogram
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets) + (float("inf"),)
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self.values.get(label_values)
+            if series is None:
+                # per bucket counts, sum, count
+                series = self.values[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][index] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        with self._lock:
+            values = {key: (list(series[0]), series[1], series[2]) for key, series in self.values.items()}
+        for label_values, (counts, total, count) in sorted(values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield (f"{self.name}_bucket{formatLabels(self.labels, label_values, [('le', formatNumber(bound))])} "
+                       f"{cumulative}")
+            yield f"{self.name}_sum{formatLabels(self.labels, label_values)} {formatNumber(total)}"
+            yield f"{self.name}_count{formatLabels(self.labels, label_values)} {count}"
+
+
+class Gauge:
+    """
+    `Gauge` reports the current value of something by calling `callback` when the metrics are read.
+
+    `callback` returns a number, or a dictionary from label value tuples to numbers.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, description, callback, labels=()):
+        self.name = name
+        self.description = description
+        self.callback = callback
+        self.labels = tuple(labels)
+
+    def render(self):
+        values = self.callback()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for label_values, value in sorted(values.items()):
+            yield f"{self.name}{formatLabels(self.labels, label_values)} {formatNumber(value)}"
+
+
+class Registry:
+    """
+    `Registry` holds the metrics of a process and renders them in the Prometheus text format.
+
+    Every process keeps its own values, so with several web worker processes each one reports
+    the requests it served.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        # metrics are created once per name, so several `Manager` instances share them
+        with self._lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, description, labels=()):
+        return self.register(Counter(name, description, labels))
+
+    def histogram(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, description, labels, buckets))
+
+    def gauge(self, name, description, callback, labels=()):
+        # the latest callback replaces an earlier one of the same name
+        with self._lock:
+            self.metrics[name] = Gauge(name, description, callback, labels)
+            return self.metrics[name]
+
+    def render(self):
+        with self._lock:
+            metrics = sorted(self.metrics.values(), key=lambda metric: metric.name)
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.description}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+QUERY_DURATION = REGISTRY.histogram("assetguard_query_duration_seconds",
+                                    "Time spent running database queries", ("statement",))
+QUERY_ROWS = REGISTRY.counter("assetguard_query_rows_total", "Rows returned or changed by database queries", ("statement",))
+CONNECT_DURATION = REGISTRY.histogram("assetguard_db_connect_seconds", "Time spent opening database connections")
+REQUEST_DURATION = REGISTRY.histogram("assetguard_request_duration_seconds",
+                                      "Time spent serving web requests, including streamed bodies",
+                                      ("method", "route", "status"))
+JOB_DURATION = REGISTRY.histogram("assetguard_job_duration_seconds", "Duration of tool runs",
+                                  ("tool", "status"), buckets=JOB_BUCKETS)
+DNS_QUERIES = REGISTRY.counter("assetguard_dns_queries_total", "DNS queries by outcome, including answers from the cache",
+                               ("outcome",))
+FRESH_SKIPPED = REGISTRY.counter("assetguard_fresh_domains_skipped_total",
+                                 "Target domains left out of runs because they were scanned recently", ("tool",))
+TOOL_SECONDS_SAVED = REGISTRY.counter("assetguard_tool_seconds_saved_total",
+                                      "Estimated tool run time saved by skipping recently scanned domains", ("tool",))
+DNS_DURATION = REGISTRY.histogram("assetguard_dns_query_seconds", "Time spent waiting for DNS answers")
+
+
+def serve(host, port, registry=REGISTRY):
+    """
+    `serve` exposes `registry` at `/metrics` on a background HTTP server, for processes without a web interface
+    """
+    # only the runner serves metrics this way, so the import is left out of every other command
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name="MetricsServer", daemon=True).start()
+    return server
@@ -0,0 +1,572 @@
+#!/usr/bin/python3
+# This file handles resolving discovered subdomains with an asyncio
+# DNS client and storing their A, AAAA and CNAME records
+
+import argparse
+import asyncio
+import collections
+import heapq
+import random
+import secrets
+import socket
+import sqlite3
+import struct
+import threading
+import time
+
+import DbManager
+import metrics
+
+RECORD_TYPES = {"A": 1, "CNAME": 5, "SOA": 6, "AAAA": 28}
+TYPE_NAMES = {value: name for name, value in RECORD_TYPES.items()}
+CLASS_IN = 1
+TYPE_OPT = 41
+
+FLAG_RD = 0x0100
+FLAG_TC = 0x0200
+RCODE_NOERROR = 0
+RCODE_NXDOMAIN = 3
+RCODE_NAMES = {0: "noerror", 1: "formerr", 2: "servfail", 3: "nxdomain", 4: "notimp", 5: "refused"}
+
+# UDP payload size advertised with EDNS, small enough to avoid IP fragmentation
+EDNS_PAYLOAD_SIZE = 1232
+DNS_PORT = 53
+
+# statuses stored in the `resolutions` table
+RESOLVED = "resolved"
+NXDOMAIN = "nxdomain"
+NODATA = "nodata"
+FAILED = "failed"
+
+Response = collections.namedtuple("Response", "id flags rcode question answers negative_ttl")
+# `records` are (record type, value, ttl) tuples
+Answer = collections.namedtuple("Answer", "status records")
+
+
+def encodeName(name):
+    encoded = b""
+    for label in name.rstrip(".").split("."):
+        raw_label = label.encode("ascii")
+        if not 0 < len(raw_label) < 64:
+            raise ValueError(f"invalid label in `{name}`")
+        encoded += bytes([len(raw_label)]) + raw_label
+    if len(encoded) > 254:
+        raise ValueError(f"`{name}` is too long")
+    return encoded + b"\x00"
+
+
+def encodeQuery(query_id, name, record_type):
+    """
+    `encodeQuery` builds a recursive query for `record_type` records of `name` with an EDNS OPT record
+    """
+    header = struct.pack("!HHHHHH", query_id, FLAG_RD, 1, 0, 0, 1)
+    question = encodeName(name) + struct.pack("!HH", record_type, CLASS_IN)
+    opt = b"\x00" + struct.pack("!HHIH", TYPE_OPT, EDNS_PAYLOAD_SIZE, 0, 0)
+    return header + question + opt
+
+
+def readName(data, offset):
+    """
+    `readName` reads a possibly compressed name at `offset`. Returns the name and the offset after it
+    """
+    labels = []
+    end = None
+    for _ in range(128):
+        length = data[offset]
+        if length & 0xC0 == 0xC0:
+            # the rest of the name is elsewhere in the message
+            if end is None:
+                end = offset + 2
+            offset = struct.unpack_from("!H", data, offset)[0] & 0x3FFF
+        elif length == 0:
+            return ".".join(labels).lower(), offset + 1 if end is None else end
+        else:
+            labels.append(data[offset + 1:offset + 1 + length].decode("ascii", errors="replace"))
+            offset += 1 + length
+    raise ValueError("compression loop in name")
+
+
+def parseResponse(data):
+    """
+    `parseResponse` decodes a DNS response. Answers are (owner, type, ttl, value) tuples of A, AAAA and CNAME records.
+
+    `negative_ttl` is how long a negative answer may be cached, from the SOA record of the
+    authority section (RFC 2308), or None without one.
+    """
+    query_id, flags, question_count, answer_count, authority_count, _ = struct.unpack_from("!HHHHHH", data, 0)
+    offset = 12
+    question = None
+    for _ in range(question_count):
+        name, offset = readName(data, offset)
+        question = (name, struct.unpack_from("!H", data, offset)[0])
+        offset += 4
+
+    answers = []
+    negative_ttl = None
+    for index in range(answer_count + authority_count):
+        owner, offset = readName(data, offset)
+        record_type, _, ttl, length = struct.unpack_from("!HHIH", data, offset)
+        offset += 10
+        rdata_offset, offset = offset, offset + length
+        if offset > len(data):
+            raise ValueError("truncated record")
+
+        if index >= answer_count:
+            if record_type == RECORD_TYPES["SOA"]:
+                _, soa_offset = readName(data, rdata_offset)
+                _, soa_offset = readName(data, soa_offset)
+                negative_ttl = min(ttl, struct.unpack_from("!5I", data, soa_offset)[4])
+        elif record_type == RECORD_TYPES["A"] and length == 4:
+            answers.append((owner, record_type, ttl, socket.inet_ntop(socket.AF_INET, data[rdata_offset:offset])))
+        elif record_type == RECORD_TYPES["AAAA"] and length == 16:
+            answers.append((owner, record_type, ttl, socket.inet_ntop(socket.AF_INET6, data[rdata_offset:offset])))
+        elif record_type == RECORD_TYPES["CNAME"]:
+            answers.append((owner, record_type, ttl, readName(data, rdata_offset)[0]))
+
+    return Response(query_id, flags, flags & 0xF, question, answers, negative_ttl)
+
+
+def parseNameserver(nameserver):
+    """
+    `parseNameserver` turns `1.1.1.1`, `127.0.0.1:5353`, `::1` or `[::1]:5353` into an address tuple
+    """
+    if nameserver.startswith("["):
+        host, _, port = nameserver[1:].partition("]")
+        return host, int(port.lstrip(":") or DNS_PORT)
+    if nameserver.count(":") == 1:
+        host, port = nameserver.split(":")
+        return host, int(port)
+    return nameserver, DNS_PORT
+
+
+def systemNameservers(path="/etc/resolv.conf"):
+    """
+    `systemNameservers` returns the nameservers configured in `path`
+    """
+    nameservers = []
+    try:
+        with open(path) as resolv_conf:
+            for line in resolv_conf:
+                fields = line.split()
+                if len(fields) >= 2 and fields[0] == "nameserver":
+                    nameservers.append(fields[1].split("%")[0])
+    except OSError:
+        pass
+    return nameservers or ["127.0.0.1"]
+
+
+class TTLCache:
+    """
+    `TTLCache` keeps DNS answers until their TTL runs out, for at most `max_size` questions.
+
+    TTLs are kept between `min_ttl` and `max_ttl` seconds, so names with a TTL of 0 are not
+    asked again for every run that prints them. Expired answers are dropped in expiry order
+    from a heap on every `add`; when the cache is still full the least recently used answer
+    is dropped. It is used from one event loop and not thread safe.
+    """
+
+    def __init__(self, max_size=100000, min_ttl=30, max_ttl=86400, negative_ttl=300):
+        self.max_size = max_size
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.negative_ttl = negative_ttl
+        # key -> (expires, answer), least recently used first
+        self.entries = collections.OrderedDict()
+        self.expiry = []
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, now=None):
+        now = time.monotonic() if now is None else now
+        entry = self.entries.get(key)
+        if entry is None or entry[0] <= now:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def add(self, key, answer, ttl, now=None):
+        now = time.monotonic() if now is None else now
+        expires = now + min(max(ttl, self.min_ttl), self.max_ttl)
+        self.entries[key] = (expires, answer)
+        self.entries.move_to_end(key)
+        heapq.heappush(self.expiry, (expires, key))
+        self.evict(now)
+
+    def evict(self, now):
+        while self.expiry and self.expiry[0][0] <= now:
+            expires, key = heapq.heappop(self.expiry)
+            # keys added again since have a later expiry and stay
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == expires:
+                del self.entries[key]
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        # heap items of replaced or evicted keys are left behind, so rebuild it now and then
+        if len(self.expiry) > 2 * len(self.entries) + 64:
+            self.expiry = [(entry[0], key) for key, entry in self.entries.items()]
+            heapq.heapify(self.expiry)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def answersQuery(response, query_id, question):
+    """
+    `answersQuery` tells whether `response` carries the id and the question section of the query
+    """
+    return response.id == query_id and response.question == question
+
+
+class _QueryProtocol(asyncio.DatagramProtocol):
+    # a UDP socket of its own for one query, so every query comes from a new random source port
+    def __init__(self, future, query_id, question):
+        self.future = future
+        self.query_id = query_id
+        self.question = question
+
+    def datagram_received(self, data, address):
+        try:
+            response = parseResponse(data)
+        except (ValueError, struct.error, IndexError):
+            return
+        # answers to another question are late or spoofed
+        if self.future.done() or not answersQuery(response, self.query_id, self.question):
+            return
+        self.future.set_result(response)
+
+    def error_received(self, error):
+        # e.g. ICMP port unreachable; the query times out and is retried
+        pass
+
+    def connection_lost(self, error):
+        if not self.future.done():
+            self.future.set_exception(ConnectionError("nameserver socket closed"))
+
+
+class AsyncResolver:
+    """
+    `AsyncResolver` resolves host names concurrently with plain DNS queries on one event loop.
+
+    At most `concurrency` queries are in flight. A query that times out after `timeout` seconds,
+    or is answered with SERVFAIL or REFUSED, is sent again to the next of `nameservers` up to
+    `retries` times. Truncated answers are asked again over TCP. Answers are kept in `cache` for
+    their TTL, negative ones for the TTL of the zone's SOA record.
+    """
+
+    def __init__(self, nameservers=None, concurrency=200, retries=2, timeout=2.0, cache=None):
+        self.nameservers = [parseNameserver(nameserver) for nameserver in (nameservers or systemNameservers())]
+        self.concurrency = concurrency
+        self.retries = retries
+        self.timeout = timeout
+        self.cache = cache if cache is not None else TTLCache()
+
+        self._slots = None
+
+    async def _queryUDP(self, address, query, query_id, question):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        # the connected socket only accepts datagrams from `address`
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda: _QueryProtocol(future, query_id, question), remote_addr=address)
+        try:
+            transport.sendto(query)
+            return await asyncio.wait_for(future, self.timeout)
+        finally:
+            transport.close()
+
+    async def _queryTCP(self, address, query, query_id, question):
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(*address), self.timeout)
+        try:
+            writer.write(struct.pack("!H", len(query)) + query)
+            length = struct.unpack("!H", await asyncio.wait_for(reader.readexactly(2), self.timeout))[0]
+            response = parseResponse(await asyncio.wait_for(reader.readexactly(length), self.timeout))
+        finally:
+            writer.close()
+        if not answersQuery(response, query_id, question):
+            raise ValueError("answer to another query")
+        return response
+
+    async def query(self, name, record_type):
+        """
+        `query` asks the nameservers for the `record_type` records of `name`. Returns the `Response`, or None if none answered
+        """
+        first = random.randrange(len(self.nameservers))
+        # names in responses are read in lower case
+        question = (name.lower().rstrip("."), record_type)
+        response = None
+        for attempt in range(self.retries + 1):
+            address = self.nameservers[(first + attempt) % len(self.nameservers)]
+            start = time.perf_counter()
+            try:
+                # query ids are not guessable, so an off-path attacker can't forge the answer
+                query_id = secrets.randbelow(65536)
+                query = encodeQuery(query_id, name, record_type)
+                response = await self._queryUDP(address, query, query_id, question)
+                if response.flags & FLAG_TC:
+                    response = await self._queryTCP(address, query, query_id, question)
+            except asyncio.TimeoutError:
+                metrics.DNS_QUERIES.inc("timeout")
+                continue
+            except (OSError, ValueError, struct.error, asyncio.IncompleteReadError):
+                metrics.DNS_QUERIES.inc("error")
+                continue
+            finally:
+                metrics.DNS_DURATION.observe(time.perf_counter() - start)
+
+            metrics.DNS_QUERIES.inc(RCODE_NAMES.get(response.rcode, "other"))
+            if response.rcode in (RCODE_NOERROR, RCODE_NXDOMAIN):
+                return response
+        return None
+
+    async def lookup(self, name, record_type):
+        """
+        `lookup` returns the `Answer` for the `record_type` records of `name`, from the cache if possible
+        """
+        key = (name, record_type)
+        answer = self.cache.get(key)
+        if answer is not None:
+            metrics.DNS_QUERIES.inc("cached")
+            return answer
+
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.concurrency)
+        async with self._slots:
+            response = await self.query(name, RECORD_TYPES[record_type])
+        if response is None:
+            return Answer(FAILED, ())
+
+        records = tuple((TYPE_NAMES[answer_type], value, ttl) for _, answer_type, ttl, value in response.answers)
+        if response.rcode == RCODE_NXDOMAIN:
+            status = NXDOMAIN
+        elif any(record[0] == record_type for record in records):
+            status = RESOLVED
+        else:
+            status = NODATA
+
+        if status == RESOLVED:
+            ttl = min(record[2] for record in records)
+        else:
+            ttl = response.negative_ttl if response.negative_ttl is not None else self.cache.negative_ttl
+        answer = Answer(status, records)
+        self.cache.add(key, answer, ttl)
+        return answer
+
+    async def resolve(self, name):
+        """
+        `resolve` returns the `Answer` with the A and AAAA records of `name` and the CNAME records leading to them
+        """
+        name = name.strip().lower().rstrip(".")
+        try:
+            encodeName(name)
+        except (ValueError, UnicodeEncodeError):
+            return Answer(FAILED, ())
+
+        answers = await asyncio.gather(self.lookup(name, "A"), self.lookup(name, "AAAA"))
+        records = list(dict.fromkeys(record for answer in answers for record in answer.records))
+        statuses = {answer.status for answer in answers}
+        for status in (RESOLVED, NXDOMAIN, NODATA):
+            if status in statuses:
+                break
+        else:
+            status = FAILED
+        return Answer(status, tuple(records))
+
+    async def resolveMany(self, names):
+        """
+        `resolveMany` resolves `names` concurrently and returns a dictionary from name to `Answer`
+        """
+        names = list(dict.fromkeys(names))
+        answers = await asyncio.gather(*(self.resolve(name) for name in names))
+        return dict(zip(names, answers))
+
+
+class ResolutionStage:
+    """
+    `ResolutionStage` resolves subdomains found by tools on a background thread and stores the results.
+
+    `submitRun` queues the subdomains seen by a finished run and `submit` any (subdomain id, name)
+    pairs. The thread runs an event loop with one `AsyncResolver`, resolving up to `batch_size`
+    queued names at a time. Every batch is stored in one transaction: the status of each name in
+    `resolutions` (a name is alive when it is `resolved`) and its A, AAAA and CNAME records in
+    `dns_records`. The resolver's cache lives as long as the stage, so names printed by many runs
+    are only asked again once their records expired. A batch that can't be stored is logged as
+    `resolution_failed` and dropped, and a thread that stopped anyway is started again by the
+    next `submit`.
+    """
+
+    def __init__(self, db_manager, batch_size=500, **resolver_options):
+        self.db_manager = db_manager
+        self.batch_size = batch_size
+        self.resolver_options = resolver_options
+        self.resolved = 0
+        self.alive = 0
+
+        self.loop = None
+        self._queue = None
+        self._thread = None
+
+    def start(self):
+        """
+        `start` starts the thread resolving queued names
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return
+        ready = threading.Event()
+        self._thread = threading.Thread(target=lambda: asyncio.run(self._consume(ready)),
+                                        name="ResolutionStage", daemon=True)
+        self._thread.start()
+        ready.wait()
+
+    def stop(self):
+        """
+        `stop` resolves the names queued so far and stops the thread
+        """
+        if self._thread is None:
+            return
+        if self._running():
+            self.loop.call_soon_threadsafe(self._queue.put_nowait, None)
+        self._thread.join()
+        self._thread = None
+
+    def submit(self, subdomains):
+        """
+        `submit` queues (subdomain id, name) pairs for resolution
+        """
+        subdomains = list(subdomains)
+        if not subdomains:
+            return
+        if self._thread is None:
+            self.db_manager.logEvent([("resolution_skipped", f"{len(subdomains)} subdomains not resolved, the resolution stage is stopped")])
+            return
+        if not self._running():
+            self.db_manager.logEvent([("resolution_restarted", "The resolution thread had stopped and was started again")])
+            self.start()
+        self.loop.call_soon_threadsafe(self._enqueue, subdomains)
+
+    def _running(self):
+        return self._thread is not None and self._thread.is_alive() and not self.loop.is_closed()
+
+    def submitRun(self, run_id):
+        """
+        `submitRun` queues the subdomains seen by run `run_id`. Returns how many
+        """
+        rows = self.db_manager.execute_select_query(
+            """SELECT subdomains.id, subdomains.name FROM sightings
+               JOIN subdomains ON subdomains.id = sightings.subdomain_id
+               WHERE sightings.run_id = ?;""", (run_id,))
+        self.submit(rows)
+        return len(rows)
+
+    def _enqueue(self, subdomains):
+        for subdomain in subdomains:
+            self._queue.put_nowait(subdomain)
+
+    async def _consume(self, ready):
+        self.loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        resolver = AsyncResolver(**self.resolver_options)
+        ready.set()
+
+        stopping = False
+        while not stopping:
+            batch = [await self._queue.get()]
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            if None in batch:
+                stopping = True
+                batch = [subdomain for subdomain in batch if subdomain is not None]
+            if not batch:
+                continue
+            try:
+                answers = await resolver.resolveMany(name for _, name in batch)
+                # writes may wait for other writers, so they don't run on the event loop
+                await self.loop.run_in_executor(None, self.store,
+                                                [(subdomain_id, answers[name]) for subdomain_id, name in batch])
+            except (sqlite3.Error, OSError) as error:
+                # the batch is dropped, the names are resolved again by their next run or `resolve`
+                await self.loop.run_in_executor(None, self._logFailure, len(batch), error)
+
+    def _logFailure(self, count, error):
+        try:
+            self.db_manager.logEvent([("resolution_failed", f"{count} subdomains not resolved: {error}")])
+        except sqlite3.Error:
+            # the database is still unavailable; the failure is left unlogged rather than stopping the stage
+            pass
+
+    def store(self, results):
+        """
+        `store` writes the status and records of resolved subdomains in one transaction
+        """
+        with self.db_manager.transaction() as connection:
+            # subdomains deleted with their target domain in the meantime are skipped
+            connection.executemany(
+                """INSERT INTO resolutions (subdomain_id, status, resolved_at)
+                   SELECT id, ?, CURRENT_TIMESTAMP FROM subdomains WHERE id = ?
+                   ON CONFLICT(subdomain_id) DO UPDATE SET status = excluded.status, resolved_at = excluded.resolved_at;""",
+                [(answer.status, subdomain_id) for subdomain_id, answer in results])
+            connection.executemany(
+                """INSERT INTO dns_records (subdomain_id, record_type, value, ttl)
+                   SELECT id, ?, ?, ? FROM subdomains WHERE id = ?
+                   ON CONFLICT(subdomain_id, record_type, value) DO UPDATE SET ttl = excluded.ttl, last_seen = CURRENT_TIMESTAMP;""",
+                [(record_type, value, ttl, subdomain_id)
+                 for subdomain_id, answer in results for record_type, value, ttl in answer.records])
+
+        alive = sum(1 for _, answer in results if answer.status == RESOLVED)
+        self.resolved += len(results)
+        self.alive += alive
+        self.db_manager.logEvent([("dns_resolved", f"{len(results)} subdomains resolved, {alive} alive")])
+
+
+def selectUnresolved(db_manager, max_age_hours=24):
+    """
+    `selectUnresolved` returns the subdomains never resolved, failed last time or resolved more than `max_age_hours` ago
+    """
+    return db_manager.execute_select_query(
+        """SELECT subdomains.id, subdomains.name FROM subdomains
+           LEFT JOIN resolutions ON resolutions.subdomain_id = subdomains.id
+           WHERE resolutions.subdomain_id IS NULL OR resolutions.status = ?
+              OR resolutions.resolved_at < datetime('now', ?);""", (FAILED, f"-{max_age_hours} hours"))
+
+
+def main(argv=None, prog=None):
+    parser = argparse.ArgumentParser(prog=prog, description="Resolve discovered subdomains and store their DNS records")
+    parser.add_argument("names", nargs="*", help="Only resolve and print these names, without storing them")
+    parser.add_argument("--db-file", help="Location of the database (default target_data/assetguard.sqlite)",
+                        dest="db_file", default="target_data/assetguard.sqlite")
+    parser.add_argument("--nameserver", help="Nameserver as host or host:port, can be repeated (default from /etc/resolv.conf)",
+                        dest="nameservers", action="append")
+    parser.add_argument("--concurrency", help="Maximum number of queries in flight (default 200)",
+                        dest="concurrency", type=int, default=200)
+    parser.add_argument("--retries", help="Times a query is sent again after a timeout or server failure (default 2)",
+                        dest="retries", type=int, default=2)
+    parser.add_argument("--timeout", help="Seconds to wait for an answer (default 2)", dest="timeout", type=float, default=2.0)
+    parser.add_argument("--max-age-hours", help="Resolve subdomains again after this many hours (default 24)",
+                        dest="max_age_hours", type=int, default=24)
+    args = parser.parse_args(argv)
+
+    resolver_options = dict(nameservers=args.nameservers, concurrency=args.concurrency,
+                            retries=args.retries, timeout=args.timeout)
+    if args.names:
+        async def resolveNames():
+            return await AsyncResolver(**resolver_options).resolveMany(args.names)
+
+        for name, answer in asyncio.run(resolveNames()).items():
+            print(name, answer.status, " ".join(f"{record_type}={value}" for record_type, value, _ in answer.records))
+        return 0
+
+    DbManager.prepareDatabase(args.db_file)
+    db_manager = DbManager.Manager(args.db_file)
+    stage = ResolutionStage(db_manager, **resolver_options)
+    stage.start()
+    stage.submit(selectUnresolved(db_manager, args.max_age_hours))
+    stage.stop()
+    db_manager.close()
+
+    print(f"{stage.resolved} subdomains resolved, {stage.alive} alive")
+    return 0
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+#!/usr/bin/python3
+# This file handles moving old entries of the logs table
+# into compressed archive files and shrinking the database
+
+import argparse
+import datetime
+import gzip
+import json
+import os
+import threading
+import time
+
+import DbManager
+
+# PRAGMA auto_vacuum value of databases that free pages with PRAGMA incremental_vacuum
+AUTO_VACUUM_INCREMENTAL = 2
+
+
+def archivePath(archive_dir, day):
+    return os.path.join(archive_dir, f"logs-{day}.jsonl.gz")
+
+
+def appendArchive(path, rows):
+    """
+    `appendArchive` appends log rows to a gzip JSONL file and waits until they are on disk.
+
+    Every call adds a new gzip member to the file; readers such as `gzip.open` and `zcat`
+    read all members as one stream.
+    """
+    with open(path, "ab") as raw_file:
+        with gzip.GzipFile(fileobj=raw_file, mode="wb") as archive_file:
+            for rowid, event_name, event_details, timestamp in rows:
+                archive_file.write(json.dumps({"id": rowid, "event_name": event_name,
+                                               "event_details": event_details, "timestamp": timestamp}).encode() + b"\n")
+        raw_file.flush()
+        os.fsync(raw_file.fileno())
+
+
+class LogRetention:
+    """
+    `LogRetention` keeps the `logs` table to the entries of the last `max_age_days` days.
+
+    Older entries are read in chunks of `chunk_size` rows in timestamp order, appended to one
+    archive file per day in `archive_dir` and only then deleted, each chunk in its own short
+    transaction, so writers never wait for more than one chunk. A crash between writing a chunk
+    and deleting it archives the chunk twice but never loses it. Hourly counts per event are
+    kept in `log_rollups` by a trigger and are not affected.
+
+    Pages freed by deletes are given back to the file system with `PRAGMA incremental_vacuum`,
+    `vacuum_pages` pages at a time, on databases created with `auto_vacuum=INCREMENTAL`.
+    """
+
+    def __init__(self, db_manager, archive_dir, max_age_days=30, chunk_size=1000, vacuum_pages=1000,
+                 interval=3600, pause=0.05):
+        self.db_manager = db_manager
+        self.archive_dir = archive_dir
+        self.max_age_days = max_age_days
+        self.chunk_size = chunk_size
+        self.vacuum_pages = vacuum_pages
+        self.interval = interval
+        self.pause = pause
+
+        self.archived = 0
+        self.freed_pages = 0
+
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def cutoff(self, now=None):
+        """
+        `cutoff` returns the timestamp before which log entries are archived
+        """
+        now = now or datetime.datetime.now(datetime.timezone.utc)
+        return (now - datetime.timedelta(days=self.max_age_days)).strftime("%Y-%m-%d %H:%M:%S")
+
+    def archiveOld(self, now=None):
+        """
+        `archiveOld` moves the log entries older than `max_age_days` into the archive. Returns their number
+        """
+        cutoff = self.cutoff(now)
+        os.makedirs(self.archive_dir, exist_ok=True)
+        # events still queued are written with the time they happened, which may be before the cutoff
+        self.db_manager.flushEvents()
+
+        archived = 0
+        while not self._stop_event.is_set():
+            rows = self.db_manager.execute_select_query(
+                """SELECT rowid, event_name, event_details, timestamp FROM logs
+                   WHERE timestamp < ? ORDER BY timestamp, rowid LIMIT ?;""", (cutoff, self.chunk_size))
+            if not rows:
+                break
+
+            days = {}
+            for row in rows:
+                days.setdefault(row[3][:10], []).append(row)
+            for day, day_rows in days.items():
+                appendArchive(archivePath(self.archive_dir, day), day_rows)
+
+            self.db_manager.execute_multi_query("DELETE FROM logs WHERE rowid=?;", [(row[0],) for row in rows])
+            archived += len(rows)
+            # let other writers take the lock between chunks
+            time.sleep(self.pause)
+
+        self.archived += archived
+        return archived
+
+    def vacuum(self):
+        """
+        `vacuum` returns free pages of the database file to the file system. Returns the number of pages freed
+        """
+        if self.db_manager.execute_select_query("PRAGMA auto_vacuum;", ())[0][0] != AUTO_VACUUM_INCREMENTAL:
+            return 0
+
+        freed = 0
+        while not self._stop_event.is_set():
+            free_pages = self.db_manager.execute_select_query("PRAGMA freelist_count;", ())[0][0]
+            if free_pages == 0:
+                break
+            self.db_manager.execute_select_query(f"PRAGMA incremental_vacuum({int(self.vacuum_pages)});", ())
+            freed += min(free_pages, self.vacuum_pages)
+            time.sleep(self.pause)
+
+        self.freed_pages += freed
+        return freed
+
+    def enableIncrementalVacuum(self):
+        """
+        `enableIncrementalVacuum` switches an existing database to `auto_vacuum=INCREMENTAL`.
+
+        This rewrites the whole file with `VACUUM` once and blocks other connections meanwhile.
+        New databases are created with incremental vacuum already enabled.
+        """
+        connection = self.db_manager.pool.getConnection()
+        if connection.execute("PRAGMA auto_vacuum;").fetchone()[0] == AUTO_VACUUM_INCREMENTAL:
+            return False
+        connection.execute("PRAGMA auto_vacuum=INCREMENTAL;")
+        connection.execute("VACUUM;")
+        return True
+
+    def runOnce(self, now=None):
+        """
+        `runOnce` archives old log entries and frees the pages they used. Returns (archived, freed_pages)
+        """
+        archived = self.archiveOld(now)
+        freed = self.vacuum()
+        if archived:
+            self.db_manager.logEvent([("logs_archived",
+                                       f"{archived} log entries older than {self.max_age_days} days archived to {self.archive_dir}, "
+                                       f"{freed} pages freed")])
+        return archived, freed
+
+    def start(self):
+        """
+        `start` starts a thread that calls `runOnce` every `interval` seconds
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="LogRetention", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        `stop` stops the thread after the chunk it is working on
+        """
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            self.runOnce()
+            self._stop_event.wait(self.interval)
+
+
+def main(argv=None, prog=None):
+    parser = argparse.ArgumentParser(prog=prog, description="Archive old log entries and shrink the database file")
+    parser.add_argument("--db-file", help="Location of the database (default target_data/assetguard.sqlite)",
+                        dest="db_file", default="target_data/assetguard.sqlite")
+    parser.add_argument("--archive-dir", help="Directory for the archive files (default target_data/log_archive)",
+                        dest="archive_dir", default="target_data/log_archive")
+    parser.add_argument("--days", help="Keep log entries of this many days in the database (default 30)",
+                        dest="days", type=int, default=30)
+    parser.add_argument("--enable-incremental-vacuum", help="Switch an existing database to incremental vacuum first. "
+                        "Rewrites the whole file once", dest="enable_incremental_vacuum", action="store_true", default=False)
+    args = parser.parse_args(argv)
+
+    DbManager.prepareDatabase(args.db_file)
+    db_manager = DbManager.Manager(args.db_file)
+    retention = LogRetention(db_manager, args.archive_dir, max_age_days=args.days)
+    if args.enable_incremental_vacuum and retention.enableIncrementalVacuum():
+        print("Incremental vacuum enabled")
+    archived, freed = retention.runOnce()
+    db_manager.close()
+
+    print(f"{archived} log entries archived, {freed} pages freed")
+    return 0
+
+
+if __name__ == "__main__":
+    main()
@@ -2,23 +2,307 @@
 # This file handles the running of tool at its
 # scheduled time
 
-import os 
+import argparse
+import datetime
+import heapq
+import itertools
+import os
+import threading
+
+import asyncexecutor
+import changes
 import DbManager
+import executor
+import freshness
+import ingest
+import jobqueue
+import metrics
+import resolver
+import retention
+import sharding
+
+WEEKDAYS = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+
+
+class ScheduleEntry:
+    """
+    `ScheduleEntry` is one row of the `schedule` table
+    """
+
+    def __init__(self, id, hour, minute, day, cmd_id, cmd_type):
+        self.id = id
+        self.hour = int(hour)
+        self.minute = int(minute)
+        self.day = (day or "everyday").strip().lower()
+        self.cmd_id = cmd_id
+        self.cmd_type = cmd_type
+
+        if not (0 <= self.hour < 24 and 0 <= self.minute < 60):
+            raise ValueError(f"invalid time {hour}:{minute}")
+        if self.day != "everyday" and self.day not in WEEKDAYS:
+            raise ValueError(f"invalid day `{day}`")
+
+    def key(self):
+        return (self.hour, self.minute, self.day, self.cmd_id, self.cmd_type)
+
+    def nextRun(self, after):
+        """
+        `nextRun` returns the first time after `after` at which this entry is due
+        """
+        candidate = after.replace(hour=self.hour, minute=self.minute, second=0, microsecond=0)
+        if candidate <= after:
+            candidate += datetime.timedelta(days=1)
+        if self.day != "everyday":
+            candidate += datetime.timedelta(days=(WEEKDAYS.index(self.day) - candidate.weekday()) % 7)
+        return candidate
+
 
 class Engine:
-    """ 
+    """
     This class can be used by other files to start the runner for tools
+
+    Schedule entries are kept in a min-heap ordered by their next run time. The loop sleeps
+    until the earliest entry is due, so it does not use CPU while idle. The `schedule` table
+    is reloaded when `PRAGMA data_version` shows another connection changed the database,
+    and only the rows that changed are pushed back on the heap.
     """
 
-    def __init__(self):
-        # check out the next line. Fix it
-        self.db_manager = DbManager.Manager(db_file)
-    def start():
-        """ 
-        Call this function to start an infinite loop, which checks the time to run the tool every moment
+    def __init__(self, db_file, on_due=None, reload_interval=30, log_retention_days=None,
+                 log_archive_dir="target_data/log_archive", slow_query_threshold=None, use_asyncio=False,
+                 resolver_options=None, queue_jobs=False, fresh_ttl=None, fresh_mode="skip", **executor_options):
+        self.db_manager = DbManager.Manager(db_file, slow_query_threshold=slow_query_threshold)
+        self.ingestor = ingest.Ingestor(self.db_manager)
+        self.change_detector = changes.ChangeDetector(self.db_manager)
+        self.ingestor.on_run_ingested = self.runIngested
+        # with `resolver_options` the subdomains of every finished run are resolved as well
+        self.resolution_stage = None
+        if resolver_options is not None:
+            self.resolution_stage = resolver.ResolutionStage(self.db_manager, **resolver_options)
+        # domains scanned by a command within `fresh_ttl` seconds are skipped or run last
+        if fresh_ttl:
+            executor_options["freshness"] = freshness.FreshnessPolicy(self.db_manager, fresh_ttl, fresh_mode)
+        # the asyncio executor supervises all tools from one thread instead of one thread per tool
+        executor_class = asyncexecutor.AsyncExecutor if use_asyncio else executor.Executor
+        self.executor = executor_class(self.db_manager, ingestor=self.ingestor, **executor_options)
+        # with `queue_jobs` due commands are left to `jobqueue.QueueWorker` processes, which may run
+        # from another directory, so the queued jobs get absolute paths
+        self.job_queue = None
+        if queue_jobs:
+            self.job_queue = jobqueue.JobQueue(self.db_manager)
+            self.executor.output_dir = os.path.abspath(self.executor.output_dir)
+        self.on_due = on_due or self.dispatch
+        self.reload_interval = reload_interval
+
+        self.log_retention = None
+        if log_retention_days:
+            self.log_retention = retention.LogRetention(self.db_manager, log_archive_dir, max_age_days=log_retention_days)
+
+        self.entries = {}
+        self.heap = []
+        self.data_version = None
+        self.invalid_ids = set()
+
+        # tie breaker so heap items with the same run time never compare entries
+        self._sequence = itertools.count()
+        self._wakeup = threading.Event()
+        self._stop_event = threading.Event()
+
+    def loadSchedule(self, now=None):
+        """
+        `loadSchedule` reads the `schedule` table and updates the heap with added or changed rows
+        """
+        now = now or datetime.datetime.now()
+        rows = self.db_manager.config_cache.get("schedule")
+
+        loaded = {}
+        for row in rows:
+            try:
+                entry = ScheduleEntry(*row)
+            except ValueError as error:
+                if row[0] not in self.invalid_ids:
+                    self.invalid_ids.add(row[0])
+                    self.db_manager.logEvent([("invalid_schedule", f"Schedule ID `{row[0]}` skipped: {error}")])
+                continue
+
+            current = self.entries.get(entry.id)
+            if current is not None and current.key() == entry.key():
+                loaded[entry.id] = current
+                continue
+            loaded[entry.id] = entry
+            self.invalid_ids.discard(entry.id)
+            heapq.heappush(self.heap, (entry.nextRun(now), next(self._sequence), entry))
+
+        # entries that were removed or replaced stay on the heap and are skipped when popped
+        self.entries = loaded
+        if len(self.heap) > 2 * len(self.entries) + 64:
+            self.heap = [item for item in self.heap if self.entries.get(item[2].id) is item[2]]
+            heapq.heapify(self.heap)
+
+        self.data_version = self.db_manager.execute_select_query("PRAGMA data_version;", ())[0][0]
+
+    def scheduleChanged(self):
+        """
+        `scheduleChanged` returns True if the database was modified by another connection since the last load
+        """
+        return self.db_manager.execute_select_query("PRAGMA data_version;", ())[0][0] != self.data_version
+
+    def notifyScheduleChanged(self):
         """
-        while True:
-            checkSchedule()
+        `notifyScheduleChanged` makes a running engine reload the schedule right away
+        """
+        self.data_version = None
+        self._wakeup.set()
+
+    def runPending(self, now=None):
+        """
+        `runPending` dispatches every entry that is due at `now` and returns the time of the next run
+        """
+        now = now or datetime.datetime.now()
+
+        while self.heap and self.heap[0][0] <= now:
+            run_at, _, entry = heapq.heappop(self.heap)
+            if self.entries.get(entry.id) is not entry:
+                continue
+            heapq.heappush(self.heap, (entry.nextRun(now), next(self._sequence), entry))
+            self.on_due(entry, run_at)
+
+        while self.heap and self.entries.get(self.heap[0][2].id) is not self.heap[0][2]:
+            heapq.heappop(self.heap)
+
+        return self.heap[0][0] if self.heap else None
+
+    def runIngested(self, run_id):
+        """
+        `runIngested` is called once the output of a run is stored. It compares the run with the previous one
+        and queues its subdomains for resolution
+        """
+        self.change_detector.detect(run_id)
+        if self.resolution_stage is not None:
+            self.resolution_stage.submitRun(run_id)
+
+    def dispatch(self, entry, run_at):
+        """
+        `dispatch` is called for every due schedule entry and queues its command on the executor or the job queue
+        """
+        if self.job_queue is not None:
+            jobs = self.job_queue.enqueueCommand(self.executor, entry.cmd_id)
+            action = "queued"
+        else:
+            jobs = self.executor.submitCommand(entry.cmd_id)
+            action = "started"
+        self.db_manager.logEvent([("scheduled_run",
+                                   f"Schedule ID `{entry.id}` due at {run_at:%Y-%m-%d %H:%M} {action} {len(jobs)} job(s) for command ID `{entry.cmd_id}`")])
+
+    def start(self):
+        """
+        Call this function to start the scheduling loop. It returns after `stop` is called
+        """
+        self._stop_event.clear()
+        if self.resolution_stage is not None:
+            self.resolution_stage.start()
+        self.ingestor.start()
+        if self.log_retention is not None:
+            self.log_retention.start()
+        self.loadSchedule()
+
+        while not self._stop_event.is_set():
+            if self.data_version is None or self.scheduleChanged():
+                self.loadSchedule()
+
+            next_run = self.runPending()
+
+            timeout = self.reload_interval
+            if next_run is not None:
+                timeout = min(timeout, max((next_run - datetime.datetime.now()).total_seconds(), 0))
+
+            self._wakeup.wait(timeout)
+            self._wakeup.clear()
+
+    def stop(self, cancel_jobs=False):
+        """
+        `stop` ends the scheduling loop and waits for the queued jobs, or cancels them with `cancel_jobs`
+        """
+        self._stop_event.set()
+        self._wakeup.set()
+        self.executor.shutdown(wait=True, cancel=cancel_jobs)
+        self.ingestor.stop()
+        if self.resolution_stage is not None:
+            self.resolution_stage.stop()
+        if self.log_retention is not None:
+            self.log_retention.stop()
+
+
+def main(argv=None, prog=None):
+    parser = argparse.ArgumentParser(prog=prog, description="Run tools at their scheduled time")
+    parser.add_argument("--db-file", help="Location of the database (default target_data/assetguard.sqlite)",
+                        dest="db_file", default="target_data/assetguard.sqlite")
+    parser.add_argument("--output-dir", help="Directory for tool output (default target_data/output)",
+                        dest="output_dir", default="target_data/output")
+    parser.add_argument("--workers", help="Maximum number of tools running at the same time (default 4)",
+                        dest="max_workers", type=int, default=4)
+    parser.add_argument("--per-tool", help="Maximum number of runs of the same tool at the same time (default 2)",
+                        dest="default_tool_limit", type=int, default=2)
+    parser.add_argument("--shards", help="Split file commands into this many parallel runs (default 1). "
+                        "Raise --per-tool as well, as shards of a command run the same tool",
+                        dest="shards", type=int, default=1)
+    parser.add_argument("--shard-by", help="Balance shards by domain count or by estimated cost from past runs",
+                        dest="shard_by", choices=sharding.SHARD_STRATEGIES, default="count")
+    parser.add_argument("--timeout", help="Seconds after which a tool run is stopped (default 21600)",
+                        dest="timeout", type=int, default=6 * 60 * 60)
+    parser.add_argument("--log-retention-days", help="Archive log entries older than this many days, 0 keeps them (default 0)",
+                        dest="log_retention_days", type=int, default=0)
+    parser.add_argument("--log-archive-dir", help="Directory for archived log entries (default target_data/log_archive)",
+                        dest="log_archive_dir", default="target_data/log_archive")
+    parser.add_argument("--slow-query-ms", help="Log database queries taking at least this many milliseconds, 0 disables (default 0)",
+                        dest="slow_query_ms", type=float, default=0)
+    parser.add_argument("--asyncio", help="Run tools as asyncio subprocesses and read their output as it is printed. "
+                        "Allows far more --workers than threads would", dest="use_asyncio", action="store_true", default=False)
+    parser.add_argument("--fresh-hours", help="Leave out domains a command scanned successfully within this many hours, "
+                        "0 runs every domain (default 0)", dest="fresh_hours", type=float, default=0)
+    parser.add_argument("--fresh-mode", help="skip leaves recently scanned domains out, last runs them after the others, "
+                        "for per-domain commands only (default skip)",
+                        dest="fresh_mode", choices=freshness.FRESHNESS_MODES, default="skip")
+    parser.add_argument("--queue", help="Queue due commands in the database for `worker` processes instead of running them here",
+                        dest="queue_jobs", action="store_true", default=False)
+    parser.add_argument("--resolve", help="Resolve the subdomains found by every run and store their A, AAAA and CNAME records",
+                        dest="resolve", action="store_true", default=False)
+    parser.add_argument("--nameserver", help="Nameserver for --resolve as host or host:port, can be repeated (default from /etc/resolv.conf)",
+                        dest="nameservers", action="append")
+    parser.add_argument("--dns-concurrency", help="Maximum number of DNS queries in flight (default 200)",
+                        dest="dns_concurrency", type=int, default=200)
+    parser.add_argument("--dns-retries", help="Times a DNS query is sent again after a timeout or server failure (default 2)",
+                        dest="dns_retries", type=int, default=2)
+    parser.add_argument("--dns-timeout", help="Seconds to wait for a DNS answer (default 2)",
+                        dest="dns_timeout", type=float, default=2.0)
+    parser.add_argument("--metrics-port", help="Serve Prometheus metrics at /metrics on this port, 0 disables (default 0)",
+                        dest="metrics_port", type=int, default=0)
+    parser.add_argument("--metrics-ip", help="Host to serve metrics on (default 127.0.0.1)",
+                        dest="metrics_ip", default="127.0.0.1")
+    args = parser.parse_args(argv)
+    if args.queue_jobs and args.resolve:
+        # queued jobs are run and ingested by the workers, so this process never sees their subdomains
+        parser.error("--resolve has no effect with --queue, pass it to `worker` instead")
+
+    if args.metrics_port:
+        metrics.serve(args.metrics_ip, args.metrics_port)
+    resolver_options = None
+    if args.resolve:
+        resolver_options = dict(nameservers=args.nameservers, concurrency=args.dns_concurrency,
+                                retries=args.dns_retries, timeout=args.dns_timeout)
+
+    DbManager.prepareDatabase(args.db_file)
+    engine = Engine(args.db_file, output_dir=args.output_dir, max_workers=args.max_workers,
+                    default_tool_limit=args.default_tool_limit, timeout=args.timeout,
+                    shards=args.shards, shard_by=args.shard_by, log_retention_days=args.log_retention_days,
+                    log_archive_dir=args.log_archive_dir, slow_query_threshold=args.slow_query_ms / 1000 or None,
+                    use_asyncio=args.use_asyncio, resolver_options=resolver_options, queue_jobs=args.queue_jobs,
+                    fresh_ttl=args.fresh_hours * 3600, fresh_mode=args.fresh_mode)
+    try:
+        engine.start()
+    except KeyboardInterrupt:
+        engine.stop(cancel_jobs=True)
+    engine.db_manager.close()
+
 
-def checkSchedule():
-    pass
\ No newline at end of file
+if __name__ == "__main__":
+    main()
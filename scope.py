@@ -0,0 +1,139 @@
+#!/usr/bin/python3
+# This file handles finding the target domain and program
+# a host name belongs to
+
+import threading
+
+# key of the entry stored in a trie node. Labels are strings, so it never clashes with one
+ENTRY = None
+
+
+class ScopeMatcher:
+    """
+    `ScopeMatcher` finds the target domain a host name is in scope of, in O(labels).
+
+    Target domains are kept in a trie of their labels from right to left, e.g. `a.example.com`
+    is stored under `com` -> `example` -> `a`. A host name is matched by following its labels
+    down the trie; the deepest target domain passed on the way is the most specific match.
+    With `enabled_only` only enabled target domains are matched.
+
+    The trie is built from the `domains` table on first use. Triggers journal every changed
+    target domain in `domain_changes`, whichever process changed it; `refresh` re-reads only
+    the domains journaled since the trie was built or last refreshed and updates it in place.
+    A matcher that fell behind the trimmed journal rebuilds the trie instead.
+    """
+
+    def __init__(self, db_manager, enabled_only=True):
+        self.db_manager = db_manager
+        self.enabled_only = enabled_only
+        self.root = {}
+        self.size = 0
+        self.version = None
+
+        self._lock = threading.Lock()
+
+    def journalPosition(self):
+        return self.db_manager.execute_select_query("SELECT COALESCE(MAX(id), 0) FROM domain_changes;", ())[0][0]
+
+    def load(self):
+        """
+        `load` builds the trie from the `domains` table
+        """
+        # read the position first, so changes made while the rows are read are applied by the next refresh
+        version = self.journalPosition()
+        query = "SELECT domain, program_url FROM domains"
+        if self.enabled_only:
+            query += " WHERE enabled>0"
+
+        root = {}
+        size = 0
+        for domain, program_url in self.db_manager.iterate_select_query(query + ";", ()):
+            size += insert(root, domain, program_url)
+        with self._lock:
+            self.root = root
+            self.size = size
+            self.version = version
+
+    def refresh(self):
+        """
+        `refresh` loads the trie on first use, or applies the domains changed since. Returns True if the trie changed
+        """
+        if self.version is None:
+            self.load()
+            return True
+        changes = self.db_manager.execute_select_query(
+            "SELECT id, domain FROM domain_changes WHERE id > ? ORDER BY id;", (self.version,))
+        if not changes:
+            return False
+        # journal ids have no gaps, so a missing one was trimmed before this matcher read it
+        if changes[0][0] != self.version + 1:
+            self.load()
+            return True
+        self._apply(list(dict.fromkeys(domain for _, domain in changes)), changes[-1][0])
+        return True
+
+    def _apply(self, domains, version):
+        # re-reads `domains`; a domain changed again meanwhile is journaled once more and re-read by the next refresh
+        rows = {}
+        # stay below the number of variables SQLite allows in a statement
+        for index in range(0, len(domains), 500):
+            chunk = domains[index:index + 500]
+            rows.update((row[0], row) for row in self.db_manager.execute_select_query(
+                f"SELECT domain, program_url, enabled FROM domains WHERE domain IN ({', '.join('?' * len(chunk))});",
+                chunk))
+
+        with self._lock:
+            for domain in domains:
+                row = rows.get(domain)
+                if row is not None and (row[2] > 0 or not self.enabled_only):
+                    self.size += insert(self.root, domain, row[1])
+                else:
+                    self.size -= remove(self.root, domain)
+            self.version = version
+
+    def match(self, name):
+        """
+        `match` returns the (domain, program_url) of the most specific target domain of `name`, or None
+        """
+        node = self.root
+        found = None
+        for label in reversed(name.split(".")):
+            node = node.get(label)
+            if node is None:
+                break
+            entry = node.get(ENTRY)
+            if entry is not None:
+                found = entry
+        return found
+
+    def __len__(self):
+        return self.size
+
+
+def insert(root, domain, program_url):
+    # returns 1 if the domain is new in the trie
+    node = root
+    for label in reversed(domain.split(".")):
+        node = node.setdefault(label, {})
+    added = ENTRY not in node
+    node[ENTRY] = (domain, program_url)
+    return int(added)
+
+
+def remove(root, domain):
+    # returns 1 if the domain was in the trie. Nodes left empty are removed
+    path = [root]
+    for label in reversed(domain.split(".")):
+        node = path[-1].get(label)
+        if node is None:
+            return 0
+        path.append(node)
+    if path[-1].pop(ENTRY, None) is None:
+        return 0
+
+    labels = list(reversed(domain.split(".")))
+    for depth in range(len(labels), 0, -1):
+        if path[depth]:
+            break
+        del path[depth - 1][labels[depth - 1]]
+    return 1
@@ -0,0 +1,138 @@
+#!/usr/bin/python3
+# This file handles splitting the target domains of file commands
+# into shards and merging the output of the shards
+
+import glob
+import heapq
+import os
+import threading
+
+SHARD_STRATEGIES = ("count", "cost")
+
+# weight of the latest run when updating the estimated cost of a domain
+COST_SMOOTHING = 0.5
+
+
+def splitByCount(domains, shards):
+    """
+    `splitByCount` splits `domains` into at most `shards` lists of (nearly) equal length
+    """
+    shards = max(1, min(shards, len(domains)))
+    return [domains[index::shards] for index in range(shards)]
+
+
+def splitByCost(domains, shards, costs, default_cost=1.0):
+    """
+    `splitByCost` splits `domains` into at most `shards` lists with (nearly) equal total estimated cost.
+
+    `costs` maps a domain to its estimated run time. Domains are assigned from the most to the
+    least expensive, each to the shard with the lowest total so far.
+    """
+    shards = max(1, min(shards, len(domains)))
+    loads = [(0.0, index) for index in range(shards)]
+    result = [[] for _ in range(shards)]
+
+    for domain in sorted(domains, key=lambda domain: costs.get(domain, default_cost), reverse=True):
+        load, index = heapq.heappop(loads)
+        result[index].append(domain)
+        heapq.heappush(loads, (load + costs.get(domain, default_cost), index))
+
+    return [shard for shard in result if shard]
+
+
+def loadCosts(db_manager, cmd_id):
+    """
+    `loadCosts` returns the estimated run time per domain for a command, from earlier runs
+    """
+    return dict(db_manager.execute_select_query(
+        "SELECT domain, seconds FROM domain_costs WHERE cmd_id=?;", (cmd_id,)))
+
+
+def recordCosts(db_manager, cmd_id, domains, duration):
+    """
+    `recordCosts` spreads the duration of a shard run over its domains and updates their estimated cost
+    """
+    if not domains:
+        return
+    seconds = duration / len(domains)
+    db_manager.execute_multi_query(
+        """INSERT INTO domain_costs (domain, cmd_id, seconds) VALUES (?, ?, ?)
+           ON CONFLICT(domain, cmd_id) DO UPDATE SET seconds = seconds * ? + excluded.seconds * ?;""",
+        [(domain, cmd_id, seconds, 1 - COST_SMOOTHING, COST_SMOOTHING) for domain in domains])
+
+
+def outputFiles(output):
+    """
+    `outputFiles` returns the files written for a job's `output` name: the name itself and the name with a suffix added by the tool.
+
+    Every job writes into a directory of its own (see `executor.jobOutput`), so no file of
+    another job starts with the same name, e.g. `amass_shard10` for `amass_shard1` or
+    `subfinder_example.com.au` for `subfinder_example.com`.
+    """
+    return sorted(path for path in glob.glob(glob.escape(output) + "*") if os.path.isfile(path))
+
+
+def mergeOutputs(shard_outputs, output):
+    """
+    `mergeOutputs` merges the output files of every shard into files named after `output`.
+
+    A tool may add a suffix to the output name (e.g. `$output.txt`), so every file starting
+    with a shard's output name is merged into the same suffix after `output`. Duplicate lines
+    are written once. Returns the merged file paths.
+    """
+    suffixes = {}
+    for shard_output in shard_outputs:
+        for path in outputFiles(shard_output):
+            suffix = path[len(shard_output):]
+            if suffix == ".log":
+                continue
+            suffixes.setdefault(suffix, []).append(path)
+
+    merged = []
+    for suffix, paths in suffixes.items():
+        seen = set()
+        with open(output + suffix, "w") as merged_file:
+            for path in paths:
+                with open(path, errors="replace") as shard_file:
+                    for line in shard_file:
+                        line = line.rstrip("\n")
+                        if line and line not in seen:
+                            seen.add(line)
+                            merged_file.write(line + "\n")
+        merged.append(output + suffix)
+
+    return merged
+
+
+class ShardGroup:
+    """
+    `ShardGroup` tracks the jobs that run one command over several shards and merges their output when all are done
+    """
+
+    def __init__(self, cmd_id, output):
+        self.cmd_id = cmd_id
+        self.output = output
+        self.jobs = []
+        self.merged = []
+
+        self._remaining = 0
+        self._lock = threading.Lock()
+        self.done = threading.Event()
+
+    def add(self, job):
+        job.group = self
+        self.jobs.append(job)
+        self._remaining += 1
+
+    def jobFinished(self):
+        """
+        `jobFinished` is called once for each finished job. Returns True for the last one
+        """
+        with self._lock:
+            self._remaining -= 1
+            return self._remaining == 0
+
+    def merge(self):
+        self.merged = mergeOutputs([job.output for job in self.jobs], self.output)
+        self.done.set()
+        return self.merged
@@ -0,0 +1,70 @@
+# Runs a tool twice through the executor and the ingestor, to check that
+# scans which found the same subdomains are marked unchanged
+
+import os
+import stat
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import changes
+import DbManager
+import executor
+import ingest
+
+TOOL = """#!/bin/sh
+# prints the results file to stdout and to $output, like tools that show progress on the terminal
+echo "[INF] Enumerating subdomains of $2"
+cat "$3"
+cat "$3" | grep -v '^\\[' > "$1"
+"""
+
+
+def createServer(tmp_path):
+    db_location = str(tmp_path / "assetguard.sqlite")
+    DbManager.Manager.createNewDB(db_location)
+    manager = DbManager.Manager(db_location)
+
+    tool = tmp_path / "tool.sh"
+    tool.write_text(TOOL)
+    tool.chmod(tool.stat().st_mode | stat.S_IEXEC)
+    with manager.transaction() as connection:
+        connection.execute("INSERT INTO domains (domain, program_url, enabled) VALUES ('example.com', 'https://example.com/program', 1);")
+        connection.execute("INSERT INTO tools (name, binary_path, enabled) VALUES ('stubtool', ?, 1);", (str(tool),))
+        cmd_id = connection.execute(
+            "INSERT INTO commands (tool, command, file_command, cmd_type) VALUES ('stubtool', ?, 0, 'subdomain_enum');",
+            ("$exec $output $domain " + str(tmp_path / "results.txt"),)).lastrowid
+    return manager, cmd_id
+
+
+def runCommand(manager, cmd_id, tmp_path, results):
+    (tmp_path / "results.txt").write_text(results)
+    ingestor = ingest.Ingestor(manager, poll_interval=0.05)
+    ingestor.on_run_ingested = changes.ChangeDetector(manager).detect
+    tool_executor = executor.Executor(manager, str(tmp_path / "output"), ingestor=ingestor)
+    ingestor.start()
+    jobs = tool_executor.submitCommand(cmd_id)
+    tool_executor.shutdown(wait=True)
+    ingestor.stop()
+    return jobs[0].id
+
+
+def scan(manager, cmd_id):
+    return manager.execute_select_query(
+        "SELECT run_id, unchanged FROM domain_scans WHERE domain = 'example.com' AND cmd_id = ?;", (cmd_id,))[0]
+
+
+def test_same_subdomains_in_another_order_are_unchanged(tmp_path):
+    manager, cmd_id = createServer(tmp_path)
+
+    first = runCommand(manager, cmd_id, tmp_path, "a.example.com\nb.example.com\nc.example.com\n")
+    assert scan(manager, cmd_id) == (first, 0)
+
+    second = runCommand(manager, cmd_id, tmp_path,
+                        "[INF] 3 found\nC.example.com\na.example.com.\nb.example.com\na.example.com\n")
+    assert scan(manager, cmd_id) == (second, 1)
+
+    third = runCommand(manager, cmd_id, tmp_path, "a.example.com\nb.example.com\nd.example.com\n")
+    assert scan(manager, cmd_id) == (third, 0)
+    assert manager.execute_select_query("SELECT name, change FROM changes WHERE run_id = ? ORDER BY name;", (third,)) == \
+        [("c.example.com", changes.GONE), ("d.example.com", changes.NEW)]
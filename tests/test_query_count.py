@@ -0,0 +1,77 @@
+# Counts the SQL statements run per request, so list pages keep
+# reading their rows with a constant number of queries
+
+import base64
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import DbManager
+import main
+import webapp
+
+HEADERS = {"Authorization": "Basic " + base64.b64encode(b"admin:admin").decode()}
+
+# route -> most statements a request may run, whatever the number of rows
+ROUTES = {
+    "/": 0,
+    "/list_targets": 1,
+    "/scheudle": 1,
+    # tools and commands come from the configuration cache
+    "/cmds": 0,
+    "/delete?type=command&cmd_id=1": 1,
+    "/edit_schedule?cmd_id=1": 2,
+    "/logs/rollups": 1,
+}
+
+
+def createServer(db_location, rows):
+    DbManager.Manager.createNewDB(db_location)
+    manager = DbManager.Manager(db_location)
+    with manager.transaction() as connection:
+        connection.executemany("INSERT INTO domains (domain, program_url, enabled) VALUES (?, ?, 1);",
+                               ((f"d{i}.example.com", "https://example.com/program") for i in range(rows)))
+        connection.executemany("INSERT INTO commands (tool, command, file_command, cmd_type) VALUES (?, ?, 1, ?);",
+                               (("amass", f"amass enum -df $domain_file -o $output -timeout {i}", "subdomain_enum")
+                                for i in range(rows)))
+        connection.executemany("INSERT INTO schedule (id, hour, minute, day, cmd_id, cmd_type) VALUES (?, ?, ?, ?, ?, ?);",
+                               ((i, i % 24, i % 60, "everyday", 1 + i % (rows + 2), "subdomain_enum")
+                                for i in range(1, rows + 1)))
+    manager.close()
+    return webapp.Server(db_location, main.buildParser().parse_args(["serve"]))
+
+
+def countStatements(server, route):
+    client = server.app.test_client()
+    # warm the configuration cache, so only the queries of the page itself are counted
+    client.get(route, headers=HEADERS).get_data()
+
+    statements = []
+    connection = server.db_manager.pool.getConnection()
+    # PRAGMA data_version is the configuration cache checking for changes, not a page query
+    connection.set_trace_callback(lambda statement: statements.append(statement)
+                                  if not statement.startswith("PRAGMA data_version") else None)
+    try:
+        response = client.get(route, headers=HEADERS)
+        # streamed pages run their queries while the body is read
+        response.get_data()
+    finally:
+        connection.set_trace_callback(None)
+    assert response.status_code == 200
+    return statements
+
+
+@pytest.mark.parametrize("route", sorted(ROUTES))
+def test_query_count_does_not_grow_with_rows(tmp_path, route):
+    counts = []
+    for rows in (5, 200):
+        server = createServer(str(tmp_path / f"assetguard-{rows}.sqlite"), rows)
+        statements = countStatements(server, route)
+        server.db_manager.close()
+        assert len(statements) <= ROUTES[route], statements
+        counts.append(len(statements))
+
+    assert counts[0] == counts[1]
@@ -0,0 +1,161 @@
+# Resolves names against a stub UDP nameserver, to check that answers
+# are only taken from the socket and for the question they were sent for
+
+import asyncio
+import os
+import socket
+import sqlite3
+import struct
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import DbManager
+import resolver
+
+# name -> (record type, value, ttl) records of the stub nameserver
+ZONE = {
+    "www.example.com": [("CNAME", "web.example.com", 300)],
+    "web.example.com": [("A", "192.0.2.10", 60), ("AAAA", "2001:db8::10", 60)],
+}
+
+
+def encodeRecord(owner, record_type, value, ttl):
+    if record_type == "A":
+        data = socket.inet_pton(socket.AF_INET, value)
+    elif record_type == "AAAA":
+        data = socket.inet_pton(socket.AF_INET6, value)
+    else:
+        data = resolver.encodeName(value)
+    return resolver.encodeName(owner) + struct.pack("!HHIH", resolver.RECORD_TYPES[record_type], resolver.CLASS_IN,
+                                                     ttl, len(data)) + data
+
+
+def encodeAnswer(query, question=None):
+    """
+    `encodeAnswer` answers `query` from `ZONE`, or answers `question` instead to play a spoofed response
+    """
+    query_id = struct.unpack_from("!H", query)[0]
+    name, offset = resolver.readName(query, 12)
+    record_type = struct.unpack_from("!H", query, offset)[0]
+    if question is not None:
+        name, record_type = question
+
+    records = []
+    owner = name
+    while owner in ZONE:
+        target = None
+        for rr_type, value, ttl in ZONE[owner]:
+            if rr_type == "CNAME" or resolver.RECORD_TYPES[rr_type] == record_type:
+                records.append(encodeRecord(owner, rr_type, value, ttl))
+                target = value if rr_type == "CNAME" else target
+        if target is None:
+            break
+        owner = target
+
+    rcode = resolver.RCODE_NOERROR if name in ZONE else resolver.RCODE_NXDOMAIN
+    header = struct.pack("!HHHHHH", query_id, 0x8180 | rcode, 1, len(records), 0, 0)
+    return header + resolver.encodeName(name) + struct.pack("!HH", record_type, resolver.CLASS_IN) + b"".join(records)
+
+
+class StubNameserver:
+    """
+    `StubNameserver` answers UDP queries on a free local port and remembers the ports they came from
+    """
+
+    def __init__(self, spoof=False):
+        self.spoof = spoof
+        self.client_ports = []
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(("127.0.0.1", 0))
+        self.address = "127.0.0.1:%d" % self.socket.getsockname()[1]
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def _serve(self):
+        while True:
+            try:
+                query, client = self.socket.recvfrom(4096)
+            except OSError:
+                return
+            self.client_ports.append(client[1])
+            if self.spoof:
+                # same id, another question: must be ignored while the real answer is awaited
+                self.socket.sendto(encodeAnswer(query, ("evil.example.com", resolver.RECORD_TYPES["A"])), client)
+            self.socket.sendto(encodeAnswer(query), client)
+
+    def close(self):
+        self.socket.close()
+
+
+@pytest.fixture
+def nameserver():
+    server = StubNameserver()
+    yield server
+    server.close()
+
+
+def resolveNames(nameserver_address, names):
+    return asyncio.run(resolver.AsyncResolver([nameserver_address], retries=0, timeout=1.0).resolveMany(names))
+
+
+def test_resolve_follows_cname(nameserver):
+    answers = resolveNames(nameserver.address, ["WWW.example.com", "missing.example.com"])
+
+    assert answers["WWW.example.com"].status == resolver.RESOLVED
+    assert ("CNAME", "web.example.com", 300) in answers["WWW.example.com"].records
+    assert ("A", "192.0.2.10", 60) in answers["WWW.example.com"].records
+    assert ("AAAA", "2001:db8::10", 60) in answers["WWW.example.com"].records
+    assert answers["missing.example.com"].status == resolver.NXDOMAIN
+
+
+def test_every_query_uses_a_new_source_port(nameserver):
+    resolveNames(nameserver.address, [f"n{index}.example.com" for index in range(20)])
+
+    # two queries (A and AAAA) per name
+    assert len(nameserver.client_ports) == 40
+    assert len(set(nameserver.client_ports)) > 1
+
+
+def test_answers_to_another_question_are_ignored():
+    server = StubNameserver(spoof=True)
+    try:
+        answers = resolveNames(server.address, ["web.example.com"])
+    finally:
+        server.close()
+
+    # the spoofed answer says NXDOMAIN
+    assert answers["web.example.com"].status == resolver.RESOLVED
+
+
+def loggedEvents(manager):
+    with manager.transaction() as connection:
+        return [row[0] for row in connection.execute("SELECT event_name FROM logs;")]
+
+
+def test_stage_keeps_running_after_a_failed_batch(nameserver, tmp_path):
+    db_location = str(tmp_path / "resolver.db")
+    DbManager.Manager.createNewDB(db_location)
+    manager = DbManager.Manager(db_location)
+    stage = resolver.ResolutionStage(manager, batch_size=1, nameservers=[nameserver.address], retries=0, timeout=1.0)
+    store = stage.store
+    failures = [sqlite3.OperationalError("database is locked")]
+
+    def failOnce(results):
+        if failures:
+            raise failures.pop()
+        store(results)
+
+    stage.store = failOnce
+    stage.start()
+    stage.submit([(1, "web.example.com")])
+    stage.submit([(2, "www.example.com")])
+    stage.stop()
+
+    assert "resolution_failed" in loggedEvents(manager)
+    assert stage.resolved == 1
+    # a stopped stage drops names instead of raising
+    stage.submit([(3, "web.example.com")])
+    assert "resolution_skipped" in loggedEvents(manager)
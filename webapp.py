@@ -0,0 +1,627 @@
+from flask import *
+from flask_httpauth import HTTPBasicAuth
+from markupsafe import escape
+import sqlite3
+import io
+import re
+import time
+from urllib.parse import urlencode
+
+# import custom files
+import api
+import changes
+import credentials
+import DbManager
+import importer
+import metrics
+import scope
+
+# number of log entries shown per page on /logs
+LOGS_PAGE_SIZE = 50
+MAX_LOGS_PAGE_SIZE = 500
+# size of the chunks sent by streamed pages
+STREAM_CHUNK_SIZE = 16 * 1024
+TIMESTAMP_PATTERN = re.compile(r"^\d{4}-\d{2}-\d{2}( \d{2}:\d{2}(:\d{2})?)?$")
+
+
+def check_regex_pattern(input_string, regex_pattern):
+    """
+    `check_regex_pattern` checks if the provided string follows the provided regex
+    """
+    # Use re.match() to check if the string follows the regex pattern
+    match = re.match(regex_pattern, input_string)
+
+    # Check if there is a match and the match spans the entire string
+    if match and match.span()[1] == len(input_string):
+        return True
+    else:
+        return False
+
+
+def streamTemplate(template_name, **context):
+    """
+    `streamTemplate` renders a template while the response is being sent.
+
+    Row generators passed in `context` are consumed as the template reaches them, so large
+    tables are neither built in memory nor delayed until the last row is read. The output is
+    sent in chunks of about `STREAM_CHUNK_SIZE` characters.
+    """
+    def chunks():
+        buffer = []
+        size = 0
+        for part in stream_template(template_name, **context):
+            buffer.append(part)
+            size += len(part)
+            if size >= STREAM_CHUNK_SIZE:
+                yield "".join(buffer)
+                buffer = []
+                size = 0
+        if buffer:
+            yield "".join(buffer)
+
+    return Response(stream_with_context(chunks()), mimetype="text/html")
+
+
+class Server:
+    """
+    `Server` class manages the web application for the AssetGuard
+
+    `options` are the parsed `serve` arguments of main.py
+    """
+
+    def __init__(self, db_file, options):
+        self.options = options
+        self.app = Flask(__name__)
+        self.auth = HTTPBasicAuth()
+        self.db_manager = DbManager.Manager(db_file, slow_query_threshold=options.slow_query_ms / 1000 or None)
+        # events (including failed logins) are written in batches from a background thread
+        self.db_manager.startLogWriter()
+        self.change_detector = changes.ChangeDetector(self.db_manager)
+        # the enabled target domains, brought up to date from the `domain_changes` journal before every lookup
+        self.scope = scope.ScopeMatcher(self.db_manager)
+
+        # only the password hash is kept in memory
+        if options.passwd_hash:
+            self.credentials = credentials.CredentialStore(options.usrnm, options.passwd_hash)
+        else:
+            self.credentials = credentials.CredentialStore.fromPassword(options.usrnm, options.passwd)
+
+        @self.auth.verify_password
+        def verify_password(username, password):
+            if username and password:
+                verified = self.credentials.verify(username, password, request.remote_addr)
+                if verified is None:
+                    abort(429)
+                if verified:
+                    return True
+                else:
+                    self.db_manager.logEvent(
+                        [("invalid_authentication_attempt", f"Invalid authentication attempt from {request.remote_addr} with username as `{username}`")])
+                    return False
+            self.db_manager.logEvent(
+                [("invalid_authentication_attempt", f"Invalid authentication attempt from {request.remote_addr}")])
+            return False
+
+        @self.app.before_request
+        def startRequestTimer():
+            g.request_start = time.perf_counter()
+
+        @self.app.after_request
+        def recordRequestTime(response):
+            start = g.get("request_start", time.perf_counter())
+            labels = (request.method, request.url_rule.rule if request.url_rule is not None else "unmatched",
+                      str(response.status_code))
+            # streamed pages are still being rendered here, so the time is taken once the body is sent
+            response.call_on_close(lambda: metrics.REQUEST_DURATION.observe(time.perf_counter() - start, *labels))
+            return response
+
+        metrics.REGISTRY.gauge("assetguard_log_writer_events", "Events handled by the log writer",
+                               lambda: {(name,): value for name, value in self.db_manager.log_writer.stats().items()},
+                               ("state",))
+        metrics.REGISTRY.gauge("assetguard_config_cache_lookups", "Lookups of the configuration cache",
+                               lambda: {("hit",): self.db_manager.config_cache.hits,
+                                        ("miss",): self.db_manager.config_cache.misses},
+                               ("result",))
+
+        @self.app.route("/metrics")
+        @self.auth.login_required
+        def handleMetrics():
+            return Response(metrics.REGISTRY.render(), content_type=metrics.CONTENT_TYPE)
+
+        # for root
+
+        @self.app.route("/")
+        @self.auth.login_required
+        def handleIndex():
+            return render_template("index.html")
+
+        # for web interface to add targets
+
+        @self.app.route('/add_targets', methods=["GET", "POST"])
+        @self.auth.login_required
+        def handleReturnAddTargets():
+            if request.method == "GET":
+                return render_template("targets/add_targets.html")
+            elif request.method == "POST":
+                data = request.form
+
+                if data["type"] == "single_domain":
+                    # the same normalization as bulk imports, so `Example.com` can't be added next to `example.com`
+                    domain = importer.normalizeDomain(data["domain"])
+                    program_url = data["program_url"]
+                    enabled = int(data["enabled"])
+
+                    # check if the given domain matches the regex of domain
+                    if check_regex_pattern(domain, importer.DOMAIN_PATTERN) == False:
+                        return render_template("targets/add_targets.html", program_url=program_url, domain=domain, message="Please enter a valid domain name")
+
+                    # check if the given program url matches the regex of URL
+                    if check_regex_pattern(program_url, importer.PROGRAM_URL_PATTERN) == False:
+                        return render_template("targets/add_targets.html", program_url=program_url, domain=domain, message="Please enter a valid program URL")
+
+                    # the unique index on domains.domain rejects domains that already exist
+                    try:
+                        self.db_manager.addTargetDomain(
+                            domain, program_url, enabled)
+                    except sqlite3.IntegrityError:
+                        return render_template("targets/add_targets.html", message=f"`{domain}` already exists")
+
+                    self.db_manager.logEvent(
+                        [("domain_added", f"{domain} added")])
+
+                    return render_template("targets/add_targets.html",  message=f"Target '{domain}' added sucessfully")
+
+                elif data["type"] == "bulk":
+                    upload = request.files.get("targets_file")
+                    if upload is None or upload.filename == "":
+                        return render_template("targets/add_targets.html", message="Please select a file to import")
+
+                    fmt = data.get("format", "auto")
+                    if fmt not in importer.FORMATS:
+                        fmt = importer.detectFormat(upload.filename)
+
+                    # read the upload as a text stream instead of loading it into memory
+                    stream = io.TextIOWrapper(upload.stream, encoding="utf-8", errors="replace", newline="")
+                    result = importer.importTargets(self.db_manager, stream, fmt,
+                                                    data.get("program_url", ""), int(data.get("enabled", "0")))
+
+                    return render_template("targets/add_targets.html", message=f"Import finished: {result.summary()}",
+                                           rejects=result.rejects, rejected=result.rejected)
+
+        # to list targets available in the database
+
+        @self.app.route("/list_targets")
+        @self.auth.login_required
+        def handleListTargets(message=""):
+            # rows are read from the cursor while the page is sent
+            target_data = self.db_manager.iterate_select_query(
+                "SELECT * FROM domains;", ())
+
+            return streamTemplate("targets/list_targets.html", targets=target_data, message=message)
+
+        # to delete a target from the
+
+        @self.app.route("/delete", methods=["GET", "POST"])
+        @self.auth.login_required
+        def handleDeleteData():
+            if request.method == "GET":
+                delete_type = request.args.get("type")
+                if delete_type == "domain":
+                    domain = request.args.get("domain")
+                    return render_template("utility/delete.html", message=f"Are you sure want to delete domain '{domain}'?", back_location="/list_targets", action=f"/delete?type=domain&domain={domain}")
+                elif delete_type == "logs":
+                    return render_template("utility/delete.html", message=f"Are you sure want to delete all logs?", back_location="/logs", action=f"/delete?type=logs")
+                elif delete_type == "command":
+                    cmd = self.db_manager.selectCommand(request.args.get("cmd_id"))
+                    if cmd is None:
+                        return redirect("/cmds")
+                    return render_template("utility/delete.html", message=f"Are you sure want to delete the command `<code>{escape(cmd['command'])}</code>` for tool `{escape(cmd['tool'])}`", back_location="/cmds", action=f"""/delete?type=command&cmd_id={cmd['id']}""")
+            elif request.method == "POST":
+                if request.args.get("type") == "domain":
+                    domain = request.args.get("domain")
+                    self.db_manager.execute_other_query(
+                        "DELETE FROM domains WHERE domain=?; ",
+                        (domain,)
+                    )
+                    self.db_manager.logEvent(
+                        [("delete_domain", f"{domain} deleted")])
+                    return render_template("targets/list_targets.html", message=f"`{domain}` deleted successfully")
+                elif request.args.get("type") == "logs":
+                    self.db_manager.flushEvents()
+                    self.db_manager.execute_other_query("DELETE FROM logs", ())
+                    return render_template("logs/logs.html", message=f"Logs deleted successfully", logs=selectLogs()[0])
+                elif request.args.get("type") == "command":
+                    cmd = self.db_manager.selectCommand(request.args.get("cmd_id"))
+                    if cmd is None:
+                        return redirect("/cmds")
+                    self.db_manager.execute_other_query("DELETE FROM commands WHERE id=?", (cmd["id"],))
+                    self.db_manager.logEvent([(
+                        "delete_command",
+                        f"""Command `{cmd['command']}` deleted for {cmd['tool']} and file command = {cmd['file_command']}"""
+                    )])
+
+                    return redirect("/cmds")
+
+        @self.app.route("/enable")
+        @self.auth.login_required
+        def handleChangeEnable():
+            if request.args.get("type") == "domain":
+                with self.db_manager.transaction():
+                    current_state = int(self.db_manager.execute_select_query(
+                        "SELECT enabled FROM domains WHERE domain=?; ", (request.args.get('domain'),))[0][0])
+                    if current_state == 0:
+                        self.db_manager.execute_other_query(
+                            "UPDATE domains SET enabled=1 WHERE domain=?; ",
+                            (
+                                request.args.get('domain'),
+                            )
+                        )
+
+                        self.db_manager.logEvent([("update_domain_enable",
+                                                   f"{request.args.get('domain')} enabled")])
+
+                        message = f"'{request.args.get('domain')}' successfully enabled"
+                    else:
+                        self.db_manager.execute_other_query(
+                            "UPDATE domains SET enabled=0 WHERE domain=?; ",
+                            (
+                                request.args.get('domain'),
+                            )
+                        )
+                        self.db_manager.logEvent(
+                            [("update_domain_enable",
+                             f"{request.args.get('domain')} disabled")]
+                        )
+                        message = f"'{request.args.get('domain')}' successfully disabled"
+
+                return handleListTargets(message=message)
+
+        # to return the list of available tools
+
+        @self.app.route("/tools", methods=["GET", "POST"])
+        @self.auth.login_required
+        def handleToolList():
+            if request.method == "GET":
+                tools = {row[0]: row for row in self.db_manager.config_cache.get("tools")}
+                amass = tools["amass"]
+                subfinder = tools["subfinder"]
+
+                # check if the tool is enabled or not
+                if amass[2] > 0:
+                    amass_checked = "checked"
+                else:
+                    amass_checked = ""
+                if subfinder[2] > 0:
+                    subfinder_checked = "checked"
+                else:
+                    subfinder_checked = ""
+
+                # check the executable binary path for the tool
+                amass_binary = amass[1]
+                subfinder_binary = subfinder[1]
+
+                return render_template("tools/tools.html",
+                                       subfinder_checked=subfinder_checked,
+                                       amass_checked=amass_checked,
+                                       amass_binary=amass_binary,
+                                       subfinder_binary=subfinder_binary
+                                       )
+            elif request.method == "POST":
+                data = request.form
+
+                amass = int(data.get('amass_enabled', '0'))
+                subfinder = int(data.get('subfinder_enabled', '0'))
+
+                self.db_manager.execute_multi_query("UPDATE tools SET enabled=? WHERE name=?;", (
+                    [amass, "amass"],
+                    [subfinder, "subfinder"]
+                ))
+
+                self.db_manager.logEvent(
+                    [("target_added", "A new target domain.com was added")])
+
+                return render_template("tools/tools.html", message="<script>location.href = location.href;</script>")
+
+        @self.app.route("/cmds", methods=["GET", "POST"])
+        @self.auth.login_required
+        def handleCmds():
+            if request.method == "GET":
+                available_db = [row for row in self.db_manager.config_cache.get("tools") if row[2] > 0]
+
+                return streamTemplate("config/cmds.html", commands=self.db_manager.config_cache.get("commands"),
+                                      tools_list=available_db)
+            elif request.method == "POST":
+                data = request.form
+                id = int(data["id"])
+                command = data["command"]
+
+                self.db_manager.execute_other_query(
+                    "UPDATE commands set command=? WHERE id=?;",
+                    (
+                        command,
+                        id,
+                    )
+                )
+
+                self.db_manager.logEvent(
+                    [("update_command", f"Command ID `{id}` updated from to {command}")])
+
+                return streamTemplate("config/cmds.html",
+                                      tools_message="Command updated successfully!",
+                                      commands=self.db_manager.config_cache.get("commands")
+                                      )
+        @self.app.route("/new_command", methods=["POST"])
+        @self.auth.login_required
+        def handleNewCommand():
+            form_data = request.form
+
+            tool_name = form_data["tool_name"]
+            command = form_data["command"]
+
+            file_command = request.form.get("file_command", "off")
+
+            if file_command == "off":
+                file_command = 0
+            else:
+                file_command = 1
+
+            if tool_name == "amass" or tool_name == "subfinder":
+                cmd_type = "subdomain_enum"
+            else:
+                cmd_type = ""
+            
+
+            self.db_manager.execute_other_query("INSERT INTO commands (tool, command, file_command, cmd_type) VALUES (?, ?, ?, ?)", (tool_name, command, file_command, cmd_type,))
+
+            return redirect("/cmds")
+
+        def readLogFilters():
+            """
+            `readLogFilters` reads the page size, cursor and filters of a logs request
+            """
+            try:
+                limit = min(max(int(request.args.get("limit", LOGS_PAGE_SIZE)), 1), MAX_LOGS_PAGE_SIZE)
+            except ValueError:
+                limit = LOGS_PAGE_SIZE
+
+            before = None
+            cursor = request.args.get("cursor", "")
+            if "|" in cursor:
+                timestamp, rowid = cursor.rsplit("|", 1)
+                if check_regex_pattern(timestamp, TIMESTAMP_PATTERN) and rowid.isdigit():
+                    before = (timestamp, int(rowid))
+
+            filters = {"event_name": request.args.get("event_name", "").strip()}
+            for name in ("since", "until"):
+                # accept both `YYYY-MM-DD HH:MM[:SS]` and the `datetime-local` input format
+                value = request.args.get(name, "").strip().replace("T", " ")
+                filters[name] = value if check_regex_pattern(value, TIMESTAMP_PATTERN) else ""
+
+            return limit, before, filters
+
+        def selectLogs(limit=LOGS_PAGE_SIZE, before=None, filters=None):
+            """
+            `selectLogs` reads one page of the application log and returns it with the next page cursor
+            """
+            self.db_manager.flushEvents()
+            logs, next_cursor = self.db_manager.selectLogsPage(limit, before, **(filters or {}))
+
+            if next_cursor is not None:
+                next_cursor = f"{next_cursor[0]}|{next_cursor[1]}"
+            return logs, next_cursor
+
+        @self.app.route("/logs")
+        @self.auth.login_required
+        def handleLogs():
+            limit, before, filters = readLogFilters()
+            logs, next_cursor = selectLogs(limit, before, filters)
+
+            next_page = None
+            if next_cursor is not None:
+                next_page = "/logs?" + urlencode(dict(filters, limit=limit, cursor=next_cursor))
+
+            return streamTemplate("logs/logs.html", logs=logs, next_page=next_page, limit=limit, **filters)
+
+        @self.app.route("/logs/rollups")
+        @self.auth.login_required
+        def handleLogRollups():
+            _, _, filters = readLogFilters()
+            self.db_manager.flushEvents()
+            rows = self.db_manager.selectLogRollups(filters["since"], filters["event_name"])
+
+            return streamTemplate("logs/rollups.html", rollups=rows, event_name=filters["event_name"], since=filters["since"])
+
+        @self.app.route("/logs.json")
+        @self.auth.login_required
+        def handleLogsJSON():
+            limit, before, filters = readLogFilters()
+            self.db_manager.flushEvents()
+            logs, next_cursor = self.db_manager.selectLogsPage(limit, before, **filters)
+
+            return jsonify({
+                "logs": [{"id": row[0], "event_name": row[1], "event_details": row[2], "timestamp": row[3]} for row in logs],
+                "next_cursor": None if next_cursor is None else f"{next_cursor[0]}|{next_cursor[1]}",
+            })
+
+        def readChangeFilters():
+            """
+            `readChangeFilters` reads the page size, cursor and filters of a changes request
+            """
+            try:
+                limit = min(max(int(request.args.get("limit", LOGS_PAGE_SIZE)), 1), MAX_LOGS_PAGE_SIZE)
+            except ValueError:
+                limit = LOGS_PAGE_SIZE
+            before_id = request.args.get("before_id", "")
+            before_id = int(before_id) if before_id.isdigit() else None
+            change = request.args.get("change", "")
+            if change not in (changes.NEW, changes.GONE):
+                change = ""
+            return limit, before_id, request.args.get("domain", "").strip(), change
+
+        @self.app.route("/changes")
+        @self.auth.login_required
+        def handleChanges():
+            limit, before_id, domain, change = readChangeFilters()
+            rows, next_id = self.change_detector.listChanges(limit, before_id, domain, change)
+
+            next_page = None
+            if next_id is not None:
+                next_page = "/changes?" + urlencode({"domain": domain, "change": change, "limit": limit, "before_id": next_id})
+
+            return render_template("changes/changes.html", rows=rows, next_page=next_page,
+                                   domain=domain, change=change, limit=limit)
+
+        @self.app.route("/changes.json")
+        @self.auth.login_required
+        def handleChangesJSON():
+            limit, before_id, domain, change = readChangeFilters()
+            rows, next_id = self.change_detector.listChanges(limit, before_id, domain, change)
+
+            return jsonify({
+                "changes": [{"id": row[0], "run_id": row[1], "domain": row[2], "name": row[3],
+                             "change": row[4], "detected_at": row[5]} for row in rows],
+                "next_before_id": next_id,
+            })
+
+        @self.app.route("/scheudle", methods=["GET", "POST"])
+        @self.auth.login_required
+        def handleSchedule():
+            if request.method == "GET":
+                return streamTemplate("config/schedule.html", schedule=self.db_manager.selectScheduleWithCommands())
+
+        @self.app.route("/edit_schedule")
+        @self.auth.login_required
+        def handleEditSchedule():
+            schedule_id = int(request.args.get("cmd_id"))
+            schedule = self.db_manager.selectScheduleEntry(schedule_id)
+            if schedule is None:
+                return redirect("/scheudle")
+
+            # generate select menu for command
+            commands = self.db_manager.selectCommandsByType(schedule["cmd_type"])
+
+            return render_template("utility/edit_schedule.html", hour=schedule["hour"], minute=schedule["minute"],
+                                   commands=commands, cmd_id=schedule["cmd_id"])
+
+        # JSON API for automation. Records are changed in batches, one transaction per request
+        self.api = Blueprint("api", __name__, url_prefix="/api/v1")
+
+        def conditionalJSON(data):
+            # clients sending the ETag of their copy get an empty 304 if nothing changed
+            response = jsonify(data)
+            response.add_etag(weak=True)
+            return response.make_conditional(request)
+
+        @self.api.errorhandler(api.ApiError)
+        def handleApiError(error):
+            return jsonify(error.toDict()), error.status
+
+        @self.api.after_request
+        def compressApiResponse(response):
+            return api.compressResponse(response, request.headers.get("Accept-Encoding", ""))
+
+        @self.api.route("/<resource>", methods=["GET"])
+        @self.auth.login_required
+        def handleApiList(resource):
+            if resource not in api.RESOURCES:
+                raise api.ApiError(f"unknown resource `{resource}`", 404)
+            return conditionalJSON({resource: api.listRecords(self.db_manager, resource)})
+
+        @self.api.route("/<resource>", methods=["POST"])
+        @self.auth.login_required
+        def handleApiBatch(resource):
+            if resource not in api.RESOURCES:
+                raise api.ApiError(f"unknown resource `{resource}`", 404)
+            payload = request.get_json(silent=True)
+            if payload is None:
+                raise api.ApiError("request body must be JSON")
+
+            result = api.applyBatch(self.db_manager, resource, payload)
+            self.db_manager.logEvent([("api_batch", f"{resource}: {len(result['created'])} created, "
+                                       f"{len(result['updated'])} updated, {len(result['deleted'])} deleted")])
+            return jsonify(result)
+
+        @self.api.route("/scope", methods=["GET", "POST"])
+        @self.auth.login_required
+        def handleApiScope():
+            # one name in the query string, or many as {"names": [...]}
+            if request.method == "GET":
+                names = [request.args.get("name", "")]
+            else:
+                payload = request.get_json(silent=True)
+                if not isinstance(payload, dict) or not isinstance(payload.get("names"), list):
+                    raise api.ApiError("request body must be an object with a `names` list")
+                names = payload["names"]
+
+            self.scope.refresh()
+            matches = []
+            for name in names:
+                match = self.scope.match(str(name).strip().lower().rstrip("."))
+                matches.append({"name": name, "domain": match and match[0], "program_url": match and match[1]})
+            return jsonify({"matches": matches})
+
+        @self.api.route("/logs", methods=["GET"])
+        @self.auth.login_required
+        def handleApiLogs():
+            limit, before, filters = readLogFilters()
+            logs, next_cursor = selectLogs(limit, before, filters)
+
+            return conditionalJSON({
+                "logs": [{"id": row[0], "event_name": row[1], "event_details": row[2], "timestamp": row[3]} for row in logs],
+                "next_cursor": next_cursor,
+            })
+
+        @self.api.route("/logs/rollups", methods=["GET"])
+        @self.auth.login_required
+        def handleApiLogRollups():
+            since = request.args.get("since", "").strip().replace("T", " ")
+            if not check_regex_pattern(since, TIMESTAMP_PATTERN):
+                since = ""
+            self.db_manager.flushEvents()
+            rows = self.db_manager.selectLogRollups(since, request.args.get("event_name", "").strip())
+
+            return conditionalJSON({"rollups": [{"event_name": row[0], "hour": row[1], "count": row[2]} for row in rows]})
+
+        self.app.register_blueprint(self.api)
+
+    def start_server(self):
+        self.app.run(str(self.options.ip), int(self.options.port))
+
+
+def start_production_server(db_file, options):
+    """
+    `start_production_server` serves the web interface with a production WSGI server.
+
+    With gunicorn each of the `workers` processes builds its own `Server` after the fork, so no
+    database connection or background thread is shared between processes; SQLite in WAL mode
+    handles the concurrent access. Send SIGHUP to the master process for a graceful reload.
+    Without gunicorn, waitress serves from a single process with `threads` threads.
+    """
+    workers = options.workers
+    threads = options.threads
+
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        BaseApplication = None
+
+    if BaseApplication is None:
+        import waitress
+        if workers > 1:
+            print("gunicorn is not installed; serving with waitress from a single process")
+        waitress.serve(Server(db_file, options).app, host=str(options.ip), port=int(options.port), threads=threads)
+        return
+
+    class GunicornApplication(BaseApplication):
+        def load_config(self):
+            self.cfg.set("bind", f"{options.ip}:{options.port}")
+            self.cfg.set("workers", workers)
+            self.cfg.set("threads", threads)
+            self.cfg.set("worker_class", "gthread")
+            self.cfg.set("preload_app", False)
+
+        def load(self):
+            return Server(db_file, options).app
+
+    GunicornApplication().run()
+